@@ -78,6 +78,9 @@ pip3 install pyscard
 # Install MCRN2 Python libraries
 pip3 install adafruit-circuitpython-pn532
 
+# Install MFRC522 Python library
+pip3 install mfrc522
+
 # Install other required libraries
 pip3 install requests RPi.GPIO
 
@@ -86,6 +89,7 @@ echo "✅ Python libraries installed:"
 echo "   • pycryptodome (DESFire encryption)"
 echo "   • pyscard (ACR122U PC/SC communication)"
 echo "   • adafruit-circuitpython-pn532 (MCRN2 SPI communication)"
+echo "   • mfrc522 (MFRC522 SPI communication)"
 echo "   • requests (API communication)"
 echo "   • RPi.GPIO (GPIO control)"
 
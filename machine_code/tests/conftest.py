@@ -0,0 +1,84 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+# The controller and its helper modules live next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """Answers every call with {"success": true}, after ?wait= seconds if given,
+    or with the status set for its path in server.statuses. Paths in
+    server.html_paths get 200 and an HTML page, like the SPA catch-all."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def answer(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body_in = self.rfile.read(length) if length else b''
+        url = urlparse(self.path)
+        self.server.paths.append(url.path)
+        if self.command == 'POST':
+            self.server.bodies.append(body_in)
+        time.sleep(float(parse_qs(url.query).get('wait', [0])[0]))
+        status = self.server.statuses.get(url.path, 200)
+        if url.path in self.server.html_paths:
+            body, content_type = b'<!DOCTYPE html><html><body><div id="root"></div></body></html>', 'text/html'
+        else:
+            body, content_type = json.dumps({'success': status < 400}).encode(), 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = answer
+
+
+def api_server_instance():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ApiHandler)
+    server.daemon_threads = True
+    server.paths = []
+    server.bodies = []
+    server.statuses = {}
+    server.html_paths = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def api_server():
+    """Local HTTP server standing in for the UrbanKetl API -> (base URL, paths seen)"""
+    server = api_server_instance()
+    yield f"http://127.0.0.1:{server.server_port}", server.paths
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def api_server_full():
+    """Like api_server, but yields the server itself (paths, bodies, statuses and HTML pages per path)"""
+    server = api_server_instance()
+    server.base_url = f"http://127.0.0.1:{server.server_port}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def machine(tmp_path, monkeypatch):
+    """Controller on a config file in tmp_path, with no reader attached"""
+    from urbanketl_machine_unified import UrbanKetlUnifiedMachine
+    monkeypatch.chdir(tmp_path)
+    with open('machine_config.json', 'w') as f:
+        json.dump({'machine_id': 'UK_TEST', 'tea_price': 5.0}, f)
+    return UrbanKetlUnifiedMachine('machine_config.json')
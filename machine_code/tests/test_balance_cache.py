@@ -0,0 +1,85 @@
+import time
+
+from urbanketl_machine_unified import BalanceCache
+
+
+def make_cache(**overrides):
+    config = dict({'optimistic_max_amount': 20, 'optimistic_card_exposure': 20,
+                   'optimistic_unit_exposure': 100, 'optimistic_machine_exposure': 500,
+                   'optimistic_balance_max_age': 3600, 'optimistic_min_balance': 0}, **overrides)
+    return BalanceCache(lambda: config)
+
+
+def test_balance_read_before_a_settled_debit_is_ignored():
+    cache = make_cache()
+    cache.update('BU1', 100)
+    validate_sent = time.monotonic()
+    assert cache.reserve('BU1', 'C1', 10)
+    cache.release('BU1', 'C1', 10, new_balance=90)
+
+    # A validate reply sent before the debit settled still shows the old balance
+    cache.update('BU1', 100, validate_sent)
+    assert cache.units['BU1']['balance'] == 90
+    assert cache.get_status()['staleBalances'] == 1
+
+    cache.update('BU1', 95)  # Read after the settlement (e.g. a top-up)
+    assert cache.units['BU1']['balance'] == 95
+
+
+def test_older_balance_does_not_replace_a_newer_one():
+    cache = make_cache()
+    cache.update('BU1', 80, observed_at=20.0)
+    cache.update('BU1', 100, observed_at=10.0)
+    assert cache.units['BU1']['balance'] == 80
+
+
+def test_conflict_forgets_the_balance():
+    cache = make_cache()
+    cache.update('BU1', 100)
+    assert cache.reserve('BU1', 'C1', 10)
+    cache.release('BU1', 'C1', 10, conflict=True)
+    assert 'BU1' not in cache.units
+    assert not cache.reserve('BU1', 'C1', 10)
+    assert cache.get_status()['declinedReasons'] == {'noBalance': 1}
+
+
+def test_reserve_within_limits():
+    cache = make_cache()
+    cache.update('BU1', 100)
+    assert cache.reserve('BU1', 'C1', 10)
+    assert cache.get_status()['unsettledAmount'] == 10
+
+
+def test_refusal_reasons():
+    cache = make_cache(optimistic_card_exposure=15, optimistic_unit_exposure=25, optimistic_machine_exposure=40)
+    assert cache.refusal('BU1', 'C1', 5) == 'noBalance'
+
+    cache.update('BU1', 100)
+    cache.update('BU2', 100)
+    assert cache.refusal('BU1', 'C1', 25) == 'amount'
+
+    assert cache.reserve('BU1', 'C1', 10)
+    assert cache.refusal('BU1', 'C1', 10) == 'cardExposure'
+    assert cache.reserve('BU1', 'C2', 10)
+    assert cache.refusal('BU1', 'C3', 10) == 'unitExposure'
+    assert cache.reserve('BU2', 'C4', 15)
+    assert cache.refusal('BU2', 'C5', 10) == 'machineExposure'
+
+
+def test_unsettled_debits_count_against_the_balance():
+    cache = make_cache(optimistic_min_balance=5)
+    cache.update('BU1', 30)
+    assert cache.reserve('BU1', 'C1', 10)
+    assert cache.reserve('BU1', 'C2', 10)
+    assert cache.refusal('BU1', 'C3', 10) == 'balance'  # 30 - 20 - 10 < 5
+
+    cache.release('BU1', 'C1', 10, new_balance=20)
+    assert cache.refusal('BU1', 'C3', 5) is None
+
+
+def test_stale_balance_goes_online():
+    cache = make_cache(optimistic_balance_max_age=60)
+    cache.update('BU1', 100)
+    cache.units['BU1']['updatedAt'] -= 61
+    assert not cache.reserve('BU1', 'C1', 5)
+    assert cache.get_status()['declinedReasons'] == {'staleBalance': 1}
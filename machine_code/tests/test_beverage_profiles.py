@@ -0,0 +1,24 @@
+import pytest
+
+from urbanketl_machine_unified import BeverageProfiles
+
+
+def test_profile_price_overrides_only_when_set(machine):
+    machine.price_cache.price = 6.0
+    machine.price_cache.machine_id = machine.config['machine_id']
+    amount = lambda profile: machine.dispense_payload('C1', 'BU1', profile, 'k')['amount']
+
+    assert amount(None) == 6.0
+    assert amount({'id': 'regular', 'name': 'Regular Tea'}) == 6.0
+    assert amount({'id': 'regular', 'name': 'Regular Tea', 'price': None}) == 6.0
+    assert amount({'id': 'masala', 'name': 'Masala Chai', 'price': 8}) == 8.0
+
+
+def test_null_price_is_valid():
+    profiles = BeverageProfiles.validate([{'id': 'regular', 'name': 'Regular Tea', 'price': None}])
+    assert profiles['regular']['price'] is None
+
+
+def test_invalid_price_is_rejected():
+    with pytest.raises(ValueError, match='invalid price'):
+        BeverageProfiles.validate([{'id': 'masala', 'name': 'Masala Chai', 'price': 0}])
@@ -0,0 +1,52 @@
+import pytest
+
+from urbanketl_machine_unified import CardCapabilities, ReaderInterface
+
+EV2_VERSION = [
+    bytes.fromhex('0401011200181591AF'),
+    bytes.fromhex('0401010200181591AF'),
+    bytes.fromhex('04A1B2C3D4E5F6BA44005119179100'),
+]
+
+
+class FakeReader(ReaderInterface):
+    """ISO14443-4 card answering GetVersion frames from a list (None: no answer)"""
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+
+    def send_apdu(self, apdu_command):
+        return self.answers.pop(0) if self.answers else None
+
+    def card_info(self):
+        return {'sak': 0x20}
+
+
+def make_capabilities():
+    return CardCapabilities(lambda: {'card_capability_cache_size': 16})
+
+
+def test_desfire_generation_is_cached():
+    capabilities = make_capabilities()
+    capability = capabilities.detect('04A1B2', FakeReader(EV2_VERSION))
+    assert (capability['type'], capability['authCommand'], capability['cached']) == ('EV2', 0xAA, False)
+    assert capabilities.detect('04A1B2', FakeReader([]))['cached']
+
+
+@pytest.mark.parametrize('status', ['6E00', '6D00'])
+def test_definite_refusal_is_cached(status):
+    capabilities = make_capabilities()
+    assert not capabilities.detect('04A1B2', FakeReader([bytes.fromhex(status)]))['supported']
+    capability = capabilities.detect('04A1B2', FakeReader(EV2_VERSION))
+    assert (capability['type'], capability['cached']) == ('not-desfire', True)
+
+
+@pytest.mark.parametrize('answer', [None, bytes.fromhex('6A82'), bytes.fromhex('6F00')])
+def test_transient_failure_is_probed_again(answer):
+    # A dropped reader connection (no answer) or an unexpected status must not brand a DESFire card
+    capabilities = make_capabilities()
+    capability = capabilities.detect('04A1B2', FakeReader([answer]))
+    assert (capability['supported'], capability['type']) == (True, 'unknown')
+    assert capabilities.get_status()['uncertain'] == 1
+
+    assert capabilities.detect('04A1B2', FakeReader(EV2_VERSION))['type'] == 'EV2'
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from urbanketl_machine_unified import UrbanKetlUnifiedMachine
+
+
+# The config helpers do not need a running controller
+bare = UrbanKetlUnifiedMachine.__new__(UrbanKetlUnifiedMachine)
+
+
+def defaults():
+    return bare.get_default_config()
+
+
+def validate(**overrides):
+    return bare.validate_config(dict(defaults(), **overrides))
+
+
+def test_defaults_are_valid():
+    assert validate() == []
+
+
+@pytest.mark.parametrize('overrides, error', [
+    ({'tea_price': 0}, "tea_price must be between"),
+    ({'dispense_time': '3'}, "dispense_time must be a number"),
+    ({'polling_interval': True}, "polling_interval must be a number"),
+    ({'auth_mode': 'offline'}, "auth_mode must be"),
+    ({'gpio_pins': {'led_green': 23}}, "gpio_pins.dispenser is required"),
+    ({'gpio_pins': {'dispenser': 18, 'buzzer': 18}}, "must not reuse the same pin"),
+    ({'spi_pins': {'cs': 40, 'reset': 25}}, "spi_pins.cs must be a BCM pin number"),
+    ({'status_host': '0.0.0.0'}, "needs a status_token"),
+    ({'beverage_buttons': {'masala': 18}}, "already gpio_pins.dispenser"),
+    ({'beverage_buttons': {'masala': 25}}, "already spi_pins.reset"),
+    ({'beverage_buttons': {'regular': 5, 'masala': 5}}, "must not reuse the same pin"),
+    ({'api_timeout': 60}, "tap_stall_timeout must be longer than 60s"),
+    ({'api_timeout': 20, 'api_endpoints': ['http://a', 'http://b', 'http://c']}, "tap_stall_timeout must be longer"),
+    ({'tap_stall_timeout': 20, 'card_removal_delay': 25}, "tap_stall_timeout must be longer than 26s"),
+])
+def test_invalid_values_are_reported(overrides, error):
+    assert any(error in message for message in validate(**overrides))
+
+
+def test_status_api_off_loopback_with_token_is_valid():
+    assert validate(status_host='0.0.0.0', status_token='s3cret') == []
+    assert validate(status_host='::1') == []
+    assert validate(status_host='0.0.0.0', status_enabled=False) == []
+
+
+def test_invalid_file_stops_startup(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('machine_config.json', 'w') as f:
+        json.dump({'tea_price': -1}, f)
+    with pytest.raises(ValueError, match='tea_price'):
+        UrbanKetlUnifiedMachine('machine_config.json')
+
+
+def test_server_cannot_change_local_only_keys(machine):
+    base_url = machine.config['api_base_url']
+    assert machine.apply_config_update({'tea_price': 7.0, 'api_base_url': 'http://elsewhere'})
+    assert machine.config['tea_price'] == 7.0
+    assert machine.config['api_base_url'] == base_url
+    assert 'api_base_url' not in machine.config_overrides
+
+    assert not machine.apply_config_update({'status_host': '0.0.0.0', 'status_token': None})
+
+
+def test_invalid_push_is_rejected(machine):
+    assert not machine.apply_config_update({'dispense_time': 600})
+    assert machine.config['dispense_time'] == defaults()['dispense_time']
+    assert machine.config_overrides == {}
+
+
+def test_pushed_values_win_over_file_reloads(machine):
+    machine.apply_config_update({'tea_price': 7.0})
+    with open('machine_config.json', 'w') as f:
+        json.dump({'machine_id': 'UK_TEST', 'tea_price': 9.0, 'dispense_time': 4.0}, f)
+
+    assert machine.reload_config('test')
+    assert machine.config['tea_price'] == 7.0
+    assert machine.config['dispense_time'] == 4.0
@@ -0,0 +1,42 @@
+import threading
+import time
+
+from urbanketl_machine_unified import ApiClient, ConnectionWarmer
+
+
+def test_long_poll_does_not_reset_idle_clock(api_server):
+    base, _ = api_server
+    api = ApiClient(lambda: {'api_base_url': base, 'api_timeout': 5})
+
+    api.get('/api/machine/commands', params={'wait': 0})
+    assert api.idle_seconds() == float('inf')
+
+    api.get('/api/machine/tea-price')
+    assert api.idle_seconds() < 1
+
+
+def test_keepalive_probe_fires_while_long_poll_is_active(api_server):
+    base, paths = api_server
+    config = {'api_base_url': base, 'api_timeout': 5, 'keepalive_interval': 1}
+    api = ApiClient(lambda: config)
+    stop = threading.Event()
+
+    def long_poll():
+        while not stop.is_set():
+            api.get('/api/machine/commands', params={'wait': 0.2})
+
+    poller = threading.Thread(target=long_poll, daemon=True)
+    poller.start()
+    warmer = ConnectionWarmer(api, lambda: api.get('/api/machine/tea-price'), lambda: config)
+    warmer.start()
+    try:
+        deadline = time.monotonic() + 5
+        while warmer.stats['probes'] == 0 and time.monotonic() < deadline:
+            time.sleep(0.1)
+    finally:
+        stop.set()
+        poller.join()
+
+    assert warmer.stats['probes'] >= 1
+    assert '/api/machine/tea-price' in paths
+    assert paths.count('/api/machine/commands') > 3
@@ -0,0 +1,59 @@
+import json
+
+from urbanketl_machine_unified import DispenseJournal
+
+
+def make_journal(tmp_path):
+    config = {'dispense_journal_file': str(tmp_path / 'journal.jsonl')}
+    return DispenseJournal(lambda: config)
+
+
+def journal_lines(tmp_path):
+    with open(tmp_path / 'journal.jsonl') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    journal = make_journal(tmp_path)
+    journal.append('a', 'authorizing', request={'amount': 10})
+    with open(tmp_path / 'journal.jsonl', 'a') as f:
+        f.write('{"key": "a", "state": "autho')  # Power lost mid-write
+
+    reloaded = make_journal(tmp_path)
+    assert [(e['key'], e['state']) for e in reloaded.unfinished()] == [('a', 'authorizing')]
+    # The rewrite on load drops the torn line, so the next append starts on a clean line
+    reloaded.append('b', 'queued')
+    assert [line['key'] for line in journal_lines(tmp_path)] == ['a', 'b']
+
+
+def test_unfinished_entries_survive_a_restart(tmp_path):
+    journal = make_journal(tmp_path)
+    journal.append('queued', 'queued', request={'amount': 10}, optimistic=True)
+    journal.append('poured', 'queued', request={'amount': 10}, optimistic=True)
+    journal.append('poured', 'poured')
+    journal.append('sent', 'authorizing', request={'amount': 10})
+    journal.append('charged', 'authorizing', request={'amount': 10})
+    journal.append('charged', 'authorized')
+    journal.append('done', 'authorizing', request={'amount': 10})
+    journal.append('done', 'authorized')
+    journal.append('done', 'dispensed')
+
+    states = {e['key']: e for e in make_journal(tmp_path).unfinished()}
+    assert {key: e['state'] for key, e in states.items()} == {
+        'queued': 'queued', 'poured': 'poured', 'sent': 'authorizing', 'charged': 'authorized'}
+    # Later records update the entry without losing the request written first
+    assert states['charged']['request'] == {'amount': 10}
+    assert states['queued']['optimistic'] is True
+
+
+def test_compaction_keeps_only_unfinished_entries(tmp_path):
+    journal = make_journal(tmp_path)
+    journal.append('open', 'authorizing', request={'amount': 10})
+    for index in range(DispenseJournal.COMPACT_EVERY - 1):  # The 200th append compacts
+        journal.append(f"tap-{index}", 'dispensed')
+
+    assert [(line['key'], line['state']) for line in journal_lines(tmp_path)] == [('open', 'authorizing')]
+    # The fsync window keeps rolling across compactions instead of starting over
+    journal.append('next', 'authorizing')
+    assert len(journal.fsync_ms) == journal.fsync_ms.maxlen
+    assert journal.get_status()['unfinished'] == {'authorizing': 2}
@@ -0,0 +1,73 @@
+import time
+
+from urbanketl_machine_unified import EndpointSelector
+
+A, B, C = 'https://a.example', 'https://b.example', 'https://c.example'
+
+
+def make_selector(**overrides):
+    config = dict({'api_base_url': A, 'api_endpoints': [A, B, C],
+                   'api_endpoint_down_after': 3, 'api_endpoint_down_for': 30,
+                   'api_endpoint_probe_interval': 60}, **overrides)
+    return EndpointSelector(lambda: config)
+
+
+def test_single_endpoint():
+    selector = make_selector(api_endpoints=[])
+    assert selector.rank() == [A]
+
+
+def test_unmeasured_first_then_fastest():
+    selector = make_selector()
+    selector.record(A, 0.200, True)
+    selector.record(B, 0.050, True)
+    assert selector.rank() == [C, B, A]
+
+    selector.record(C, 0.100, True)
+    assert selector.rank() == [B, C, A]
+
+
+def test_errors_weigh_on_the_score():
+    selector = make_selector(api_endpoint_down_after=100)
+    for url in (A, B, C):
+        selector.record(url, 0.050, True)
+    selector.record(B, 0.050, False)
+    selector.record(B, 0.050, False)
+    assert selector.rank()[-1] == B
+
+
+def test_failures_in_a_row_mark_an_endpoint_down():
+    selector = make_selector()
+    for url in (A, B, C):
+        selector.record(url, 0.050, True)
+    selector.record(A, 0.010, True)  # Fastest...
+    for _ in range(3):
+        selector.record(A, 5.0, False)  # ...until it fails three times in a row
+    assert selector.rank()[-1] == A
+    assert selector.get_status()['endpoints'][A]['down']
+
+
+def test_success_resets_the_failure_run():
+    selector = make_selector()
+    selector.record(A, 5.0, False)
+    selector.record(A, 5.0, False)
+    selector.record(A, 0.050, True)
+    selector.record(A, 5.0, False)
+    assert not selector.get_status()['endpoints'][A]['down']
+
+
+def test_down_endpoint_comes_back_after_down_for():
+    selector = make_selector(api_endpoint_down_for=0.05)
+    for _ in range(3):
+        selector.record(A, 5.0, False)
+    assert selector.rank()[-1] == A
+    time.sleep(0.1)
+    assert selector.get_status()['endpoints'][A]['down'] is False
+
+
+def test_explore_promotes_an_idle_endpoint():
+    selector = make_selector(api_endpoint_probe_interval=0)
+    for url, seconds in ((A, 0.010), (B, 0.050), (C, 0.100)):
+        selector.record(url, seconds, True)
+    assert selector.rank() == [A, B, C]
+    assert selector.rank(explore=True) == [B, A, C]
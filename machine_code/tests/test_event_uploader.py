@@ -0,0 +1,80 @@
+import json
+import os
+
+import pytest
+import requests
+
+from urbanketl_machine_unified import ApiClient, EventUploader, acknowledged
+
+
+def make_uploader(server, tmp_path):
+    config = {
+        'api_base_url': server.base_url,
+        'api_timeout': 5,
+        'machine_id': 'M1',
+        'events_spool_dir': str(tmp_path / 'spool')
+    }
+    return EventUploader(ApiClient(lambda: config), lambda: config)
+
+
+def buffered_batch(uploader, count):
+    for index in range(count):
+        uploader.add({'type': 'tap', 'n': index})
+    with uploader.lock:
+        return uploader.take_batch()
+
+
+def test_missing_bulk_endpoint_falls_back_to_single_posts(api_server_full, tmp_path):
+    api_server_full.statuses[EventUploader.PATH] = 404
+    uploader = make_uploader(api_server_full, tmp_path)
+
+    assert uploader.send(*buffered_batch(uploader, 3))
+    assert api_server_full.paths == [EventUploader.PATH] + [EventUploader.EVENT_PATH] * 3
+    posted = [json.loads(body) for body in api_server_full.bodies[1:]]
+    assert [post['event']['n'] for post in posted] == [0, 1, 2]
+    assert len({post['eventId'] for post in posted}) == 3
+    assert uploader.stats['eventsPostedSingly'] == 3
+
+    # The bulk endpoint is not asked again until events_bulk_recheck has passed
+    assert uploader.send(*buffered_batch(uploader, 1))
+    assert api_server_full.paths.count(EventUploader.PATH) == 1
+
+
+def test_failed_single_post_keeps_the_batch(api_server_full, tmp_path):
+    api_server_full.statuses[EventUploader.PATH] = 405
+    api_server_full.statuses[EventUploader.EVENT_PATH] = 503
+    uploader = make_uploader(api_server_full, tmp_path)
+
+    assert not uploader.send(*buffered_batch(uploader, 2))
+    assert uploader.stats['eventsUploaded'] == 0
+    assert uploader.stats['eventsDropped'] == 0
+
+
+def test_html_page_is_not_an_acknowledgement(api_server_full, tmp_path):
+    # The real server has no events routes; its SPA catch-all answers 200 with index.html
+    api_server_full.html_paths.update({EventUploader.PATH, EventUploader.EVENT_PATH})
+    uploader = make_uploader(api_server_full, tmp_path)
+    uploader.spool(*buffered_batch(uploader, 2))
+
+    uploader.drain_spool()
+    assert len(os.listdir(tmp_path / 'spool')) == 1
+    assert api_server_full.paths == [EventUploader.PATH, EventUploader.EVENT_PATH]
+    assert uploader.stats['eventsUploaded'] == 0
+    assert uploader.stats['eventsDropped'] == 0
+
+
+@pytest.mark.parametrize('status, content_type, body, expected', [
+    (200, 'application/json', b'{"success": true}', True),
+    (202, 'application/json; charset=utf-8', b'{"ack": true}', True),
+    (200, 'application/json', b'{"success": false}', False),
+    (200, 'application/json', b'{}', False),
+    (200, 'text/html', b'<!DOCTYPE html>', False),
+    (204, '', b'', False),
+    (500, 'application/json', b'{"success": true}', False),
+])
+def test_only_a_json_acknowledgement_counts(status, content_type, body, expected):
+    response = requests.Response()
+    response.status_code = status
+    response.headers['Content-Type'] = content_type
+    response._content = body
+    assert acknowledged(response) is expected
@@ -0,0 +1,14 @@
+from urbanketl_machine_unified import LivenessMonitor
+
+
+def test_allowance_covers_one_step():
+    liveness = LivenessMonitor()
+    liveness.register('tap', 10)
+
+    liveness.beat('tap', allowance=30)  # A 30s pour starts
+    liveness.components['tap']['last_beat'] -= 35
+    assert liveness.check() == []
+
+    liveness.beat('tap')  # The pour is over; back to the plain limit
+    liveness.components['tap']['last_beat'] -= 11
+    assert liveness.check() == ['tap']
@@ -0,0 +1,38 @@
+from urbanketl_machine_unified import MCRN2Reader
+
+
+class FakePN532:
+    """Answers InListPassiveTarget with a fixed response"""
+
+    def __init__(self, response):
+        self.response = response
+
+    def listen_for_passive_target(self, timeout):
+        return True
+
+    def process_response(self, command, response_length, timeout):
+        return self.response
+
+
+def make_reader(response):
+    reader = MCRN2Reader()
+    reader.nfc_reader = FakePN532(bytearray(response))
+    return reader
+
+
+def test_card_uid_and_sak():
+    reader = make_reader(bytes.fromhex('0101004420070411223344556605'))
+    assert reader.read_uid() == bytes.fromhex('04112233445566')
+    assert reader.card_info()['sak'] == 0x20
+
+
+def test_two_cards_are_no_read_not_a_reader_fault():
+    reader = make_reader(bytes.fromhex('0201004420070411223344556605'))
+    assert reader.read_uid() is None
+    assert reader.read_errors == 0
+
+
+def test_garbled_answer_is_a_reader_fault():
+    reader = make_reader(bytes.fromhex('01010044200B'))
+    assert reader.read_uid() is None
+    assert reader.read_errors == 1
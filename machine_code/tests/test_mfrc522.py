@@ -0,0 +1,16 @@
+import pytest
+
+from urbanketl_machine_unified import MFRC522Reader
+
+
+@pytest.mark.parametrize('frame, crc', [
+    ('5000', '57CD'),  # HLTA
+    ('0000', 'A01E'),  # ISO/IEC 14443-3 Annex B examples
+    ('1234', '26CF'),
+])
+def test_crc_a(frame, crc):
+    assert MFRC522Reader.crc_a(bytes.fromhex(frame)) == bytes.fromhex(crc)
+
+
+def test_crc_a_of_empty_frame_is_the_preset():
+    assert MFRC522Reader.crc_a(b'') == bytes([0x63, 0x63])
@@ -0,0 +1,10 @@
+from urbanketl_machine_unified import Profiler
+
+
+def test_empty_deterministic_session_leaves_nothing_on_disk(tmp_path):
+    profile_dir = tmp_path / 'profiles'
+    profiler = Profiler(lambda: {'profile_dir': str(profile_dir), 'profile_max_seconds': 60})
+
+    assert profiler.start('deterministic')
+    assert profiler.stop() is None  # No taps were profiled
+    assert not profile_dir.exists()
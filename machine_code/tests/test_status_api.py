@@ -0,0 +1,25 @@
+import pytest
+
+from urbanketl_machine_unified import MemoryMonitor
+
+
+def test_test_dispense_is_refused_while_a_tap_holds_the_valve(machine):
+    assert machine.claim_tap()  # The poller took a card
+    with pytest.raises(RuntimeError):
+        machine.test_dispense()
+
+    machine.processing_card = False
+    machine.config['dispense_time'] = 0.1
+    assert machine.test_dispense()
+    assert machine.claim_tap()  # Released again afterwards
+
+
+def test_status_reuses_the_heartbeat_type_counts(monkeypatch):
+    memory = MemoryMonitor(lambda: {'memory_top_types': 3})
+    counted = []
+    monkeypatch.setattr(memory, 'top_types', lambda limit: counted.append(limit) or [['dict', 1]])
+
+    assert 'topTypes' not in memory.get_status()
+    memory.get_snapshot()  # Heartbeat
+    assert memory.get_status()['topTypes'] == [['dict', 1]]
+    assert counted == [3]
@@ -0,0 +1,34 @@
+import threading
+
+from urbanketl_machine_unified import LivenessMonitor, TapWorker
+
+
+def test_one_tap_at_a_time():
+    release = threading.Event()
+    done = threading.Event()
+    taps = []
+
+    def handler(card_uid_hex, read_ms):
+        taps.append(card_uid_hex)
+        release.wait(5)
+        done.set()
+
+    worker = TapWorker(handler, LivenessMonitor())
+    worker.start()
+    try:
+        assert worker.submit('AA', 1.0)
+        assert not worker.submit('BB', 1.0)  # Still pouring for AA
+        release.set()
+        assert done.wait(5)
+        for _ in range(100):
+            if not worker.get_status()['busy']:
+                break
+            threading.Event().wait(0.01)
+
+        status = worker.get_status()
+        assert taps == ['AA']
+        assert (status['submitted'], status['completed'], status['rejected']) == (1, 1, 1)
+        assert worker.submit('CC', 1.0)
+    finally:
+        release.set()
+        worker.stop()
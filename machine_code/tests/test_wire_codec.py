@@ -0,0 +1,39 @@
+import pytest
+
+from urbanketl_machine_unified import WireCodec
+
+PAYLOAD = {
+    'machineId': 'UK_0001',
+    'cardUid': '04A1B2C3D4E5F6',
+    'challenge': '00112233445566778899AABBCCDDEEFF',
+    'nested': [{'response': 'DEADBEEF', 'amount': 5.0}],
+    'teaType': 'Regular Tea'
+}
+
+
+@pytest.fixture(params=['msgpack', 'cbor'])
+def codec(request):
+    if not WireCodec.available(request.param):
+        pytest.skip(f"{request.param} not installed")
+    return WireCodec(request.param)
+
+
+def test_round_trip(codec):
+    assert codec.decode(codec.encode(PAYLOAD)) == PAYLOAD
+
+
+def test_hex_fields_travel_as_bytes(codec):
+    packed = codec.loads(codec.encode(PAYLOAD))
+    assert packed['cardUid'] == bytes.fromhex('04A1B2C3D4E5F6')
+    assert packed['nested'][0]['response'] == bytes.fromhex('DEADBEEF')
+    assert packed['machineId'] == 'UK_0001'
+
+
+@pytest.mark.parametrize('value', ['04a1b2', 'ABC', 'XYZ0', ''])
+def test_hex_fields_that_would_not_round_trip_stay_strings(codec, value):
+    assert codec.decode(codec.encode({'cardUid': value})) == {'cardUid': value}
+
+
+def test_for_content_type(codec):
+    assert WireCodec.for_content_type(codec.content_type).name == codec.name
+    assert WireCodec.for_content_type('application/json') is None
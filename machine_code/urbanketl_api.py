@@ -0,0 +1,1012 @@
+"""
+UrbanKetl Tea Machine Controller - Server API
+HTTP client with endpoint ranking and hedging, binary wire formats, DNS
+cache, keep-alive warmer, push channel and tap event upload
+"""
+
+import time
+import json
+import requests
+import logging
+import threading
+import uuid
+import gzip
+import random
+import socket
+import os
+from urllib3.exceptions import NewConnectionError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Callable
+from urllib.parse import urlparse
+
+# Compact binary wire formats (optional, JSON is used without them)
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+try:
+    import cbor2
+    CBOR_AVAILABLE = True
+except ImportError:
+    CBOR_AVAILABLE = False
+
+from urbanketl_common import percentile
+
+
+class WireCodec:
+    """
+    Compact binary encoding (MessagePack or CBOR) for machine API payloads
+    
+    Hex fields (challenge, card response, card UID) travel as raw bytes,
+    which halves their size; decode() turns them back into uppercase hex
+    so callers see exactly the JSON shape.
+    """
+    
+    HEX_FIELDS = ('challenge', 'response', 'cardUid')
+    CONTENT_TYPES = {'msgpack': 'application/msgpack', 'cbor': 'application/cbor'}
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.content_type = self.CONTENT_TYPES[name]
+        if name == 'msgpack':
+            self.dumps = lambda value: msgpack.packb(value, use_bin_type=True)
+            self.loads = lambda data: msgpack.unpackb(data, raw=False)
+        else:
+            self.dumps = cbor2.dumps
+            self.loads = cbor2.loads
+    
+    @staticmethod
+    def available(name: str) -> bool:
+        return (name == 'msgpack' and MSGPACK_AVAILABLE) or (name == 'cbor' and CBOR_AVAILABLE)
+    
+    @classmethod
+    def for_content_type(cls, content_type: str) -> Optional['WireCodec']:
+        for name, known in cls.CONTENT_TYPES.items():
+            if content_type == known and cls.available(name):
+                return cls(name)
+        return None
+    
+    def pack_hex(self, value: Any) -> Any:
+        if isinstance(value, dict):
+            return {key: self.hex_to_bytes(item) if key in self.HEX_FIELDS else self.pack_hex(item)
+                    for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.pack_hex(item) for item in value]
+        return value
+    
+    @staticmethod
+    def hex_to_bytes(value: Any) -> Any:
+        # Only uppercase even-length hex round-trips exactly; anything else stays a string
+        if isinstance(value, str) and len(value) % 2 == 0 and value == value.upper():
+            try:
+                return bytes.fromhex(value)
+            except ValueError:
+                pass
+        return value
+    
+    def unpack_hex(self, value: Any) -> Any:
+        if isinstance(value, dict):
+            return {key: item.hex().upper() if isinstance(item, bytes) else self.unpack_hex(item)
+                    for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.unpack_hex(item) for item in value]
+        return value
+    
+    def encode(self, payload: Any) -> bytes:
+        return self.dumps(self.pack_hex(payload))
+    
+    def decode(self, data: bytes) -> Any:
+        return self.unpack_hex(self.loads(data))
+
+
+class DnsCache:
+    """
+    getaddrinfo cache for the API host only
+    
+    Wraps socket.getaddrinfo once per process. Lookups for hosts registered
+    with scope() are cached for dns_ttl seconds; if the resolver fails, a
+    stale answer up to dns_stale_max seconds old is used instead. Every
+    other host goes straight to the system resolver. The per-thread lookup
+    count tells the caller whether a request had to open a new connection.
+    """
+    
+    shared_instance = None
+    
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.hosts = {}  # host -> (ttl, stale_max)
+        self.cache = {}  # lookup args -> (result, resolved_at)
+        self.local = threading.local()
+        self.stats = {'hits': 0, 'misses': 0, 'staleServed': 0, 'failures': 0}
+        self.resolve = socket.getaddrinfo
+        socket.getaddrinfo = self.getaddrinfo
+    
+    @classmethod
+    def shared(cls) -> 'DnsCache':
+        if cls.shared_instance is None:
+            cls.shared_instance = cls()
+        return cls.shared_instance
+    
+    def scope(self, host: str, ttl: float, stale_max: float):
+        """Cache lookups for host (called per request so config reloads apply)"""
+        self.hosts[host] = (ttl, stale_max)
+    
+    def lookups(self) -> int:
+        """Scoped lookups made by the current thread (one per new connection)"""
+        return getattr(self.local, 'lookups', 0)
+    
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        settings = self.hosts.get(host)
+        if settings is None:
+            return self.resolve(host, port, family, type, proto, flags)
+        
+        self.local.lookups = self.lookups() + 1
+        ttl, stale_max = settings
+        key = (host, port, family, type, proto, flags)
+        now = time.monotonic()
+        cached = self.cache.get(key)
+        if cached and now - cached[1] < ttl:
+            self.stats['hits'] += 1
+            return cached[0]
+        
+        try:
+            result = self.resolve(host, port, family, type, proto, flags)
+        except socket.gaierror as e:
+            self.stats['failures'] += 1
+            if cached and now - cached[1] < stale_max:
+                self.stats['staleServed'] += 1
+                self.logger.warning(f"⚠️  DNS lookup for {host} failed ({e}) - using cached address from {now - cached[1]:.0f}s ago")
+                return cached[0]
+            raise
+        
+        with self.lock:
+            self.cache[key] = (result, now)
+        self.stats['misses'] += 1
+        return result
+    
+    def get_status(self) -> Dict[str, Any]:
+        return dict(self.stats, hosts=sorted(self.hosts))
+
+
+def request_never_sent(error: Exception) -> bool:
+    """True if a requests error happened before the request reached the server"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+    return False
+
+
+def acknowledged(response: requests.Response) -> bool:
+    """
+    True if the server acknowledged the call in a JSON body
+    ({"success": true} or {"ack": true}). A bare 200 is not enough: the
+    server's SPA catch-all answers unknown routes with 200 and index.html.
+    """
+    if not 200 <= response.status_code < 300:
+        return False
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+    if content_type != 'application/json' and WireCodec.for_content_type(content_type) is None:
+        return False
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    return isinstance(body, dict) and (body.get('success') is True or body.get('ack') is True)
+
+
+class EndpointSelector:
+    """
+    Latency and error tracking for the API endpoints
+    
+    Endpoints come from api_endpoints (or just api_base_url). Each one keeps
+    an EWMA of latency and error rate plus recent latencies for its p95.
+    rank() orders them best first: unmeasured endpoints are tried first,
+    and an endpoint failing api_endpoint_down_after calls in a row drops to
+    the back for api_endpoint_down_for seconds. Hedged duplicates draw on a
+    token bucket refilled by api_hedge_budget per eligible call, so they
+    never exceed that share of the traffic.
+    """
+    
+    ALPHA = 0.2
+    
+    def __init__(self, get_config: Callable[[], Dict[str, Any]]):
+        self.get_config = get_config
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.hedge_tokens = 1.0
+        self.hedge_stats = {'eligible': 0, 'sent': 0, 'won': 0, 'budgetDenied': 0}
+    
+    def urls(self) -> List[str]:
+        config = self.get_config()
+        return [url.rstrip('/') for url in config.get('api_endpoints') or [config['api_base_url']]]
+    
+    def endpoint(self, url: str) -> Dict[str, Any]:
+        if url not in self.stats:
+            self.stats[url] = {'ewmaMs': None, 'errorRate': 0.0, 'latencies': deque(maxlen=200),
+                               'requests': 0, 'errors': 0, 'failuresInRow': 0, 'downUntil': 0.0,
+                               'lastSample': 0.0}
+        return self.stats[url]
+    
+    def record(self, url: str, seconds: float, ok: bool):
+        ms = seconds * 1000
+        config = self.get_config()
+        with self.lock:
+            endpoint = self.endpoint(url)
+            endpoint['requests'] += 1
+            endpoint['lastSample'] = time.monotonic()
+            endpoint['errorRate'] += self.ALPHA * ((0.0 if ok else 1.0) - endpoint['errorRate'])
+            if ok:
+                endpoint['failuresInRow'] = 0
+                endpoint['latencies'].append(ms)
+                endpoint['ewmaMs'] = ms if endpoint['ewmaMs'] is None else endpoint['ewmaMs'] + self.ALPHA * (ms - endpoint['ewmaMs'])
+                return
+            endpoint['errors'] += 1
+            endpoint['failuresInRow'] += 1
+            if endpoint['failuresInRow'] >= config.get('api_endpoint_down_after', 3):
+                endpoint['downUntil'] = time.monotonic() + config.get('api_endpoint_down_for', 30)
+    
+    def rank(self, explore: bool = False) -> List[str]:
+        """Endpoints best first. With explore, one not measured for a while goes first."""
+        urls = self.urls()
+        if len(urls) == 1:
+            return urls
+        
+        now = time.monotonic()
+        with self.lock:
+            def score(url):
+                endpoint = self.endpoint(url)
+                if endpoint['downUntil'] > now:
+                    return (1, 0.0)
+                if endpoint['ewmaMs'] is None:
+                    return (0, 0.0)
+                return (0, endpoint['ewmaMs'] * (1 + 4 * endpoint['errorRate']))
+            
+            ranked = sorted(urls, key=score)
+            if explore:
+                stale = now - self.get_config().get('api_endpoint_probe_interval', 60)
+                idle = [url for url in ranked[1:] if self.endpoint(url)['lastSample'] < stale
+                        and self.endpoint(url)['downUntil'] <= now]
+                if idle:
+                    ranked.remove(idle[0])
+                    ranked.insert(0, idle[0])
+        return ranked
+    
+    def hedge_delay(self, url: str) -> float:
+        """Seconds to wait for url before hedging: its p95, once there are enough samples"""
+        config = self.get_config()
+        with self.lock:
+            latencies = list(self.endpoint(url)['latencies'])
+        if len(latencies) < 20:
+            return config.get('api_hedge_delay', 1.0)
+        return max(percentile(latencies, 95) / 1000.0, config.get('api_hedge_min_delay', 0.05))
+    
+    def hedge_eligible(self):
+        """Count an eligible call and refill the hedge budget"""
+        with self.lock:
+            self.hedge_stats['eligible'] += 1
+            self.hedge_tokens = min(self.hedge_tokens + self.get_config().get('api_hedge_budget', 0.1), 5.0)
+    
+    def take_hedge(self) -> bool:
+        with self.lock:
+            if self.hedge_tokens < 1.0:
+                self.hedge_stats['budgetDenied'] += 1
+                return False
+            self.hedge_tokens -= 1.0
+            self.hedge_stats['sent'] += 1
+            return True
+    
+    def hedge_won(self):
+        with self.lock:
+            self.hedge_stats['won'] += 1
+    
+    def get_status(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self.lock:
+            endpoints = {}
+            for url in self.urls():
+                endpoint = self.endpoint(url)
+                latencies = list(endpoint['latencies'])
+                endpoints[url] = {
+                    'requests': endpoint['requests'],
+                    'errors': endpoint['errors'],
+                    'errorRate': round(endpoint['errorRate'], 3),
+                    'ewmaMs': round(endpoint['ewmaMs'], 1) if endpoint['ewmaMs'] is not None else None,
+                    'p95Ms': percentile(latencies, 95),
+                    'down': endpoint['downUntil'] > now
+                }
+            return {'endpoints': endpoints, 'hedging': dict(self.hedge_stats)}
+
+
+class ApiClient:
+    """
+    HTTP client for the UrbanKetl server API (keep-alive session)
+    
+    With wire_format set to "msgpack" or "cbor", auth and heartbeat POSTs
+    advertise the binary type in Accept. Bodies switch to binary only once
+    the server has answered in that type, and fall back to JSON on a 415.
+    
+    Each call goes to the best of the API endpoints (EndpointSelector) and
+    moves on to the next one if it could not connect. Idempotent calls
+    (HEDGE_PATHS) get a duplicate to the second endpoint when the first is
+    slower than its own p95. Responses carry the endpoint that answered
+    (response.endpoint) so a call can be pinned to it with endpoint=.
+    """
+    
+    # Calls eligible for the binary wire format
+    BINARY_PATHS = ('/api/machine/auth/', '/api/machine/heartbeat')
+    
+    # Every tap starts with this call
+    FIRST_TAP_PATH = '/api/machine/auth/challenge'
+    
+    # Safe to send twice: a heartbeat is a status report. Challenges are kept in
+    # the memory of the server process that issued them, so auth calls are never
+    # hedged - validate and dispense are pinned to the challenge's endpoint.
+    HEDGE_PATHS = ('/api/machine/heartbeat',)
+    
+    # Long-polls hold a pooled connection of their own, so they say nothing about
+    # how warm the tap path's connection is and do not reset the idle clock
+    IDLE_EXEMPT_PATHS = ('/api/machine/commands',)
+    
+    def __init__(self, get_config: Callable[[], Dict[str, Any]]):
+        # get_config returns the live config so reloads apply to the next call
+        self.get_config = get_config
+        self.session = requests.Session()
+        self.recorder = None
+        self.binary_accepted = False  # Server has answered in the binary format
+        self.codec_warned = False
+        self.wire_stats = {'bytesSent': 0, 'bytesReceived': 0, 'binaryResponses': 0, 'fallbacks': 0}
+        self.logger = logging.getLogger(__name__)
+        self.dns = DnsCache.shared()
+        self.endpoints = EndpointSelector(get_config)
+        self.executor = None
+        self.last_request = None
+        self.connection_stats = {'opened': 0, 'reused': 0}
+        # First request of each tap, split by whether it needed a new connection
+        self.first_request_ms = {'cold': deque(maxlen=200), 'warm': deque(maxlen=200)}
+    
+    def idle_seconds(self) -> float:
+        """Seconds since the last completed request (long-polls excluded)"""
+        return time.monotonic() - self.last_request if self.last_request is not None else float('inf')
+    
+    def wire_codec(self, path: str) -> Optional[WireCodec]:
+        """Binary codec to offer for this path, or None for plain JSON"""
+        name = self.get_config().get('wire_format', 'json')
+        if name == 'json' or not path.startswith(self.BINARY_PATHS):
+            return None
+        if not WireCodec.available(name):
+            if not self.codec_warned:
+                self.logger.warning(f"⚠️  wire_format {name} needs the {'msgpack' if name == 'msgpack' else 'cbor2'} package - using JSON")
+                self.codec_warned = True
+            return None
+        return WireCodec(name)
+    
+    def timeout(self, timeout: Optional[float]) -> float:
+        return timeout if timeout is not None else self.get_config().get('api_timeout', 5)
+    
+    def post(self, path: str, payload: Dict[str, Any], timeout: Optional[float] = None,
+             headers: Optional[Dict[str, str]] = None, endpoint: Optional[str] = None) -> requests.Response:
+        """POST a payload (JSON or negotiated binary). Network errors are raised to the caller."""
+        codec = self.wire_codec(path)
+        if codec is None:
+            return self.request('POST', path, json=payload, headers=headers, timeout=timeout, endpoint=endpoint)
+        
+        accept = dict(headers or {}, Accept=f"{codec.content_type}, application/json;q=0.9")
+        if not self.binary_accepted:
+            return self.request('POST', path, json=payload, headers=accept, timeout=timeout, endpoint=endpoint)
+        
+        response = self.request('POST', path, data=codec.encode(payload), trace_payload=payload, timeout=timeout,
+                                headers=dict(accept, **{'Content-Type': codec.content_type}), endpoint=endpoint)
+        if response.status_code == 415:
+            self.logger.warning(f"⚠️  Server rejected {codec.name} body - falling back to JSON")
+            self.binary_accepted = False
+            self.wire_stats['fallbacks'] += 1
+            return self.request('POST', path, json=payload, headers=accept, timeout=timeout, endpoint=endpoint)
+        return response
+    
+    def get(self, path: str, headers: Optional[Dict[str, str]] = None,
+            timeout: Optional[float] = None, params: Optional[Dict[str, Any]] = None) -> requests.Response:
+        """GET a resource. Network errors are raised to the caller."""
+        return self.request('GET', path, headers=headers, params=params, timeout=timeout)
+    
+    def request(self, method: str, path: str, timeout: Optional[float] = None,
+                endpoint: Optional[str] = None, **kwargs) -> requests.Response:
+        """
+        Send a request, recording it into the current tap trace
+        
+        With endpoint (a previous response.endpoint) the call goes only
+        there: no ranking, hedging or failover.
+        """
+        trace_payload = kwargs.pop('trace_payload', kwargs.get('json'))
+        hedge = path in self.HEDGE_PATHS and self.get_config().get('api_hedging', True) and endpoint is None
+        
+        started = time.perf_counter()
+        try:
+            ranked = [endpoint] if endpoint else self.endpoints.rank(explore=path == '/api/machine/heartbeat')
+            if hedge and len(ranked) > 1:
+                response, cold = self.hedged(ranked, method, path, timeout, kwargs)
+            else:
+                response, cold = self.failover(ranked, method, path, timeout, kwargs)
+        except Exception as e:
+            if self.recorder:
+                self.recorder.record('http', started, m=method, p=path, req=trace_payload, err=str(e))
+            raise
+        
+        if not path.startswith(self.IDLE_EXEMPT_PATHS):
+            self.last_request = time.monotonic()
+        if path == self.FIRST_TAP_PATH:
+            self.first_request_ms['cold' if cold else 'warm'].append((time.perf_counter() - started) * 1000)
+        
+        body = response.request.body if response.request is not None else None
+        self.wire_stats['bytesSent'] += len(body) if body else 0
+        self.wire_stats['bytesReceived'] += len(response.content)
+        binary = self.decode_binary(response)
+        
+        if self.recorder:
+            self.recorder.record('http', started, m=method, p=path, req=trace_payload, s=response.status_code,
+                                 res=json.dumps(response.json()) if binary else response.text)
+        return response
+    
+    def send(self, base: str, method: str, path: str, timeout: Optional[float],
+             kwargs: Dict[str, Any]) -> tuple:
+        """(response, opened a new connection) from one endpoint, feeding its stats"""
+        config = self.get_config()
+        self.dns.scope(urlparse(base).hostname, config.get('dns_ttl', 300), config.get('dns_stale_max', 86400))
+        lookups = self.dns.lookups()
+        
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{base}{path}", timeout=self.timeout(timeout), **kwargs)
+        except Exception:
+            self.endpoints.record(base, time.perf_counter() - started, False)
+            raise
+        self.endpoints.record(base, time.perf_counter() - started, response.status_code < 500)
+        response.endpoint = base
+        
+        # A scoped DNS lookup means urllib3 had to open a new connection
+        cold = self.dns.lookups() != lookups
+        self.connection_stats['opened' if cold else 'reused'] += 1
+        return response, cold
+    
+    def failover(self, ranked: List[str], method: str, path: str, timeout: Optional[float],
+                 kwargs: Dict[str, Any]) -> tuple:
+        """Send to the best endpoint, moving on only while the request never left the Pi"""
+        for index, base in enumerate(ranked):
+            try:
+                return self.send(base, method, path, timeout, kwargs)
+            except Exception as e:
+                if index == len(ranked) - 1 or not request_never_sent(e):
+                    raise
+                self.logger.warning(f"⚠️  {base} unreachable - trying {ranked[index + 1]}")
+    
+    def hedged(self, ranked: List[str], method: str, path: str, timeout: Optional[float],
+               kwargs: Dict[str, Any]) -> tuple:
+        """Send to the best endpoint and, past its p95, a duplicate to the next; first good answer wins"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='api-hedge')
+        self.endpoints.hedge_eligible()
+        
+        primary = self.executor.submit(self.send, ranked[0], method, path, timeout, kwargs)
+        done, _ = wait([primary], timeout=self.endpoints.hedge_delay(ranked[0]))
+        if done or not self.endpoints.take_hedge():
+            try:
+                return primary.result()
+            except Exception as e:
+                if not request_never_sent(e):
+                    raise
+                self.logger.warning(f"⚠️  {ranked[0]} unreachable - trying {ranked[1]}")
+                return self.failover(ranked[1:], method, path, timeout, kwargs)
+        
+        hedge = self.executor.submit(self.send, ranked[1], method, path, timeout, kwargs)
+        pending = {primary, hedge}
+        fallback, error = None, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if result[0].status_code >= 500 and pending:
+                    fallback = result
+                    continue
+                if future is hedge:
+                    self.endpoints.hedge_won()
+                # The slower copy finishes in the background and still feeds its endpoint's stats
+                return result
+        if fallback:
+            return fallback
+        raise error
+    
+    def decode_binary(self, response: requests.Response) -> bool:
+        """Decode a binary response body so response.json() works as usual"""
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+        codec = WireCodec.for_content_type(content_type)
+        if codec is None:
+            return False
+        
+        decoded = codec.decode(response.content)
+        response.json = lambda **kwargs: decoded
+        self.wire_stats['binaryResponses'] += 1
+        if not self.binary_accepted:
+            self.logger.info(f"📦 Server speaks {codec.name} - switching request bodies to {codec.name}")
+            self.binary_accepted = True
+        return True
+    
+    def get_connection_status(self) -> Dict[str, Any]:
+        status = dict(self.connection_stats, dns=self.dns.get_status(), **self.endpoints.get_status())
+        for kind, samples in self.first_request_ms.items():
+            samples = list(samples)
+            status[f'firstRequest{kind.title()}'] = {
+                'count': len(samples),
+                'p50Ms': percentile(samples, 50),
+                'p95Ms': percentile(samples, 95)
+            }
+        return status
+    
+    def get_wire_status(self) -> Dict[str, Any]:
+        return dict(self.wire_stats, format=self.get_config().get('wire_format', 'json'),
+                    binaryActive=self.binary_accepted)
+
+
+class ConnectionWarmer:
+    """
+    Keeps the keep-alive connection to the API warm
+    
+    While the machine is idle a cheap probe is sent every keepalive_interval
+    seconds, below the server's 65s keep-alive timeout, so the first tap
+    after a quiet spell does not pay for DNS, TCP and TLS. When a card is
+    detected after a longer silence, the probe is started immediately, so
+    the handshake overlaps the beep and hand-off to a tap worker.
+    """
+    
+    def __init__(self, api: ApiClient, probe: Callable[[], Any], get_config: Callable[[], Dict[str, Any]]):
+        self.api = api
+        self.probe = probe
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.probing = False
+        self.last_probe = 0.0
+        self.thread = None
+        self.stats = {'probes': 0, 'prewarms': 0}
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.keepalive_loop, name='keepalive', daemon=True)
+        self.thread.start()
+    
+    def keepalive_loop(self):
+        while True:
+            time.sleep(1)
+            interval = self.get_config().get('keepalive_interval', 45)
+            # Failed probes do not reset the idle time, so also space out the attempts
+            if interval and min(self.api.idle_seconds(), time.monotonic() - self.last_probe) >= interval:
+                self.run_probe('probes')
+    
+    def run_probe(self, counter: str):
+        with self.lock:
+            if self.probing:
+                return
+            self.probing = True
+        try:
+            self.last_probe = time.monotonic()
+            self.stats[counter] += 1
+            self.probe()
+        finally:
+            self.probing = False
+    
+    def on_card_detected(self):
+        """Start warming the connection if it has been idle long enough to be cold"""
+        if self.api.idle_seconds() >= self.get_config().get('prewarm_idle', 20) and not self.probing:
+            threading.Thread(target=self.run_probe, args=('prewarms',), name='prewarm', daemon=True).start()
+    
+    def get_status(self) -> Dict[str, Any]:
+        return dict(self.stats, idleSec=round(self.api.idle_seconds(), 1))
+
+
+class PushChannel:
+    """
+    Server-to-machine command channel over HTTP long-poll
+    
+    GET /api/machine/commands?machineId=...&cursor=...&wait=... is held open
+    by the server until commands are queued or `wait` seconds pass. The
+    response is {"commands": [{"id", "type", "payload", "issuedAt"}],
+    "cursor", "serverTime"}; sending the returned cursor on the next poll
+    acknowledges delivery. Each command is dispatched to the handler
+    registered for its type.
+    """
+    
+    def __init__(self, api: ApiClient, get_config: Callable[[], Dict[str, Any]],
+                 handlers: Dict[str, Callable[[Dict[str, Any]], Any]]):
+        self.api = api
+        self.get_config = get_config
+        self.handlers = handlers
+        self.logger = logging.getLogger(__name__)
+        self.cursor = None
+        self.connected = False
+        self.active = False
+        self.thread = None
+        self.failures = 0
+        self.reconnects = 0
+        self.commands_received = 0
+        self.latencies = deque(maxlen=100)
+    
+    def start(self):
+        """Start the long-poll loop in a background thread"""
+        self.active = True
+        self.thread = threading.Thread(target=self.poll_loop, name='push', daemon=True)
+        self.thread.start()
+        self.logger.info("📡 Push channel started")
+    
+    def stop(self):
+        self.active = False
+        self.connected = False
+    
+    def poll_loop(self):
+        while self.active:
+            config = self.get_config()
+            wait = config.get('push_wait', 25)
+            
+            try:
+                response = self.api.get(
+                    "/api/machine/commands",
+                    params={'machineId': config['machine_id'], 'cursor': self.cursor, 'wait': wait},
+                    timeout=wait + config.get('api_timeout', 5)
+                )
+                
+                if response.status_code == 204:
+                    self.on_connected()
+                    continue
+                
+                if response.status_code != 200:
+                    raise RuntimeError(f"HTTP {response.status_code}")
+                
+                self.on_connected()
+                data = response.json()
+                received_at = time.time()
+                
+                for command in data.get('commands', []):
+                    self.dispatch(command, data.get('serverTime'), received_at)
+                
+                if data.get('cursor') is not None:
+                    self.cursor = data['cursor']
+            
+            except Exception as e:
+                self.on_error(e)
+    
+    def on_connected(self):
+        if not self.connected:
+            if self.failures:
+                self.reconnects += 1
+            self.logger.info("📡 Push channel connected")
+        self.connected = True
+        self.failures = 0
+    
+    def on_error(self, error: Exception):
+        """Back off exponentially (with jitter) before reconnecting"""
+        if self.connected or self.failures == 0:
+            self.logger.warning(f"⚠️  Push channel disconnected: {error}")
+        else:
+            self.logger.debug(f"Push channel retry failed: {error}")
+        
+        self.connected = False
+        self.failures += 1
+        max_backoff = self.get_config().get('push_max_backoff', 300)
+        delay = min(max_backoff, 2 ** min(self.failures, 10))
+        time.sleep(delay * random.uniform(0.5, 1.0))
+    
+    def dispatch(self, command: Dict[str, Any], server_time: Optional[str], received_at: float):
+        """Run the handler for one command and record its delivery latency"""
+        command_type = command.get('type')
+        self.commands_received += 1
+        
+        latency = self.delivery_latency(command.get('issuedAt'), server_time, received_at)
+        if latency is not None:
+            self.latencies.append(latency)
+        
+        handler = self.handlers.get(command_type)
+        if not handler:
+            self.logger.warning(f"⚠️  Unknown push command: {command_type}")
+            return
+        
+        latency_text = f" ({latency:.2f}s after issue)" if latency is not None else ""
+        self.logger.info(f"📨 Push command {command_type}{latency_text}")
+        
+        try:
+            handler(command.get('payload') or {})
+        except Exception as e:
+            self.logger.error(f"❌ Push command {command_type} failed: {e}")
+    
+    @staticmethod
+    def delivery_latency(issued_at, server_time, received_at: float) -> Optional[float]:
+        """Seconds between the server queuing a command and it reaching us"""
+        try:
+            issued = float(issued_at) / 1000.0
+        except (TypeError, ValueError):
+            return None
+        
+        # Prefer the server clock to avoid skew with the Pi's clock
+        if server_time:
+            try:
+                sent = datetime.fromisoformat(str(server_time).replace('Z', '+00:00')).timestamp()
+                return max(0.0, sent - issued)
+            except ValueError:
+                pass
+        return max(0.0, received_at - issued)
+    
+    def get_status(self) -> Dict[str, Any]:
+        """Channel state and delivery latency for diagnostics"""
+        latencies = list(self.latencies)
+        return {
+            'connected': self.connected,
+            'reconnects': self.reconnects,
+            'commandsReceived': self.commands_received,
+            'latencyAvg': round(sum(latencies) / len(latencies), 3) if latencies else None,
+            'latencyP95': percentile(latencies, 95),
+            'latencyMax': percentile(latencies, 100)
+        }
+
+
+class EventUploader:
+    """
+    Structured tap events uploaded in gzip batches
+    
+    Every tap (including failures and rejected taps) becomes one event.
+    Events are buffered and POSTed to /api/machine/events/bulk when the
+    batch is full or the oldest event reaches events_max_age. Batches that
+    cannot be delivered are spooled to disk and retried oldest-first, so
+    nothing is lost while the machine is offline. Each batch carries a
+    batchId so the server can drop duplicates after a retry.
+    
+    A batch only counts as delivered when the server acknowledges it in a
+    JSON body (see acknowledged()). A server without the bulk endpoint
+    (404/405, or a 200 page from the SPA catch-all) gets the events one by
+    one on EVENT_PATH, each with an eventId, until the bulk endpoint is
+    checked again after events_bulk_recheck seconds. Batches stay spooled
+    until one of the two acknowledges them.
+    """
+    
+    PATH = "/api/machine/events/bulk"
+    EVENT_PATH = "/api/machine/events"
+    
+    def __init__(self, api: ApiClient, get_config: Callable[[], Dict[str, Any]]):
+        self.api = api
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Condition()
+        self.buffer = []
+        self.oldest = None
+        self.running = False
+        self.thread = None
+        self.retry_at = 0.0
+        self.backoff = 0
+        self.bulk_unavailable_until = 0.0
+        self.stats = {
+            'eventsUploaded': 0,
+            'batchesUploaded': 0,
+            'eventsPostedSingly': 0,
+            'bulkUnavailable': 0,
+            'batchesSpooled': 0,
+            'eventsDropped': 0,
+            'bytesUploaded': 0,
+            'rawBytes': 0,
+            'compressedBytes': 0,
+            'lastUpload': None
+        }
+    
+    def add(self, event: Dict[str, Any]):
+        if not self.get_config().get('events_enabled', True):
+            return
+        with self.lock:
+            self.buffer.append(event)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            if len(self.buffer) >= self.get_config().get('events_batch_size', 50):
+                self.lock.notify()
+    
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.upload_loop, name='event-upload', daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Spool whatever is still buffered so it is sent after the restart"""
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+            batch = self.take_batch()
+        if batch:
+            self.spool(*batch)
+    
+    def take_batch(self) -> Optional[tuple]:
+        """(gzipped batch, event count) of buffered events (caller holds the lock)"""
+        if not self.buffer:
+            return None
+        events, self.buffer, self.oldest = self.buffer, [], None
+        raw = json.dumps({
+            'machineId': self.get_config().get('machine_id'),
+            'batchId': str(uuid.uuid4()),
+            'events': events
+        }, separators=(',', ':')).encode('utf-8')
+        data = gzip.compress(raw)
+        self.stats['rawBytes'] += len(raw)
+        self.stats['compressedBytes'] += len(data)
+        return data, len(events)
+    
+    def upload_loop(self):
+        while True:
+            with self.lock:
+                if not self.running:
+                    return
+                config = self.get_config()
+                due = self.oldest is not None and (
+                    len(self.buffer) >= config.get('events_batch_size', 50)
+                    or time.monotonic() - self.oldest >= config.get('events_max_age', 60)
+                )
+                if not due:
+                    self.lock.wait(timeout=1)
+                    batch = None
+                else:
+                    batch = self.take_batch()
+            
+            if batch is not None:
+                if time.monotonic() < self.retry_at or not self.send(*batch):
+                    self.spool(*batch)
+            
+            if time.monotonic() >= self.retry_at:
+                self.drain_spool()
+    
+    def send(self, batch: bytes, count: int) -> bool:
+        """POST one batch. False means keep it for a retry."""
+        if time.monotonic() < self.bulk_unavailable_until:
+            return self.send_singly(batch, count)
+        
+        try:
+            response = self.api.request('POST', self.PATH, data=batch, headers={
+                'Content-Type': 'application/json',
+                'Content-Encoding': 'gzip'
+            })
+        except Exception as e:
+            self.logger.debug(f"Event upload error: {e}")
+            self.schedule_retry()
+            return False
+        
+        if acknowledged(response):
+            self.backoff = 0
+            self.stats['batchesUploaded'] += 1
+            self.stats['eventsUploaded'] += count
+            self.stats['bytesUploaded'] += len(batch)
+            self.stats['lastUpload'] = datetime.now().isoformat(timespec='seconds')
+            return True
+        
+        if response.status_code in (408, 429) or response.status_code >= 500:
+            self.logger.warning(f"⚠️  Event upload failed: {response.status_code} - will retry")
+            self.schedule_retry()
+            return False
+        
+        # A 2xx without an acknowledgement is a page from the SPA catch-all, not the API
+        if response.status_code in (404, 405) or response.status_code < 300:
+            self.logger.warning(f"⚠️  {self.PATH} unavailable ({response.status_code}) - posting events one by one")
+            self.stats['bulkUnavailable'] += 1
+            self.bulk_unavailable_until = time.monotonic() + self.get_config().get('events_bulk_recheck', 600)
+            return self.send_singly(batch, count)
+        
+        if self.is_json(response):
+            # The API rejected the batch itself; it will never be accepted, so do not retry it forever
+            self.logger.error(f"❌ Event batch rejected: {response.status_code} - dropped {count} events")
+            self.stats['eventsDropped'] += count
+            return True
+        
+        self.logger.warning(f"⚠️  Event upload not acknowledged: {response.status_code} - keeping the batch spooled")
+        self.schedule_retry()
+        return False
+    
+    @staticmethod
+    def is_json(response: requests.Response) -> bool:
+        return response.headers.get('Content-Type', '').split(';')[0].strip() == 'application/json'
+    
+    def send_singly(self, batch: bytes, count: int) -> bool:
+        """POST the events of a batch one at a time. False keeps the whole batch for a retry."""
+        body = json.loads(gzip.decompress(batch))
+        for index, event in enumerate(body['events']):
+            try:
+                response = self.api.post(self.EVENT_PATH, {
+                    'machineId': body['machineId'],
+                    'eventId': f"{body['batchId']}:{index}",  # Lets the server drop repeats after a retry
+                    'event': event
+                })
+            except Exception as e:
+                self.logger.debug(f"Event post error: {e}")
+                self.schedule_retry()
+                return False
+            if not acknowledged(response):
+                self.logger.warning(f"⚠️  Event post not acknowledged: {response.status_code} - keeping the batch spooled")
+                self.schedule_retry()
+                return False
+        
+        self.backoff = 0
+        self.stats['eventsUploaded'] += count
+        self.stats['eventsPostedSingly'] += count
+        self.stats['lastUpload'] = datetime.now().isoformat(timespec='seconds')
+        return True
+    
+    def schedule_retry(self):
+        self.backoff = min(max(self.backoff * 2, 5), self.get_config().get('events_max_age', 60) * 5)
+        self.retry_at = time.monotonic() + self.backoff
+    
+    def spool_dir(self) -> str:
+        directory = self.get_config().get('events_spool_dir', 'event_spool')
+        os.makedirs(directory, exist_ok=True)
+        return directory
+    
+    def spooled_files(self) -> List[str]:
+        directory = self.spool_dir()
+        return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.json.gz'))
+    
+    @staticmethod
+    def spooled_count(path: str) -> int:
+        # Spool files are named <time>-<event count>.json.gz
+        try:
+            return int(os.path.basename(path).split('.json')[0].rsplit('-', 1)[1])
+        except (IndexError, ValueError):
+            return 0
+    
+    def spool(self, batch: bytes, count: int):
+        try:
+            directory = self.spool_dir()
+            path = os.path.join(directory, f"{time.time():.6f}-{count}.json.gz")
+            with open(path + '.tmp', 'wb') as f:
+                f.write(batch)
+            os.replace(path + '.tmp', path)
+            self.stats['batchesSpooled'] += 1
+            self.trim_spool()
+        except OSError as e:
+            self.logger.error(f"❌ Could not spool event batch: {e}")
+    
+    def trim_spool(self):
+        """Drop the oldest batches above events_spool_max_bytes"""
+        files = self.spooled_files()
+        sizes = {path: os.path.getsize(path) for path in files}
+        total = sum(sizes.values())
+        limit = self.get_config().get('events_spool_max_bytes', 20_000_000)
+        for path in files:
+            if total <= limit:
+                break
+            os.remove(path)
+            total -= sizes[path]
+            self.stats['eventsDropped'] += self.spooled_count(path)
+            self.logger.warning(f"🗑️  Event spool full - dropped {os.path.basename(path)}")
+    
+    def drain_spool(self):
+        """Send spooled batches oldest-first until one fails"""
+        try:
+            files = self.spooled_files()
+        except OSError:
+            return
+        for path in files[:10]:
+            try:
+                with open(path, 'rb') as f:
+                    batch = f.read()
+            except OSError:
+                continue
+            if not self.send(batch, self.spooled_count(path)):
+                return
+            os.remove(path)
+    
+    def get_status(self) -> Dict[str, Any]:
+        try:
+            files = self.spooled_files()
+            spooled_bytes = sum(os.path.getsize(path) for path in files)
+        except OSError:
+            files, spooled_bytes = [], 0
+        with self.lock:
+            buffered = len(self.buffer)
+        ratio = self.stats['rawBytes'] / self.stats['compressedBytes'] if self.stats['compressedBytes'] else None
+        return dict(self.stats, buffered=buffered, spooledBatches=len(files), spooledBytes=spooled_bytes,
+                    compressionRatio=round(ratio, 1) if ratio else None)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+UrbanKetl Authentication Benchmark
+Measures on-device DESFire mutual authentication (auth_mode "local") on this
+hardware against an in-process simulated card: AES cost per tap for EV1
+(AuthenticateAES) and EV2/EV3 (AuthenticateEV2First), with and without the
+cached key schedule, and raw AES-128 throughput. Optionally times the server's
+challenge + validate round trip that local authentication removes.
+
+Usage:
+    python3 urbanketl_auth_benchmark.py                 # run on the Pi itself
+    python3 urbanketl_auth_benchmark.py --cards 500 --iterations 20000 --json
+    python3 urbanketl_auth_benchmark.py --api https://ukteawallet.com --uid 04A1B2C3D4E5F6
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Dict, Any, List
+
+from urbanketl_machine_unified import ApiClient, CardKeyStore, CRYPTO_AVAILABLE, percentile
+
+if CRYPTO_AVAILABLE:
+    from Crypto.Cipher import AES
+
+
+def make_store(cards: int) -> CardKeyStore:
+    """Key store with random provisioned cards (nothing written to disk)"""
+    config = {'machine_id': 'BENCH', 'local_auth_cache_size': cards,
+              'card_key_store_file': os.path.join(tempfile.gettempdir(), f"urbanketl-bench-{os.getpid()}.bin")}
+    store = CardKeyStore(None, lambda: config)
+    for index in range(cards):
+        uid = f"04{index:012X}"
+        store.cards[uid] = {'uid': uid, 'cardNumber': f"UK-CARD-{index:06d}", 'businessUnitId': 'bench',
+                            'key': os.urandom(16).hex(), 'keyVersion': 1, 'active': True}
+    store.fetched_at = time.time()
+    return store
+
+
+class SimulatedCard:
+    """Card side of the DESFire AES authentication, answering APDUs like the reader would"""
+
+    def __init__(self, key: bytes, ev2: bool):
+        self.cipher = AES.new(key, AES.MODE_ECB)
+        self.ev2 = ev2
+        self.rnd_b = self.ek_rnd_b = None
+        self.spent_us = 0.0
+
+    def exchange(self, apdu: list) -> bytes:
+        started = time.perf_counter()
+        try:
+            return self.answer(apdu)
+        finally:
+            self.spent_us += (time.perf_counter() - started) * 1_000_000
+
+    def answer(self, apdu: list) -> bytes:
+        zero = bytes(16)
+        if apdu[1] in (CardKeyStore.AUTH_EV2_FIRST, CardKeyStore.AUTH_AES):
+            self.rnd_b = os.urandom(16)
+            self.ek_rnd_b = CardKeyStore.cbc(self.cipher, zero, self.rnd_b)
+            return self.ek_rnd_b + b'\x91\xAF'
+        token = bytes(apdu[5:37])
+        plain = CardKeyStore.cbc(self.cipher, zero if self.ev2 else self.ek_rnd_b, token, decrypt=True)
+        if plain[16:] != self.rnd_b[1:] + self.rnd_b[:1]:
+            return b'\x91\xAE'
+        rnd_a_rotated = plain[1:16] + plain[:1]
+        if self.ev2:
+            return CardKeyStore.cbc(self.cipher, zero, os.urandom(4) + rnd_a_rotated + bytes(12)) + b'\x91\x00'
+        return CardKeyStore.cbc(self.cipher, token[-16:], rnd_a_rotated) + b'\x91\x00'
+
+
+def authenticate_per_tap(store: CardKeyStore, iterations: int, cached: bool, ev2: bool) -> Dict[str, Any]:
+    """Microseconds of Pi-side work per authentication, cycling through all cards"""
+    cards = [(card, SimulatedCard(bytes.fromhex(card['key']), ev2)) for card in store.cards.values()]
+
+    if cached:
+        for card, simulated in cards:
+            store.authenticate(card, simulated.exchange, ev2)
+
+    samples = []
+    for index in range(iterations):
+        card, simulated = cards[index % len(cards)]
+        if not cached:
+            store.ciphers.clear()
+        simulated.spent_us = 0.0
+        started = time.perf_counter()
+        if not store.authenticate(card, simulated.exchange, ev2):
+            raise RuntimeError("authentication failed")
+        samples.append((time.perf_counter() - started) * 1_000_000 - simulated.spent_us)
+    return {
+        'p50Us': percentile(samples, 50),
+        'p99Us': percentile(samples, 99),
+        'authenticationsPerSec': round(len(samples) / (sum(samples) / 1_000_000))
+    }
+
+
+def aes_throughput(megabytes: int) -> Dict[str, Any]:
+    """Raw AES-128 ECB throughput over a buffer"""
+    data = os.urandom(megabytes * 1024 * 1024)
+    cipher = AES.new(os.urandom(16), AES.MODE_ECB)
+    started = time.perf_counter()
+    cipher.encrypt(data)
+    elapsed = time.perf_counter() - started
+
+    keys = [os.urandom(16) for _ in range(2000)]
+    started = time.perf_counter()
+    for key in keys:
+        AES.new(key, AES.MODE_ECB)
+    schedule_us = (time.perf_counter() - started) / len(keys) * 1_000_000
+    return {'mbPerSec': round(megabytes / elapsed, 1), 'keyScheduleUs': round(schedule_us, 2)}
+
+
+def server_round_trip(base_url: str, uid: str, iterations: int) -> Dict[str, Any]:
+    """Challenge + validate against the server, i.e. what auth_mode local saves per tap"""
+    api = ApiClient(lambda: {'api_base_url': base_url, 'api_timeout': 10})
+    samples: List[float] = []
+    failures = 0
+    for _ in range(iterations):
+        started = time.perf_counter()
+        try:
+            challenge = api.post("/api/machine/auth/challenge", {'machineId': 'BENCH', 'cardUid': uid}).json()
+            api.post("/api/machine/auth/validate", {'challengeId': challenge.get('challengeId'),
+                                                    'response': '00' * 16, 'cardUid': uid})
+            samples.append((time.perf_counter() - started) * 1000)
+        except Exception:
+            failures += 1
+    return {'p50Ms': percentile(samples, 50), 'p95Ms': percentile(samples, 95), 'failures': failures}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark UrbanKetl on-device card authentication")
+    parser.add_argument('--cards', type=int, default=200, help="Provisioned cards to cycle through")
+    parser.add_argument('--iterations', type=int, default=10000, help="Authentications per measurement")
+    parser.add_argument('--megabytes', type=int, default=8, help="Buffer size for AES throughput")
+    parser.add_argument('--api', help="Also time challenge + validate against this server")
+    parser.add_argument('--uid', default='04A1B2C3D4E5F6', help="Card UID for --api")
+    parser.add_argument('--round-trips', type=int, default=20, help="Server round trips for --api")
+    parser.add_argument('--json', action='store_true', help="Print the full report as JSON")
+    args = parser.parse_args()
+
+    if not CRYPTO_AVAILABLE:
+        parser.error("pycryptodome is not installed")
+
+    store = make_store(args.cards)
+    report = {
+        'aes': aes_throughput(args.megabytes),
+        'ev1Cold': authenticate_per_tap(store, args.iterations, cached=False, ev2=False),
+        'ev1Cached': authenticate_per_tap(store, args.iterations, cached=True, ev2=False),
+        'ev2Cold': authenticate_per_tap(store, args.iterations, cached=False, ev2=True),
+        'ev2Cached': authenticate_per_tap(store, args.iterations, cached=True, ev2=True),
+        'serverRoundTrip': server_round_trip(args.api, args.uid, args.round_trips) if args.api else None
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"🔑 On-device authentication - {args.cards} cards, {args.iterations} authentications")
+    print(f"   AES-128 throughput   {report['aes']['mbPerSec']:>10} MB/s")
+    print(f"   Key schedule         {report['aes']['keyScheduleUs']:>10} µs")
+    for name, label in (('ev1Cold', 'EV1 (new schedule)'), ('ev1Cached', 'EV1 (cached)'),
+                        ('ev2Cold', 'EV2 (new schedule)'), ('ev2Cached', 'EV2 (cached)')):
+        result = report[name]
+        print(f"   {label:<21}{result['p50Us']:>10} µs p50  {result['p99Us']} µs p99  "
+              f"{result['authenticationsPerSec']}/s")
+    if report['serverRoundTrip']:
+        trip = report['serverRoundTrip']
+        print(f"   Server round trip    {trip['p50Ms']:>10} ms p50  {trip['p95Ms']} ms p95  "
+              f"({trip['failures']} failed)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,555 @@
+"""
+UrbanKetl Tea Machine Controller - Machine Catalog
+Server data the tap path reads from memory: tea price, beverage profiles
+and the card key store for on-device authentication
+"""
+
+import time
+import json
+import logging
+import threading
+import hmac
+import os
+from collections import OrderedDict, deque
+from typing import Optional, Dict, Any, Callable
+
+# GPIO for the beverage selection buttons (Raspberry Pi only)
+try:
+    import RPi.GPIO as GPIO
+    GPIO_AVAILABLE = True
+except ImportError:
+    GPIO_AVAILABLE = False
+
+# Cryptography for DESFire
+try:
+    from Crypto.Cipher import AES
+    CRYPTO_AVAILABLE = True
+except ImportError:
+    CRYPTO_AVAILABLE = False
+
+from urbanketl_api import ApiClient
+from urbanketl_common import percentile
+
+
+class TeaPriceCache:
+    """
+    Per-machine tea price from GET /api/machines/:machineId/tea-price
+    
+    The price is fetched at startup and refreshed in the background every
+    price_ttl seconds using conditional requests (ETag / Last-Modified), so
+    get_price() on the tap path never waits on the network. If the server
+    cannot be reached the last known price keeps being used; before the
+    first successful fetch the local tea_price is used.
+    """
+    
+    def __init__(self, api: ApiClient, get_config: Callable[[], Dict[str, Any]]):
+        self.api = api
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.price = None
+        self.machine_id = None
+        self.etag = None
+        self.last_modified = None
+        self.fetched_at = None
+        self.last_error = None
+        self.refresh_event = threading.Event()
+        self.thread = None
+    
+    def get_price(self) -> float:
+        """Price to charge for the next cup (no network access)"""
+        config = self.get_config()
+        if self.price is None or self.machine_id != config['machine_id']:
+            return config.get('tea_price', 5.0)
+        return self.price
+    
+    def refresh(self) -> bool:
+        """Fetch the price from the server. Returns True if the cache is current."""
+        machine_id = self.get_config()['machine_id']
+        headers = {}
+        if machine_id == self.machine_id:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+        
+        try:
+            response = self.api.get(f"/api/machines/{machine_id}/tea-price", headers=headers)
+            
+            if response.status_code == 304:
+                self.fetched_at = time.monotonic()
+                self.last_error = None
+                return True
+            
+            if response.status_code != 200:
+                self.last_error = f"HTTP {response.status_code}"
+                self.logger.warning(f"⚠️  Tea price refresh failed: {response.status_code}")
+                return False
+            
+            price = float(response.json()['price'])
+            if price <= 0:
+                raise ValueError(f"invalid price {price}")
+            
+            if price != self.price:
+                self.logger.info(f"💲 Tea price for {machine_id}: ₹{price}")
+            
+            self.price = price
+            self.machine_id = machine_id
+            self.etag = response.headers.get('ETag')
+            self.last_modified = response.headers.get('Last-Modified')
+            self.fetched_at = time.monotonic()
+            self.last_error = None
+            return True
+        
+        except Exception as e:
+            self.last_error = str(e)
+            self.logger.warning(f"⚠️  Tea price refresh error: {e}")
+            return False
+    
+    def refresh_now(self):
+        """Wake the refresh thread early (e.g. server announced a price change)"""
+        self.refresh_event.set()
+    
+    def start(self):
+        """Start background refresh"""
+        def refresh_loop():
+            failures = 0
+            while True:
+                ttl = self.get_config().get('price_ttl', 120)
+                # Retry sooner after a failure, backing off up to the TTL
+                delay = ttl if failures == 0 else min(ttl, 5 * 2 ** min(failures, 6))
+                self.refresh_event.wait(delay)
+                self.refresh_event.clear()
+                failures = 0 if self.refresh() else failures + 1
+        
+        self.thread = threading.Thread(target=refresh_loop, name='price-refresh', daemon=True)
+        self.thread.start()
+    
+    def get_status(self) -> Dict[str, Any]:
+        """Cache state for diagnostics"""
+        return {
+            'price': self.get_price(),
+            'source': 'server' if self.price is not None else 'config',
+            'ageSeconds': round(time.monotonic() - self.fetched_at, 1) if self.fetched_at else None,
+            'lastError': self.last_error
+        }
+
+
+class BeverageProfiles:
+    """
+    Per-machine beverage profiles (price, pour and valve sequence)
+    
+    GET /api/machines/:machineId/beverages returns {"version", "profiles":
+    [{"id", "name", "price", "dispenseTime" | "volumeMl" | "sequence"}]}.
+    The set is refreshed in the background with If-None-Match and written
+    to beverage_cache_file, so a restart without network still has the last
+    version. Until the server has answered, beverage_profiles from the config
+    is used. Taps only ever read the in-memory set.
+    
+    GPIO buttons (beverage_buttons: {profile id: BCM pin}) select the
+    profile for the next tap through edge interrupts; the selection lapses
+    after beverage_select_timeout seconds.
+    """
+    
+    def __init__(self, api: ApiClient, get_config: Callable[[], Dict[str, Any]]):
+        self.api = api
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.profiles = {}
+        self.version = None
+        self.etag = None
+        self.source = 'config'
+        self.fetched_at = None
+        self.last_error = None
+        self.selected = None  # (profile id, monotonic time)
+        self.refresh_event = threading.Event()
+        self.load_cache()
+    
+    @staticmethod
+    def validate(profiles: Any) -> Dict[str, Dict[str, Any]]:
+        """Profiles keyed by id. Raises ValueError if any profile is malformed."""
+        if not isinstance(profiles, list):
+            raise ValueError("profiles must be a list")
+        checked = {}
+        for profile in profiles:
+            if not isinstance(profile, dict) or not isinstance(profile.get('id'), str) or not profile.get('name'):
+                raise ValueError(f"profile needs an id and a name: {profile}")
+            if profile.get('price') is not None and not 0 < float(profile['price']) <= 10000:
+                raise ValueError(f"{profile['id']}: invalid price")
+            if 'dispenseTime' in profile and not 0.1 <= float(profile['dispenseTime']) <= 60:
+                raise ValueError(f"{profile['id']}: dispenseTime must be 0.1-60s")
+            if 'volumeMl' in profile and not 10 <= float(profile['volumeMl']) <= 2000:
+                raise ValueError(f"{profile['id']}: volumeMl must be 10-2000")
+            for step in profile.get('sequence', []):
+                if not isinstance(step.get('valve'), str) or not 0 < float(step.get('seconds', 0)) <= 60:
+                    raise ValueError(f"{profile['id']}: sequence steps need a valve and 0-60 seconds")
+            checked[profile['id']] = profile
+        return checked
+    
+    def cache_file(self) -> str:
+        return self.get_config().get('beverage_cache_file', 'beverage_profiles.json')
+    
+    def load_cache(self):
+        """Start from the last server version, or from the config"""
+        try:
+            with open(self.cache_file(), 'r') as f:
+                cached = json.load(f)
+            if cached.get('machineId') == self.get_config()['machine_id']:
+                self.profiles = self.validate(cached['profiles'])
+                self.version, self.etag, self.source = cached.get('version'), cached.get('etag'), 'cache'
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+        
+        try:
+            self.profiles = self.validate(self.get_config().get('beverage_profiles', []))
+        except ValueError as e:
+            self.logger.error(f"❌ Invalid beverage_profiles in config: {e}")
+    
+    def save_cache(self, machine_id: str):
+        path = self.cache_file()
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'machineId': machine_id, 'version': self.version, 'etag': self.etag,
+                           'profiles': list(self.profiles.values())}, f, indent=2)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            self.logger.warning(f"⚠️  Could not cache beverage profiles: {e}")
+    
+    def refresh(self) -> bool:
+        """Fetch the profile set. Returns True if the in-memory set is current."""
+        machine_id = self.get_config()['machine_id']
+        headers = {'If-None-Match': self.etag} if self.etag and self.source != 'config' else {}
+        try:
+            response = self.api.get(f"/api/machines/{machine_id}/beverages", headers=headers)
+            
+            if response.status_code == 304:
+                self.fetched_at = time.monotonic()
+                self.last_error = None
+                return True
+            
+            if response.status_code != 200:
+                # 404: server without profile support - keep the config profiles
+                self.last_error = f"HTTP {response.status_code}"
+                return False
+            
+            body = response.json()
+            profiles = self.validate(body.get('profiles'))
+            with self.lock:
+                changed = body.get('version') != self.version or self.source == 'config'
+                self.profiles = profiles
+                self.version = body.get('version')
+                self.etag = response.headers.get('ETag')
+                self.source = 'server'
+            self.fetched_at = time.monotonic()
+            self.last_error = None
+            if changed:
+                self.logger.info(f"🍵 Beverage profiles v{self.version}: {', '.join(p['name'] for p in profiles.values())}")
+                self.save_cache(machine_id)
+            return True
+        
+        except Exception as e:
+            self.last_error = str(e)
+            self.logger.warning(f"⚠️  Beverage profile refresh error: {e}")
+            return False
+    
+    def refresh_now(self):
+        self.refresh_event.set()
+    
+    def start(self):
+        """Start background refresh"""
+        def refresh_loop():
+            while True:
+                self.refresh_event.wait(self.get_config().get('beverage_ttl', 300))
+                self.refresh_event.clear()
+                self.refresh()
+        
+        threading.Thread(target=refresh_loop, name='beverage-refresh', daemon=True).start()
+    
+    def setup_buttons(self):
+        """Edge interrupts for the selection buttons (no polling)"""
+        buttons = self.get_config().get('beverage_buttons', {})
+        if not buttons or not GPIO_AVAILABLE:
+            return
+        try:
+            if GPIO.getmode() is None:
+                GPIO.setmode(GPIO.BCM)
+            for profile_id, pin in buttons.items():
+                GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+                GPIO.add_event_detect(pin, GPIO.FALLING, bouncetime=200,
+                                      callback=lambda channel, profile_id=profile_id: self.select(profile_id))
+            self.logger.info(f"🔘 Beverage buttons: {', '.join(f'{k}=GPIO{v}' for k, v in buttons.items())}")
+        except Exception as e:
+            self.logger.error(f"❌ Failed to set up beverage buttons: {e}")
+    
+    def select(self, profile_id: str) -> bool:
+        """Choose the profile for the next tap"""
+        if profile_id not in self.profiles:
+            self.logger.warning(f"⚠️  Unknown beverage {profile_id}")
+            return False
+        self.selected = (profile_id, time.monotonic())
+        self.logger.info(f"🔘 Selected {self.profiles[profile_id]['name']}")
+        return True
+    
+    def take(self) -> Optional[Dict[str, Any]]:
+        """Profile for the tap starting now (in memory only). Clears the selection."""
+        selected, self.selected = self.selected, None
+        profiles = self.profiles
+        if selected and time.monotonic() - selected[1] <= self.get_config().get('beverage_select_timeout', 30):
+            profile = profiles.get(selected[0])
+            if profile:
+                return profile
+        default = self.get_config().get('beverage_default')
+        if default in profiles:
+            return profiles[default]
+        return next(iter(profiles.values()), None)
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            'version': self.version,
+            'source': self.source,
+            'profiles': [{'id': p['id'], 'name': p['name'], 'price': p.get('price')} for p in self.profiles.values()],
+            'selected': self.selected[0] if self.selected else None,
+            'ageSeconds': round(time.monotonic() - self.fetched_at, 1) if self.fetched_at else None,
+            'lastError': self.last_error
+        }
+
+
+class CardKeyStore:
+    """
+    Local store of diversified card keys for on-device authentication
+    
+    GET /api/machines/:machineId/card-keys returns {"version", "cards":
+    [{"uid", "cardNumber", "businessUnitId", "key", "keyVersion", "active"}]}
+    with an ETag. The server provisions and rotates the keys; the machine
+    refreshes every local_auth_refresh seconds (or on the refresh_card_keys
+    push command). The store is kept on disk AES-GCM encrypted under a
+    random device secret (card_key_secret_file, mode 0600), and is not used
+    once it is older than local_auth_max_age. The endpoint is not served by
+    the UrbanKetl server yet, which is why auth_mode defaults to "server".
+    
+    authenticate() runs the DESFire 3-pass mutual authentication with the
+    card key. Expanded AES key schedules are cached per card (LRU,
+    local_auth_cache_size), so a repeat tap skips the key expansion.
+    """
+    
+    KEY_NUMBER = 0x00
+    AUTH_EV2_FIRST = 0x71
+    AUTH_AES = 0xAA
+    
+    def __init__(self, api: ApiClient, get_config: Callable[[], Dict[str, Any]]):
+        self.api = api
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.cards = {}
+        self.version = None
+        self.etag = None
+        self.fetched_at = None  # Wall clock, so the age survives restarts
+        self.last_error = None
+        self.ciphers = OrderedDict()  # (uid, keyVersion) -> AES ECB object
+        self.stats = {'verified': 0, 'rejected': 0, 'errors': 0, 'scheduleHits': 0, 'scheduleMisses': 0}
+        self.verify_us = deque(maxlen=200)
+        self.refresh_event = threading.Event()
+        self.load()
+    
+    def secret(self) -> bytes:
+        """Device secret for the store, created on first use"""
+        path = self.get_config().get('card_key_secret_file', 'card_keys.secret')
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            secret = os.urandom(32)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(secret)
+            return secret
+    
+    def load(self):
+        path = self.get_config().get('card_key_store_file', 'card_keys.bin')
+        if not CRYPTO_AVAILABLE or not os.path.exists(path):
+            return
+        try:
+            with open(path, 'rb') as f:
+                blob = f.read()
+            cipher = AES.new(self.secret(), AES.MODE_GCM, nonce=blob[:12])
+            stored = json.loads(cipher.decrypt_and_verify(blob[28:], blob[12:28]))
+            if stored.get('machineId') != self.get_config()['machine_id']:
+                return
+            self.cards = {card['uid']: card for card in stored['cards']}
+            self.version, self.etag, self.fetched_at = stored.get('version'), stored.get('etag'), stored.get('fetchedAt')
+            self.logger.info(f"🔑 Card key store v{self.version} loaded ({len(self.cards)} cards)")
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.error(f"❌ Card key store unreadable ({e}) - waiting for the server")
+    
+    def save(self):
+        path = self.get_config().get('card_key_store_file', 'card_keys.bin')
+        with self.lock:
+            plain = json.dumps({'machineId': self.get_config()['machine_id'], 'version': self.version,
+                                'etag': self.etag, 'fetchedAt': self.fetched_at,
+                                'cards': list(self.cards.values())}).encode()
+        cipher = AES.new(self.secret(), AES.MODE_GCM, nonce=os.urandom(12))
+        ciphertext, tag = cipher.encrypt_and_digest(plain)
+        try:
+            fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(cipher.nonce + tag + ciphertext)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            self.logger.warning(f"⚠️  Could not save card key store: {e}")
+    
+    def refresh(self) -> bool:
+        """Fetch the key set. Returns True if the store is current."""
+        if not CRYPTO_AVAILABLE:
+            self.last_error = "pycryptodome not installed"
+            return False
+        
+        machine_id = self.get_config()['machine_id']
+        headers = {'If-None-Match': self.etag} if self.etag else {}
+        try:
+            response = self.api.get(f"/api/machines/{machine_id}/card-keys", headers=headers)
+            
+            if response.status_code == 304:
+                self.fetched_at = time.time()
+                self.last_error = None
+                return True
+            
+            if response.status_code != 200:
+                # 404: server without key provisioning - every tap goes through the server
+                self.last_error = f"HTTP {response.status_code}"
+                return False
+            
+            body = response.json()
+            cards = {}
+            for card in body['cards']:
+                if len(bytes.fromhex(card['key'])) != 16:
+                    raise ValueError(f"card {card['uid']}: key must be 16 bytes")
+                cards[card['uid'].upper()] = dict(card, uid=card['uid'].upper())
+            with self.lock:
+                self.cards = cards
+                self.version = body.get('version')
+                self.etag = response.headers.get('ETag')
+                self.fetched_at = time.time()
+                # Drop schedules for rotated or removed keys
+                self.ciphers.clear()
+            self.last_error = None
+            self.logger.info(f"🔑 Card key store v{self.version} ({len(cards)} cards)")
+            self.save()
+            return True
+        
+        except Exception as e:
+            self.last_error = str(e)
+            self.logger.warning(f"⚠️  Card key refresh error: {e}")
+            return False
+    
+    def refresh_now(self):
+        self.refresh_event.set()
+    
+    def start(self):
+        """Start background refresh"""
+        def refresh_loop():
+            while True:
+                self.refresh_event.wait(self.get_config().get('local_auth_refresh', 300))
+                self.refresh_event.clear()
+                if self.get_config().get('auth_mode', 'server') == 'local':
+                    self.refresh()
+        
+        threading.Thread(target=refresh_loop, name='card-key-refresh', daemon=True).start()
+    
+    def lookup(self, uid: str) -> Optional[Dict[str, Any]]:
+        """Provisioned entry for a card, or None if unknown or the store is too old to trust"""
+        if self.fetched_at is None or time.time() - self.fetched_at > self.get_config().get('local_auth_max_age', 86400):
+            return None
+        return self.cards.get(uid.upper())
+    
+    def cipher(self, card: Dict[str, Any]):
+        """AES-128 ECB object for the card key, reusing its expanded schedule"""
+        cache_key = (card['uid'], card.get('keyVersion'))
+        with self.lock:
+            cipher = self.ciphers.get(cache_key)
+            if cipher is not None:
+                self.ciphers.move_to_end(cache_key)
+                self.stats['scheduleHits'] += 1
+                return cipher
+            self.stats['scheduleMisses'] += 1
+        
+        cipher = AES.new(bytes.fromhex(card['key']), AES.MODE_ECB)
+        with self.lock:
+            self.ciphers[cache_key] = cipher
+            while len(self.ciphers) > self.get_config().get('local_auth_cache_size', 256):
+                self.ciphers.popitem(last=False)
+        return cipher
+    
+    @staticmethod
+    def cbc(cipher, iv: bytes, data: bytes, decrypt: bool = False) -> bytes:
+        """AES-CBC over whole blocks on an ECB object (keeps the cached key schedule)"""
+        out = b''
+        for offset in range(0, len(data), 16):
+            block = data[offset:offset + 16]
+            if decrypt:
+                out += bytes(a ^ b for a, b in zip(cipher.decrypt(block), iv))
+                iv = block
+            else:
+                iv = cipher.encrypt(bytes(a ^ b for a, b in zip(block, iv)))
+                out += iv
+        return out
+    
+    def authenticate(self, card: Dict[str, Any], exchange: Callable[[list], Optional[bytes]],
+                     ev2: bool) -> Optional[bool]:
+        """
+        DESFire mutual authentication with the card key
+        
+        The card sends E(RndB); the Pi answers E(RndA || RndB rotated left)
+        and the card must return E(RndA rotated left) - for EV2/EV3
+        (AuthenticateEV2First, 71) inside E(TI || RndA' || PDcap2 || PCDcap2)
+        with a zero IV per message, for EV1 (AuthenticateAES, AA) with the IV
+        chained from the previous cryptogram. Returns True if the card holds
+        the key, False if it does not, None if the exchange broke off.
+        """
+        started = time.perf_counter()
+        cipher = self.cipher(card)
+        zero = bytes(16)
+        
+        if ev2:
+            answer = exchange([0x90, self.AUTH_EV2_FIRST, 0x00, 0x00, 0x02, self.KEY_NUMBER, 0x00, 0x00])
+        else:
+            answer = exchange([0x90, self.AUTH_AES, 0x00, 0x00, 0x01, self.KEY_NUMBER, 0x00])
+        if not answer or len(answer) != 18 or answer[-2:] != b'\x91\xAF':
+            return self.finish(started, None)
+        
+        rnd_b = self.cbc(cipher, zero, answer[:16], decrypt=True)
+        rnd_a = os.urandom(16)
+        token = self.cbc(cipher, zero if ev2 else answer[:16], rnd_a + rnd_b[1:] + rnd_b[:1])
+        answer = exchange([0x90, 0xAF, 0x00, 0x00, 0x20] + list(token) + [0x00])
+        if not answer or len(answer) < 2:
+            return self.finish(started, None)
+        if answer[-2:] != b'\x91\x00':
+            # 91 AE: the card could not decrypt our token, i.e. the keys differ
+            return self.finish(started, False if answer[-2:] == b'\x91\xAE' else None)
+        
+        if ev2 and len(answer) == 34:
+            rnd_a_rotated = self.cbc(cipher, zero, answer[:32], decrypt=True)[4:20]
+        elif not ev2 and len(answer) == 18:
+            rnd_a_rotated = self.cbc(cipher, token[-16:], answer[:16], decrypt=True)
+        else:
+            return self.finish(started, None)
+        return self.finish(started, hmac.compare_digest(rnd_a_rotated, rnd_a[1:] + rnd_a[:1]))
+    
+    def finish(self, started: float, result: Optional[bool]) -> Optional[bool]:
+        self.verify_us.append((time.perf_counter() - started) * 1_000_000)
+        self.stats['errors' if result is None else 'verified' if result else 'rejected'] += 1
+        return result
+    
+    def get_status(self) -> Dict[str, Any]:
+        return dict(
+            self.stats,
+            version=self.version,
+            cards=len(self.cards),
+            ageSec=round(time.time() - self.fetched_at) if self.fetched_at else None,
+            cachedSchedules=len(self.ciphers),
+            verifyUsP50=percentile(list(self.verify_us), 50),
+            lastError=self.last_error
+        )
@@ -0,0 +1,36 @@
+"""
+UrbanKetl Tea Machine Controller - Shared Helpers
+Percentiles for the timing stats and systemd notifications
+"""
+
+import math
+import socket
+import os
+from typing import Optional
+
+
+def percentile(values, pct: float) -> Optional[float]:
+    """Nearest-rank percentile of a list of numbers (None if empty)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return round(ordered[index], 3)
+
+
+def sd_notify(state: str) -> bool:
+    """Send a state string to systemd (no-op when not started by systemd)"""
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    
+    if address.startswith('@'):
+        address = '\0' + address[1:]  # Abstract namespace socket
+    
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode('utf-8'))
+        return True
+    except OSError:
+        return False
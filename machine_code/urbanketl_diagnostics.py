@@ -0,0 +1,707 @@
+"""
+UrbanKetl Tea Machine Controller - Diagnostics
+Thread liveness for the watchdog, tap traces, CPU profiler, memory
+telemetry and the local status API
+"""
+
+import time
+import json
+import logging
+import threading
+import tracemalloc
+import traceback
+import gc
+import hmac
+import ipaddress
+import cProfile
+import pstats
+import re
+import sys
+import os
+from collections import deque
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, Dict, Any, List, Callable
+from urllib.parse import urlparse, parse_qs
+
+# Memory telemetry (falls back to /proc when missing)
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+
+class LivenessMonitor:
+    """
+    Liveness tracking for the systemd watchdog
+    
+    Each long-running thread registers a name and the longest time it may go
+    without calling beat(). The main loop calls check() and only pets the
+    watchdog while nothing is stalled, so a thread wedged in a reader or
+    network call gets the service restarted. Stall durations are logged
+    when a stall starts, while it lasts and when the thread recovers.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.components = {}
+        self.logger = logging.getLogger(__name__)
+    
+    def register(self, name: str, max_stall):
+        """max_stall is seconds, or a callable returning seconds"""
+        with self.lock:
+            self.components[name] = {
+                'max_stall': max_stall,
+                'last_beat': time.monotonic(),
+                'allowance': 0.0,
+                'stalled_since': None,
+                'last_report': 0.0,
+                'stalled_total': 0.0
+            }
+    
+    def unregister(self, name: str):
+        with self.lock:
+            component = self.components.pop(name, None)
+        if component and component['stalled_since'] is not None:
+            stalled_for = time.monotonic() - component['stalled_since']
+            self.logger.warning(f"⏱️  {name} finished after being stalled for {stalled_for:.1f}s")
+    
+    def beat(self, name: str, allowance: float = 0.0):
+        """allowance: extra seconds the step starting now may take on top of max_stall"""
+        now = time.monotonic()
+        with self.lock:
+            component = self.components.get(name)
+            if not component:
+                return
+            component['last_beat'] = now
+            component['allowance'] = allowance
+            stalled_since = component['stalled_since']
+            if stalled_since is not None:
+                component['stalled_since'] = None
+                component['stalled_total'] += now - stalled_since
+        
+        if stalled_since is not None:
+            self.logger.warning(f"⏱️  {name} recovered after {now - stalled_since:.1f}s stalled")
+    
+    def check(self) -> List[str]:
+        """Return the names of stalled components, logging stall durations"""
+        now = time.monotonic()
+        stalled = []
+        
+        with self.lock:
+            for name, component in self.components.items():
+                max_stall = component['max_stall']
+                if callable(max_stall):
+                    max_stall = max_stall()
+                max_stall += component['allowance']
+                
+                if now - component['last_beat'] <= max_stall:
+                    continue
+                
+                stalled.append(name)
+                silent_for = now - component['last_beat']
+                if component['stalled_since'] is None:
+                    component['stalled_since'] = component['last_beat'] + max_stall
+                    component['last_report'] = now
+                    self.logger.error(f"⏱️  {name} stalled: no progress for {silent_for:.1f}s (limit {max_stall:.0f}s)")
+                elif now - component['last_report'] >= 5:
+                    component['last_report'] = now
+                    self.logger.error(f"⏱️  {name} still stalled: no progress for {silent_for:.1f}s")
+        
+        return stalled
+    
+    def get_status(self) -> Dict[str, Any]:
+        """Seconds since each component last made progress"""
+        now = time.monotonic()
+        with self.lock:
+            return {
+                name: {
+                    'idleSeconds': round(now - component['last_beat'], 1),
+                    'stalled': component['stalled_since'] is not None,
+                    'stalledTotalSeconds': round(component['stalled_total'], 1)
+                }
+                for name, component in self.components.items()
+            }
+
+
+class TapRecorder:
+    """
+    Records a compact trace of each tap for deterministic replay
+    
+    One JSON line per tap: reader and APDU exchanges, HTTP requests with
+    their responses, and the offset/duration of every step in milliseconds.
+    Traces are collected per thread, so only calls made by the tap worker
+    are captured. See urbanketl_replay.py for the replay driver.
+    
+    A per-stage summary of the last HISTORY taps is always kept in memory
+    for the local status API; the trace file is only written while
+    trace_recording is on.
+    """
+    
+    VERSION = 1
+    HISTORY = 100
+    
+    def __init__(self, get_config: Callable[[], Dict[str, Any]]):
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=self.HISTORY)
+    
+    def begin(self, card_uid_hex: str, read_ms: Optional[float], context: Dict[str, Any]):
+        """Start a trace on the current thread"""
+        self.local.write = self.get_config().get('trace_recording', False)
+        self.local.trace = {
+            'v': self.VERSION,
+            'ts': datetime.now().isoformat(timespec='milliseconds'),
+            'uid': card_uid_hex,
+            'readMs': read_ms,
+            'cfg': context,
+            'start': time.perf_counter(),
+            'events': []
+        }
+    
+    def record(self, kind: str, started: Optional[float] = None, **fields):
+        """Add an event; started is the perf_counter() value when the step began"""
+        trace = getattr(self.local, 'trace', None)
+        if trace is None:
+            return
+        
+        now = time.perf_counter()
+        started = started if started is not None else now
+        event = {
+            'k': kind,
+            't': round((started - trace['start']) * 1000, 2),
+            'ms': round((now - started) * 1000, 2)
+        }
+        event.update(fields)
+        trace['events'].append(event)
+    
+    def end(self, outcome: Any) -> Optional[Dict[str, Any]]:
+        """Finish the current trace, append it to trace_file and return its summary"""
+        trace = getattr(self.local, 'trace', None)
+        self.local.trace = None
+        if trace is None:
+            return None
+        
+        trace['totalMs'] = round((time.perf_counter() - trace.pop('start')) * 1000, 2)
+        trace['outcome'] = outcome
+        summary = self.summarize(trace)
+        self.recent.append(summary)
+        
+        if not self.local.write:
+            return summary
+        
+        config = self.get_config()
+        trace_file = config.get('trace_file', 'tap_traces.jsonl')
+        line = json.dumps(trace, separators=(',', ':')) + '\n'
+        
+        try:
+            with self.lock:
+                # Keep one rotated file so recording can be left on
+                if os.path.exists(trace_file) and os.path.getsize(trace_file) > config.get('trace_max_bytes', 5_000_000):
+                    os.replace(trace_file, trace_file + '.1')
+                with open(trace_file, 'a') as f:
+                    f.write(line)
+        except OSError as e:
+            self.logger.error(f"❌ Failed to write tap trace: {e}")
+        return summary
+    
+    @staticmethod
+    def summarize(trace: Dict[str, Any]) -> Dict[str, Any]:
+        """Per-stage timings of a trace, without payloads"""
+        stages = []
+        error = None
+        for event in trace['events']:
+            if event['k'] == 'http':
+                stage = {'stage': f"{event['m']} {event['p']}"}
+                if 'err' in event:
+                    stage['error'] = event['err']
+                else:
+                    stage['status'] = event['s']
+            elif event['k'] == 'apdu':
+                stage = {'stage': 'card APDU'}
+            elif event['k'] == 'dispense':
+                stage = {'stage': 'valve open'}
+                if 'requestedMl' in event:
+                    stage['volumeMl'] = event['volumeMl']
+                elif 'actualMs' in event:
+                    stage['deviationMs'] = round(event['actualMs'] - event['requestedMs'], 3)
+            else:
+                stage = {'stage': f"{event['k']} {event.get('type', '')}".strip()}
+                error = event.get('type', error)
+            stage['atMs'] = event['t']
+            stage['ms'] = event['ms']
+            stages.append(stage)
+        
+        return {
+            'ts': trace['ts'],
+            'uid': trace['uid'],
+            'outcome': trace['outcome'],
+            'error': error,
+            'readMs': trace['readMs'],
+            'totalMs': trace['totalMs'],
+            'stages': stages
+        }
+    
+    def get_recent(self, limit: int) -> List[Dict[str, Any]]:
+        """Newest tap summaries first"""
+        return list(reversed(self.recent))[:limit]
+
+
+class Profiler:
+    """
+    On-demand CPU profiler for the live controller
+    
+    "sampling" mode samples every thread's stack with sys._current_frames()
+    and writes folded stacks (flamegraph.pl / speedscope), one root frame
+    per thread. "deterministic" mode runs taps under cProfile and writes
+    merged pstats. Only one cProfile may be active per process (Python
+    3.12+ raises ValueError for a second), so one tap is profiled at a time
+    and taps that overlap it, or another profiler, run unprofiled. Nothing
+    is hooked in while the profiler is off.
+    """
+    
+    def __init__(self, get_config: Callable[[], Dict[str, Any]]):
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.active = False
+        self.mode = None
+        self.started_at = None
+        self.samples = {}
+        self.sample_count = 0
+        self.tap_stats = None
+        self.tap_lock = threading.Lock()  # Held while a tap runs under cProfile
+        self.skipped_taps = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.last_output = None
+    
+    def output_path(self, prefix: str, extension: str) -> str:
+        directory = self.get_config().get('profile_dir', 'profiles')
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f"{prefix}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{extension}")
+    
+    def start(self, mode: Optional[str] = None, duration: Optional[float] = None) -> bool:
+        """Start profiling; stops on its own after profile_max_seconds"""
+        config = self.get_config()
+        mode = mode or config.get('profile_mode', 'sampling')
+        if mode not in ('sampling', 'deterministic'):
+            self.logger.warning(f"⚠️  Unknown profile mode: {mode}")
+            return False
+        
+        with self.lock:
+            if self.active:
+                return False
+            self.active = True
+            self.mode = mode
+            self.started_at = time.monotonic()
+            self.samples = {}
+            self.sample_count = 0
+            self.tap_stats = None
+            self.skipped_taps = 0
+            self.stop_event.clear()
+        
+        duration = duration or config.get('profile_max_seconds', 300)
+        if mode == 'sampling':
+            interval = config.get('profile_interval', 0.005)
+            self.thread = threading.Thread(target=self.sample_loop, args=(interval, duration), name='profiler', daemon=True)
+        else:
+            self.thread = threading.Thread(target=self.deadline_loop, args=(duration,), name='profiler', daemon=True)
+        self.thread.start()
+        
+        self.logger.info(f"🔬 CPU profiler started ({mode}, max {duration:.0f}s)")
+        return True
+    
+    def stop(self) -> Optional[str]:
+        """Stop profiling and write the profile. Returns the output path."""
+        with self.lock:
+            if not self.active:
+                return None
+            self.active = False
+            self.stop_event.set()
+        
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=2)
+        
+        elapsed = time.monotonic() - self.started_at
+        try:
+            if self.mode == 'sampling':
+                path = self.output_path('cpu', 'folded')
+                with open(path, 'w') as f:
+                    for stack, count in sorted(self.samples.items(), key=lambda item: -item[1]):
+                        f.write(f"{stack} {count}\n")
+                detail = f"{self.sample_count} samples"
+            else:
+                if self.tap_stats is None:
+                    self.logger.info("🔬 CPU profiler stopped - no taps were profiled")
+                    return None
+                path = self.output_path('cpu', 'pstats')
+                self.tap_stats.dump_stats(path)
+                detail = f"{self.tap_stats.total_calls} calls, {self.skipped_taps} taps skipped"
+        except OSError as e:
+            self.logger.error(f"❌ Failed to write profile: {e}")
+            return None
+        
+        self.last_output = path
+        self.logger.info(f"🔬 CPU profiler stopped after {elapsed:.1f}s ({detail}) → {path}")
+        return path
+    
+    def toggle(self, signum=None, frame=None):
+        """SIGUSR1 handler: start or stop profiling"""
+        # Signal handlers run on the main thread; do the file I/O elsewhere
+        target = self.stop if self.active else self.start
+        threading.Thread(target=target, name='profiler-toggle', daemon=True).start()
+    
+    @staticmethod
+    def thread_label(thread_id: int, names: Dict[int, str]) -> str:
+        # "Thread-12 (run_tap)" style names would split one worker type into many roots
+        return re.sub(r'-\d+', '', names.get(thread_id, f'thread-{thread_id}')).replace(' ', '_')
+    
+    def sample_loop(self, interval: float, duration: float):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + duration
+        while not self.stop_event.wait(interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(self.thread_label(thread_id, names))
+                key = ';'.join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+            self.sample_count += 1
+            if time.monotonic() >= deadline:
+                self.logger.info("🔬 Profiler reached profile_max_seconds")
+                self.stop()
+                return
+    
+    def deadline_loop(self, duration: float):
+        if not self.stop_event.wait(duration):
+            self.logger.info("🔬 Profiler reached profile_max_seconds")
+            self.stop()
+    
+    def profile_call(self, func: Callable, *args):
+        """Run func, under cProfile when deterministic profiling is active"""
+        if not (self.active and self.mode == 'deterministic'):
+            return func(*args)
+        
+        # Another tap is being profiled: run this one as is
+        if not self.tap_lock.acquire(blocking=False):
+            self.skipped_taps += 1
+            return func(*args)
+        
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Some other profiler is active in this process (Python 3.12+)
+                self.skipped_taps += 1
+                return func(*args)
+            
+            try:
+                return func(*args)
+            finally:
+                profile.disable()
+                with self.lock:
+                    if self.tap_stats is None:
+                        self.tap_stats = pstats.Stats(profile)
+                    else:
+                        self.tap_stats.add(profile)
+        finally:
+            self.tap_lock.release()
+    
+    def dump_stacks(self, signum=None, frame=None) -> Optional[str]:
+        """Write a stack dump of every thread (SIGUSR2 handler)"""
+        names = {t.ident: t.name for t in threading.enumerate()}
+        lines = [f"# UrbanKetl stack dump {datetime.now().isoformat(timespec='seconds')}\n"]
+        for thread_id, thread_frame in sys._current_frames().items():
+            lines.append(f"\nThread {names.get(thread_id, '?')} ({thread_id}):\n")
+            lines.extend(traceback.format_stack(thread_frame))
+        
+        try:
+            path = self.output_path('stacks', 'txt')
+            with open(path, 'w') as f:
+                f.writelines(lines)
+        except OSError as e:
+            self.logger.error(f"❌ Failed to write stack dump: {e}")
+            return None
+        
+        self.logger.info(f"🧵 Stack dump of {len(names)} threads → {path}")
+        return path
+    
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            'active': self.active,
+            'mode': self.mode if self.active else None,
+            'runningSec': round(time.monotonic() - self.started_at, 1) if self.active else None,
+            'samples': self.sample_count if self.active and self.mode == 'sampling' else None,
+            'skippedTaps': self.skipped_taps if self.active and self.mode == 'deterministic' else None,
+            'lastOutput': self.last_output
+        }
+
+
+class MemoryMonitor:
+    """
+    Memory telemetry for long uptimes under MemoryLimit
+    
+    get_snapshot() is cheap enough for every heartbeat: RSS, Python heap
+    blocks, GC state, thread count and the most common object types.
+    tracemalloc is opt-in (push command) because it roughly doubles the
+    cost of every allocation; each snapshot is diffed against the last.
+    """
+    
+    def __init__(self, get_config: Callable[[], Dict[str, Any]]):
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.baseline_rss = self.rss_bytes()
+        self.previous_snapshot = None
+        self.last_diff = None
+        self.trace_timer = None
+        self.warned = False
+        self.last_top_types = None
+    
+    @staticmethod
+    def rss_bytes() -> Optional[int]:
+        """Resident set size from psutil, or /proc when psutil is missing"""
+        if PSUTIL_AVAILABLE:
+            return psutil.Process().memory_info().rss
+        try:
+            with open('/proc/self/statm', 'r') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return None
+    
+    def top_types(self, limit: int) -> List[List[Any]]:
+        counts = {}
+        for obj in gc.get_objects():
+            name = type(obj).__name__
+            counts[name] = counts.get(name, 0) + 1
+        return [[name, count] for name, count in sorted(counts.items(), key=lambda item: -item[1])[:limit]]
+    
+    def get_snapshot(self, count_types: bool = True) -> Dict[str, Any]:
+        """
+        Memory figures for the heartbeat
+        
+        Counting object types walks the whole heap with the GIL held, so
+        only the heartbeat does it; without count_types the counts from the
+        last heartbeat are returned.
+        """
+        config = self.get_config()
+        rss = self.rss_bytes()
+        uptime_hours = (time.monotonic() - self.started_at) / 3600
+        
+        snapshot = {
+            'rssMb': round(rss / 1048576, 1) if rss is not None else None,
+            'rssGrowthMbPerHour': None,
+            'heapBlocks': sys.getallocatedblocks(),
+            'gcCounts': list(gc.get_count()),
+            'threads': threading.active_count(),
+            'tracemalloc': tracemalloc.is_tracing()
+        }
+        
+        if rss is not None and self.baseline_rss is not None and uptime_hours >= 0.1:
+            snapshot['rssGrowthMbPerHour'] = round((rss - self.baseline_rss) / 1048576 / uptime_hours, 2)
+        
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot['tracedMb'] = round(current / 1048576, 2)
+            snapshot['tracedPeakMb'] = round(peak / 1048576, 2)
+        
+        limit = config.get('memory_top_types', 10)
+        if limit and count_types:
+            self.last_top_types = self.top_types(limit)
+        if limit and self.last_top_types is not None:
+            snapshot['topTypes'] = self.last_top_types
+        
+        warn_mb = config.get('memory_warn_mb', 200)
+        if snapshot['rssMb'] is not None:
+            if snapshot['rssMb'] >= warn_mb and not self.warned:
+                self.logger.warning(f"⚠️  RSS {snapshot['rssMb']}MB is above memory_warn_mb ({warn_mb}MB)")
+                self.warned = True
+            elif snapshot['rssMb'] < warn_mb * 0.9:
+                self.warned = False
+        
+        return snapshot
+    
+    def start_tracing(self, frames: Optional[int] = None) -> bool:
+        """Start tracemalloc; it stops itself after tracemalloc_max_seconds"""
+        with self.lock:
+            if tracemalloc.is_tracing():
+                return False
+            tracemalloc.start(frames or self.get_config().get('tracemalloc_frames', 10))
+            self.previous_snapshot = tracemalloc.take_snapshot()
+            
+            max_seconds = self.get_config().get('tracemalloc_max_seconds', 3600)
+            self.trace_timer = threading.Timer(max_seconds, self.stop_tracing)
+            self.trace_timer.daemon = True
+            self.trace_timer.start()
+        
+        self.logger.info(f"🧠 tracemalloc started (stops after {max_seconds}s)")
+        return True
+    
+    def stop_tracing(self):
+        with self.lock:
+            if self.trace_timer:
+                self.trace_timer.cancel()
+                self.trace_timer = None
+            if not tracemalloc.is_tracing():
+                return
+            tracemalloc.stop()
+            self.previous_snapshot = None
+        self.logger.info("🧠 tracemalloc stopped")
+    
+    def snapshot_diff(self) -> Optional[List[Dict[str, Any]]]:
+        """Diff a new tracemalloc snapshot against the previous one"""
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                self.logger.warning("⚠️  tracemalloc is not running - send tracemalloc_start first")
+                return None
+            
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__)
+            ])
+            previous = self.previous_snapshot
+            self.previous_snapshot = snapshot
+        
+        limit = self.get_config().get('tracemalloc_top', 20)
+        diff = []
+        for stat in snapshot.compare_to(previous, 'traceback')[:limit]:
+            frame = stat.traceback[-1]  # Most recent frame: where the allocation happened
+            diff.append({
+                'location': f"{os.path.basename(frame.filename)}:{frame.lineno}",
+                'sizeDiffKb': round(stat.size_diff / 1024, 1),
+                'sizeKb': round(stat.size / 1024, 1),
+                'countDiff': stat.count_diff,
+                'traceback': stat.traceback.format()[-6:]
+            })
+        
+        self.last_diff = {'takenAt': datetime.now().isoformat(timespec='seconds'), 'top': diff}
+        for entry in diff[:5]:
+            self.logger.info(f"🧠 {entry['location']}: {entry['sizeDiffKb']:+}KB ({entry['countDiff']:+} blocks)")
+        return diff
+    
+    def get_status(self) -> Dict[str, Any]:
+        status = self.get_snapshot(count_types=False)
+        status['lastDiff'] = self.last_diff
+        return status
+
+
+class StatusServer:
+    """
+    Local status and control API for field technicians
+    
+    A ThreadingHTTPServer on its own threads (never the poller or tap
+    workers) that serves read-only status as JSON and a few safe actions.
+    It binds to 127.0.0.1 by default; use an SSH tunnel to reach it, or set
+    status_host and status_token to expose it on the local network. A
+    non-loopback status_host without a status_token is refused.
+    """
+    
+    def __init__(self, get_config: Callable[[], Dict[str, Any]],
+                 views: Dict[str, Callable[[Dict[str, str]], Any]],
+                 actions: Dict[str, Callable[[Dict[str, str]], Any]]):
+        self.get_config = get_config
+        self.views = views
+        self.actions = actions
+        self.logger = logging.getLogger(__name__)
+        self.server = None
+        self.thread = None
+    
+    @staticmethod
+    def is_loopback(host: str) -> bool:
+        if host == 'localhost':
+            return True
+        try:
+            return ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            return False
+    
+    def start(self) -> bool:
+        config = self.get_config()
+        host = config.get('status_host', '127.0.0.1')
+        port = config.get('status_port', 8088)
+        
+        if not self.is_loopback(host) and not config.get('status_token'):
+            self.logger.error(f"❌ Status API not started: status_host {host} needs a status_token")
+            return False
+        
+        try:
+            self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        except OSError as e:
+            self.logger.error(f"❌ Status API could not bind {host}:{port}: {e}")
+            return False
+        
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 1.0},
+                                       name='status-http', daemon=True)
+        self.thread.start()
+        self.logger.info(f"🩺 Status API on http://{host}:{port}/status")
+        return True
+    
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+    
+    def make_handler(self):
+        status_server = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                status_server.logger.debug(f"🩺 {self.address_string()} {format % args}")
+            
+            def send_json(self, status: int, body: Any):
+                data = json.dumps(body, indent=2, default=str).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('Cache-Control', 'no-store')
+                self.end_headers()
+                self.wfile.write(data)
+            
+            def route(self, routes: Dict[str, Callable], is_action: bool):
+                url = urlparse(self.path)
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                handler = routes.get(url.path.rstrip('/') or '/')
+                if handler is None:
+                    self.send_json(404, {'success': False, 'message': 'Not found', 'paths': sorted(routes)})
+                    return
+                try:
+                    result = handler(params)
+                    if not is_action:
+                        self.send_json(200, result)
+                    elif result is False:
+                        self.send_json(409, {'success': False, 'message': 'Not possible in the current state'})
+                    else:
+                        self.send_json(200, {'success': True, 'result': result})
+                except RuntimeError as e:
+                    # Action refused in the current state (e.g. a tap is in progress)
+                    self.send_json(409, {'success': False, 'message': str(e)})
+                except (KeyError, ValueError) as e:
+                    self.send_json(400, {'success': False, 'message': f"Bad request: {e}"})
+                except Exception as e:
+                    status_server.logger.error(f"❌ Status API error on {url.path}: {e}")
+                    self.send_json(500, {'success': False, 'message': str(e)})
+            
+            def do_GET(self):
+                self.route(status_server.views, False)
+            
+            def do_POST(self):
+                token = status_server.get_config().get('status_token')
+                if token and not hmac.compare_digest(self.headers.get('X-Status-Token', ''), token):
+                    self.send_json(401, {'success': False, 'message': 'Missing or wrong X-Status-Token'})
+                    return
+                self.route(status_server.actions, True)
+        
+        return Handler
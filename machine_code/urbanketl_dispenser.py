@@ -0,0 +1,482 @@
+"""
+UrbanKetl Tea Machine Controller - Dispenser
+Valve, LEDs, buzzer and flow sensor on GPIO, and pour timing stats
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+from typing import Optional, Dict, Any, List, Callable
+
+# GPIO for valve, LEDs, buzzer and buttons (Raspberry Pi only, whichever reader is fitted)
+try:
+    import RPi.GPIO as GPIO
+    GPIO_AVAILABLE = True
+except ImportError:
+    GPIO_AVAILABLE = False
+
+# pigpio daemon for DMA-timed valve pulses (optional)
+try:
+    import pigpio
+    PIGPIO_AVAILABLE = True
+except ImportError:
+    PIGPIO_AVAILABLE = False
+
+from urbanketl_common import percentile
+
+
+class DispenseStats:
+    """
+    Requested vs actual valve open time (or volume) for every cup
+    
+    The histogram uses fixed deviation buckets so counts from different
+    machines can simply be added up to get the fleet's overpour profile.
+    """
+    
+    # Upper edges (ms) of the deviation buckets; the last bucket is open-ended
+    BUCKETS_MS = (-5, -1, 0, 1, 2, 5, 10, 20, 50)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.deviations = deque(maxlen=1000)
+        self.histogram = [0] * (len(self.BUCKETS_MS) + 1)
+        self.cups = 0
+        self.overpour_ms = 0.0
+        self.last = None
+        # Flow sensor cups (dispense_mode "volume")
+        self.volume_deviations = deque(maxlen=1000)
+        self.flow_rates = deque(maxlen=1000)
+        self.overpour_ml = 0.0
+        self.flow_timeouts = 0
+    
+    def record(self, result: Dict[str, Any]):
+        if 'requestedMl' in result:
+            self.record_volume(result)
+            return
+        
+        deviation = result['actualMs'] - result['requestedMs']
+        bucket = next((i for i, edge in enumerate(self.BUCKETS_MS) if deviation <= edge), len(self.BUCKETS_MS))
+        with self.lock:
+            self.deviations.append(deviation)
+            self.histogram[bucket] += 1
+            self.cups += 1
+            self.overpour_ms += max(deviation, 0.0)
+            self.last = dict(result, deviationMs=round(deviation, 3))
+    
+    def record_volume(self, result: Dict[str, Any]):
+        deviation = result['volumeMl'] - result['requestedMl']
+        with self.lock:
+            self.volume_deviations.append(deviation)
+            if result['flowMlPerSec'] is not None:
+                self.flow_rates.append(result['flowMlPerSec'])
+            self.cups += 1
+            self.overpour_ml += max(deviation, 0.0)
+            self.flow_timeouts += 1 if result['timedOut'] else 0
+            self.last = dict(result, deviationMl=round(deviation, 2))
+    
+    def get_status(self) -> Dict[str, Any]:
+        with self.lock:
+            deviations = list(self.deviations)
+            volume_deviations = list(self.volume_deviations)
+            flow_rates = list(self.flow_rates)
+            return {
+                'cups': self.cups,
+                'method': self.last['method'] if self.last else None,
+                'last': self.last,
+                'deviationMs': {
+                    'p50': percentile(deviations, 50),
+                    'p95': percentile(deviations, 95),
+                    'p99': percentile(deviations, 99),
+                    'min': round(min(deviations), 3) if deviations else None,
+                    'max': round(max(deviations), 3) if deviations else None
+                },
+                'overpourMsTotal': round(self.overpour_ms, 1),
+                'histogramEdgesMs': list(self.BUCKETS_MS),
+                'histogram': list(self.histogram),
+                'volume': {
+                    'deviationMlP50': percentile(volume_deviations, 50),
+                    'deviationMlP95': percentile(volume_deviations, 95),
+                    'overpourMlTotal': round(self.overpour_ml, 1),
+                    'flowMlPerSecP50': percentile(flow_rates, 50),
+                    'flowMlPerSecMin': round(min(flow_rates), 2) if flow_rates else None,
+                    'timeouts': self.flow_timeouts
+                } if volume_deviations else None
+            }
+
+
+class FlowMeter:
+    """
+    Flow sensor pulse counter fed by GPIO edge interrupts
+    
+    on_pulse runs in RPi.GPIO's interrupt thread (or the simulated source)
+    and only increments a counter. The pulse that reaches the target closes
+    the valve right there and wakes the waiting dispense with an Event, so
+    nothing polls the count.
+    """
+    
+    def __init__(self):
+        self.pulses = 0
+        self.target = None
+        self.on_target = None
+        self.reached = threading.Event()
+    
+    def arm(self, target: int, on_target: Callable[[], None]):
+        self.target = target
+        self.on_target = on_target
+        self.pulses = 0
+        self.reached.clear()
+    
+    def on_pulse(self, channel=None):
+        self.pulses += 1
+        if self.pulses == self.target:
+            self.on_target()
+            self.reached.set()
+
+
+class SimulatedFlowSensor:
+    """Pulse source for off-device testing: a steady flow while the valve is open"""
+    
+    def __init__(self, meter: FlowMeter, ml_per_sec: float, pulses_per_ml: float):
+        self.meter = meter
+        self.period = 1.0 / (ml_per_sec * pulses_per_ml)
+        self.flowing = threading.Event()
+        self.thread = None
+    
+    def open(self):
+        self.flowing.set()
+        self.thread = threading.Thread(target=self.run, name='flow-sim', daemon=True)
+        self.thread.start()
+    
+    def close(self):
+        self.flowing.clear()
+    
+    def run(self):
+        next_pulse = time.perf_counter() + self.period
+        while self.flowing.is_set():
+            delay = next_pulse - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if not self.flowing.is_set():
+                return
+            self.meter.on_pulse()
+            next_pulse += self.period
+
+
+class Actuator:
+    """
+    Dispenser valve, LEDs and buzzer on GPIO (simulated without RPi.GPIO)
+    
+    With dispense_timing "auto" or "pigpio" and pigpiod running, the valve
+    is opened by a single DMA-timed pigpio wave, so CPU load cannot stretch
+    the pour. Otherwise the open time is held on the monotonic
+    perf_counter clock: sleep until dispense_spin_ms before the deadline,
+    then spin. Either way the actual open time is measured and returned.
+    """
+    
+    def __init__(self, get_config: Callable[[], Dict[str, Any]]):
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.pi = None  # pigpio connection; False once it proved unavailable
+        self.flow = FlowMeter()
+    
+    def setup(self, previous_pins: Optional[Dict[str, int]] = None):
+        """Initialize GPIO outputs, releasing pins from a previous config"""
+        if not GPIO_AVAILABLE:  # GPIO only available on Raspberry Pi
+            return
+        
+        try:
+            pins = self.get_config()['gpio_pins']
+            
+            if GPIO.getmode() is None:
+                GPIO.setmode(GPIO.BCM)
+            
+            if previous_pins:
+                released = [p for p in previous_pins.values() if p not in pins.values()]
+                for pin in released:
+                    GPIO.output(pin, GPIO.LOW)
+                if released:
+                    GPIO.cleanup(released)
+            
+            GPIO.setup(pins['dispenser'], GPIO.OUT)
+            GPIO.output(pins['dispenser'], GPIO.LOW)
+            
+            # Initialize optional pins
+            if 'led_green' in pins:
+                GPIO.setup(pins['led_green'], GPIO.OUT)
+                GPIO.output(pins['led_green'], GPIO.LOW)
+            if 'led_red' in pins:
+                GPIO.setup(pins['led_red'], GPIO.OUT)
+                GPIO.output(pins['led_red'], GPIO.LOW)
+            if 'buzzer' in pins:
+                GPIO.setup(pins['buzzer'], GPIO.OUT)
+                GPIO.output(pins['buzzer'], GPIO.LOW)
+            
+            # Extra valves used by beverage sequences (valve_milk, valve_syrup, ...)
+            for name, pin in pins.items():
+                if name.startswith('valve_'):
+                    GPIO.setup(pin, GPIO.OUT)
+                    GPIO.output(pin, GPIO.LOW)
+            
+            # Flow sensor pulses arrive as falling-edge interrupts
+            if 'flow_sensor' in pins:
+                GPIO.setup(pins['flow_sensor'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
+                try:
+                    GPIO.remove_event_detect(pins['flow_sensor'])
+                except RuntimeError:
+                    pass
+                GPIO.add_event_detect(pins['flow_sensor'], GPIO.FALLING, callback=self.flow.on_pulse)
+            
+            self.logger.info(f"✅ GPIO pins initialized: {list(pins.keys())}")
+        except Exception as e:
+            self.logger.error(f"❌ Failed to initialize GPIO: {e}")
+    
+    def dispense(self, dispense_time: float) -> Dict[str, Any]:
+        """Open the dispenser for dispense_time seconds. Returns the measured timing."""
+        requested_ms = dispense_time * 1000
+        if not GPIO_AVAILABLE:
+            self.logger.info(f"🔧 [SIMULATION] Dispensing tea for {dispense_time} seconds...")
+            opened = time.perf_counter()
+            self.hold(dispense_time)
+            actual = time.perf_counter() - opened
+            return {'method': 'simulated', 'requestedMs': requested_ms, 'actualMs': round(actual * 1000, 3)}
+        
+        pins = self.get_config()['gpio_pins']
+        
+        self.logger.info(f"☕ Dispensing tea for {dispense_time} seconds...")
+        
+        # Activate green LED if available
+        if 'led_green' in pins:
+            GPIO.output(pins['led_green'], GPIO.HIGH)
+        
+        try:
+            pi = self.pigpio()
+            if pi:
+                method, actual = 'pigpio', self.pulse_pigpio(pi, pins['dispenser'], dispense_time)
+            else:
+                method, actual = 'sleep', self.pulse_sleep(pins['dispenser'], dispense_time)
+        finally:
+            if 'led_green' in pins:
+                GPIO.output(pins['led_green'], GPIO.LOW)
+        
+        return {'method': method, 'requestedMs': requested_ms, 'actualMs': round(actual * 1000, 3)}
+    
+    def dispense_volume(self, volume_ml: float) -> Dict[str, Any]:
+        """Open the dispenser until the flow sensor has counted volume_ml (or flow_timeout passes)"""
+        config = self.get_config()
+        pulses_per_ml = config.get('flow_pulses_per_ml', 0.45)
+        timeout = config.get('flow_timeout', 15)
+        target = max(1, round(volume_ml * pulses_per_ml))
+        closed_at = []
+        
+        if GPIO_AVAILABLE:
+            pins = config['gpio_pins']
+            valve = pins['dispenser']
+            
+            def open_valve():
+                GPIO.output(valve, GPIO.HIGH)
+            
+            def close_valve():
+                GPIO.output(valve, GPIO.LOW)
+                closed_at.append(time.perf_counter())
+            
+            self.logger.info(f"☕ Dispensing {volume_ml}ml (target {target} pulses)...")
+            if 'led_green' in pins:
+                GPIO.output(pins['led_green'], GPIO.HIGH)
+        else:
+            source = SimulatedFlowSensor(self.flow, config.get('flow_simulated_ml_per_sec', 25), pulses_per_ml)
+            open_valve = source.open
+            
+            def close_valve():
+                source.close()
+                closed_at.append(time.perf_counter())
+            
+            self.logger.info(f"🔧 [SIMULATION] Dispensing {volume_ml}ml (target {target} pulses)...")
+        
+        self.flow.arm(target, close_valve)
+        opened = time.perf_counter()
+        try:
+            open_valve()
+            reached = self.flow.reached.wait(timeout)
+        finally:
+            if not closed_at:
+                close_valve()
+            if GPIO_AVAILABLE and 'led_green' in pins:
+                GPIO.output(pins['led_green'], GPIO.LOW)
+        
+        if not reached:
+            self.logger.error(f"❌ Flow timeout after {timeout}s: {self.flow.pulses}/{target} pulses")
+        
+        # Count what still runs through after the valve closes
+        time.sleep(config.get('flow_settle', 0.3))
+        pulses = self.flow.pulses
+        self.flow.arm(None, None)
+        
+        open_seconds = closed_at[0] - opened
+        volume = pulses / pulses_per_ml
+        return {
+            'method': 'flow',
+            'requestedMl': volume_ml,
+            'volumeMl': round(volume, 1),
+            'pulses': pulses,
+            'actualMs': round(open_seconds * 1000, 3),
+            'flowMlPerSec': round(volume / open_seconds, 2) if open_seconds > 0 else None,
+            'timedOut': not reached
+        }
+    
+    def dispense_sequence(self, steps: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Open valves one after another ([{"valve": gpio_pins name, "seconds": s}])"""
+        pins = self.get_config()['gpio_pins']
+        timings = []
+        for step in steps:
+            pin = pins[step['valve']]  # KeyError for a valve this machine does not have
+            if GPIO_AVAILABLE:
+                actual = self.pulse_sleep(pin, step['seconds'])
+            else:
+                self.logger.info(f"🔧 [SIMULATION] {step['valve']} open for {step['seconds']} seconds...")
+                opened = time.perf_counter()
+                self.hold(step['seconds'])
+                actual = time.perf_counter() - opened
+            timings.append({'valve': step['valve'], 'requestedMs': step['seconds'] * 1000,
+                            'actualMs': round(actual * 1000, 3)})
+        return {
+            'method': 'sequence',
+            'requestedMs': sum(t['requestedMs'] for t in timings),
+            'actualMs': round(sum(t['actualMs'] for t in timings), 3),
+            'steps': timings
+        }
+    
+    def hold(self, seconds: float):
+        """Wait until seconds have passed on the monotonic clock, spinning for the last few ms"""
+        deadline = time.perf_counter() + seconds
+        spin = self.get_config().get('dispense_spin_ms', 2) / 1000.0
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= spin:
+                break
+            time.sleep(remaining - spin)
+        while time.perf_counter() < deadline:
+            pass
+    
+    def pulse_sleep(self, pin: int, dispense_time: float) -> float:
+        GPIO.output(pin, GPIO.HIGH)
+        opened = time.perf_counter()
+        try:
+            self.hold(dispense_time)
+        finally:
+            GPIO.output(pin, GPIO.LOW)
+            closed = time.perf_counter()
+        return closed - opened
+    
+    def pigpio(self):
+        """pigpio connection for dispense_timing auto/pigpio, or None"""
+        mode = self.get_config().get('dispense_timing', 'auto')
+        if mode == 'sleep' or self.pi is False:
+            return None
+        if self.pi is None:
+            if not PIGPIO_AVAILABLE:
+                if mode == 'pigpio':
+                    self.logger.warning("⚠️  dispense_timing pigpio needs the pigpio package - using sleep timing")
+                self.pi = False
+                return None
+            pi = pigpio.pi()
+            if not pi.connected:
+                self.logger.warning("⚠️  pigpiod not running - using sleep timing for the valve")
+                self.pi = False
+                return None
+            self.logger.info("⏱️  Valve pulses timed by pigpio (DMA)")
+            self.pi = pi
+        return self.pi
+    
+    def pulse_pigpio(self, pi, pin: int, dispense_time: float) -> float:
+        """One hardware-timed HIGH pulse; open time measured from pigpio's edge ticks"""
+        edges = {}
+        closed = threading.Event()
+        
+        def on_edge(gpio, level, tick):
+            edges[level] = tick
+            if level == 0:
+                closed.set()
+        
+        callback = pi.callback(pin, pigpio.EITHER_EDGE, on_edge)
+        started = time.perf_counter()
+        wave = None
+        try:
+            pi.set_mode(pin, pigpio.OUTPUT)
+            pi.wave_clear()
+            pi.wave_add_generic([
+                pigpio.pulse(1 << pin, 0, int(dispense_time * 1_000_000)),
+                pigpio.pulse(0, 1 << pin, 0)
+            ])
+            wave = pi.wave_create()
+            pi.wave_send_once(wave)
+            if not closed.wait(dispense_time + 1.0):
+                self.logger.error("❌ Valve close edge not seen - forcing it low")
+                pi.wave_tx_stop()
+        finally:
+            pi.write(pin, 0)
+            callback.cancel()
+            if wave is not None:
+                pi.wave_delete(wave)
+        
+        if 1 in edges and 0 in edges:
+            return pigpio.tickDiff(edges[1], edges[0]) / 1_000_000
+        return time.perf_counter() - started
+    
+    def set_led(self, color: str, mode: str = 'on'):
+        """Control LED indicators (optional)"""
+        if not GPIO_AVAILABLE:
+            return
+        
+        try:
+            pins = self.get_config()['gpio_pins']
+            led_key = f'led_{color}'
+            
+            if led_key not in pins:
+                return
+            
+            led_pin = pins[led_key]
+            
+            if mode == 'on':
+                GPIO.output(led_pin, GPIO.HIGH)
+            elif mode == 'off':
+                GPIO.output(led_pin, GPIO.LOW)
+            elif mode == 'blink':
+                for _ in range(3):
+                    GPIO.output(led_pin, GPIO.HIGH)
+                    time.sleep(0.1)
+                    GPIO.output(led_pin, GPIO.LOW)
+                    time.sleep(0.1)
+        
+        except Exception as e:
+            self.logger.debug(f"LED not available: {e}")
+    
+    def beep(self, duration: float = 0.1):
+        """Sound buzzer (optional)"""
+        if not GPIO_AVAILABLE:
+            return
+        
+        try:
+            pins = self.get_config()['gpio_pins']
+            
+            if 'buzzer' not in pins:
+                return
+            
+            GPIO.output(pins['buzzer'], GPIO.HIGH)
+            time.sleep(duration)
+            GPIO.output(pins['buzzer'], GPIO.LOW)
+        
+        except Exception as e:
+            self.logger.debug(f"Buzzer not available: {e}")
+    
+    def release(self):
+        """Close the dispenser and free every pin"""
+        if self.pi:
+            self.pi.stop()
+        if not GPIO_AVAILABLE:
+            return
+        try:
+            GPIO.output(self.get_config()['gpio_pins']['dispenser'], GPIO.LOW)
+            GPIO.cleanup()
+        except Exception:
+            pass
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+UrbanKetl Edge Gateway - Site-Local Proxy for Many Kiosks
+Kiosks on a campus LAN point api_base_url at the gateway instead of the
+cloud. The gateway keeps one warm keep-alive pool to the cloud, answers
+tea prices and heartbeats locally, stores and forwards tap event batches,
+and fails auth calls fast while the WAN is down
+
+Usage:
+    python3 urbanketl_edge_gateway.py                         # gateway_config.json
+    python3 urbanketl_edge_gateway.py --benchmark \\
+        --cloud https://ukteawallet.com --gateway http://gateway.local:8090
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, Dict, Any
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+from urbanketl_machine_unified import (
+    ApiClient,
+    ConnectionWarmer,
+    EventUploader,
+    TeaPriceCache,
+    WireCodec,
+    percentile,
+)
+
+
+DEFAULT_CONFIG = {
+    "api_base_url": "https://your-domain.replit.app",
+    "listen_host": "0.0.0.0",
+    "listen_port": 8090,
+    "api_timeout": 5,
+    "pool_size": 32,  # Upstream keep-alive connections (one per busy kiosk)
+    "price_ttl": 120,
+    "tea_price": 5.0,
+    "heartbeat_forward_interval": 60,  # Per-machine upstream heartbeat rate
+    "wan_fail_fast": 10,  # Seconds auth calls fail immediately after a WAN error
+    "dns_ttl": 300,
+    "dns_stale_max": 86400,
+    "keepalive_interval": 45,
+    "prewarm_idle": 20,
+    "events_spool_dir": "gateway_spool",
+    "events_spool_max_bytes": 100000000,
+    "events_max_age": 60,
+    "machine_id": "GATEWAY"
+}
+
+# Headers passed through in both directions
+FORWARD_REQUEST_HEADERS = ('Content-Type', 'Accept', 'If-None-Match', 'If-Modified-Since')
+FORWARD_RESPONSE_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control')
+
+PRICE_PATH = re.compile(r'^/api/machines/([^/]+)/tea-price$')
+
+
+class HeartbeatRelay:
+    """Answers kiosk heartbeats locally and forwards the latest one per machine upstream"""
+
+    def __init__(self, api: ApiClient, get_config):
+        self.api = api
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.latest = {}  # machineId -> (payload, received_at)
+        self.forwarded_at = {}
+        self.pending_config = {}
+        self.last_error = None
+
+    def receive(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        machine_id = payload.get('machineId')
+        with self.lock:
+            self.latest[machine_id] = (payload, time.monotonic())
+            config = self.pending_config.pop(machine_id, None)
+        response = {'success': True, 'via': 'gateway'}
+        if config:
+            response['config'] = config
+        return response
+
+    def start(self):
+        threading.Thread(target=self.forward_loop, name='heartbeat-relay', daemon=True).start()
+
+    def forward_loop(self):
+        while True:
+            time.sleep(1)
+            interval = self.get_config().get('heartbeat_forward_interval', 60)
+            now = time.monotonic()
+            with self.lock:
+                # Only forward heartbeats newer than the last one sent, so a dead kiosk goes offline upstream
+                due = [(machine_id, payload) for machine_id, (payload, received_at) in self.latest.items()
+                       if received_at > self.forwarded_at.get(machine_id, 0)
+                       and now - self.forwarded_at.get(machine_id, 0) >= interval]
+            for machine_id, payload in due:
+                self.forwarded_at[machine_id] = now
+                try:
+                    response = self.api.post("/api/machine/heartbeat", payload)
+                    self.last_error = None if response.status_code == 200 else f"HTTP {response.status_code}"
+                    if response.status_code == 200:
+                        config = response.json().get('config')
+                        if config:
+                            with self.lock:
+                                self.pending_config[machine_id] = config
+                except Exception as e:
+                    self.last_error = str(e)
+
+    def get_status(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self.lock:
+            return {
+                'machines': {machine_id: {'lastSeenSec': round(now - received_at, 1)}
+                             for machine_id, (_, received_at) in self.latest.items()},
+                'lastError': self.last_error
+            }
+
+
+class EdgeGateway:
+    """Site-local proxy between kiosks and the cloud API"""
+
+    def __init__(self, config_file: str = "gateway_config.json"):
+        self.logger = logging.getLogger(__name__)
+        self.config = dict(DEFAULT_CONFIG)
+        if os.path.exists(config_file):
+            with open(config_file, 'r') as f:
+                self.config.update(json.load(f))
+
+        self.api = ApiClient(lambda: self.config)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.config['pool_size'])
+        self.api.session.mount('http://', adapter)
+        self.api.session.mount('https://', adapter)
+
+        self.prices = {}
+        self.prices_lock = threading.Lock()
+        self.heartbeats = HeartbeatRelay(self.api, lambda: self.config)
+        self.events = EventUploader(self.api, lambda: self.config)
+        self.warmer = ConnectionWarmer(self.api, self.probe, lambda: self.config)
+
+        self.wan_down_until = 0.0
+        self.upstream_ms = {'auth': [], 'other': []}
+        self.counts = {'proxied': 0, 'failedFast': 0, 'upstreamErrors': 0, 'pricesServed': 0,
+                       'heartbeats': 0, 'eventBatches': 0}
+
+    def probe(self):
+        """Keep-alive probe: refresh any known machine's price"""
+        with self.prices_lock:
+            caches = list(self.prices.values())
+        if caches:
+            caches[0].refresh()
+
+    def price_cache(self, machine_id: str) -> TeaPriceCache:
+        with self.prices_lock:
+            cache = self.prices.get(machine_id)
+            if cache is None:
+                cache = TeaPriceCache(self.api, lambda: dict(self.config, machine_id=machine_id))
+                self.prices[machine_id] = cache
+                created = True
+            else:
+                created = False
+        if created:
+            cache.refresh()
+            cache.start()
+        return cache
+
+    def wan_down(self) -> bool:
+        return time.monotonic() < self.wan_down_until
+
+    def proxy(self, method: str, path: str, headers: Dict[str, str], body: Optional[bytes]):
+        """Forward one request upstream. Returns (status, headers, body)."""
+        is_auth = path.startswith('/api/machine/auth/')
+        if is_auth and self.wan_down():
+            self.counts['failedFast'] += 1
+            return 503, {'Content-Type': 'application/json'}, json.dumps(
+                {'success': False, 'message': 'Cloud unreachable (edge gateway)'}).encode()
+
+        # Long-polls may be held open for `wait` seconds
+        query = parse_qs(urlparse(path).query)
+        timeout = self.config['api_timeout'] + float(query.get('wait', [0])[0])
+
+        started = time.perf_counter()
+        try:
+            response = self.api.request(method, path, data=body, timeout=timeout,
+                                        headers={k: v for k, v in headers.items() if k in FORWARD_REQUEST_HEADERS})
+        except Exception as e:
+            self.counts['upstreamErrors'] += 1
+            self.wan_down_until = time.monotonic() + self.config['wan_fail_fast']
+            self.logger.warning(f"⚠️  Upstream {method} {path} failed: {e}")
+            return 502, {'Content-Type': 'application/json'}, json.dumps(
+                {'success': False, 'message': f'Upstream error: {e}'}).encode()
+
+        self.wan_down_until = 0.0
+        self.counts['proxied'] += 1
+        samples = self.upstream_ms['auth' if is_auth else 'other']
+        samples.append((time.perf_counter() - started) * 1000)
+        del samples[:-500]
+        return (response.status_code,
+                {k: response.headers[k] for k in FORWARD_RESPONSE_HEADERS if k in response.headers},
+                response.content)
+
+    def serve_price(self, machine_id: str, headers: Dict[str, str]):
+        cache = self.price_cache(machine_id)
+        if cache.price is None:
+            return None  # Unknown to the cloud (or never reachable) - let the cloud answer
+        etag = f'"{machine_id}-{cache.price:.2f}"'
+        self.counts['pricesServed'] += 1
+        if headers.get('If-None-Match') == etag:
+            return 304, {'ETag': etag}, b''
+        body = json.dumps({'success': True, 'machineId': machine_id, 'price': f"{cache.price:.2f}", 'via': 'gateway'})
+        return 200, {'Content-Type': 'application/json', 'ETag': etag}, body.encode()
+
+    def handle(self, method: str, path: str, headers: Dict[str, str], body: Optional[bytes]):
+        route = urlparse(path).path
+
+        if method == 'GET' and route == '/gateway/status':
+            return 200, {'Content-Type': 'application/json'}, json.dumps(self.get_status(), indent=2).encode()
+
+        match = PRICE_PATH.match(route)
+        if method == 'GET' and match:
+            served = self.serve_price(match.group(1), headers)
+            if served:
+                return served
+
+        if method == 'POST' and route == '/api/machine/heartbeat':
+            codec = WireCodec.for_content_type(headers.get('Content-Type', '').split(';')[0].strip())
+            payload = codec.decode(body) if codec else json.loads(body or b'{}')
+            self.counts['heartbeats'] += 1
+            return 200, {'Content-Type': 'application/json'}, json.dumps(self.heartbeats.receive(payload)).encode()
+
+        if method == 'POST' and route == '/api/machine/events/bulk':
+            raw = gzip.decompress(body) if headers.get('Content-Encoding') == 'gzip' else body
+            count = len(json.loads(raw).get('events', []))
+            self.events.spool(gzip.compress(raw), count)
+            self.counts['eventBatches'] += 1
+            return 202, {'Content-Type': 'application/json'}, json.dumps({'success': True, 'accepted': count}).encode()
+
+        return self.proxy(method, path, headers, body)
+
+    def make_handler(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive on the LAN side too
+
+            def log_message(self, format, *args):
+                gateway.logger.debug(f"{self.address_string()} {format % args}")
+
+            def dispatch(self, method: str):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else None
+                try:
+                    status, headers, data = gateway.handle(method, self.path, dict(self.headers), body)
+                except Exception as e:
+                    gateway.logger.error(f"❌ {method} {self.path}: {e}")
+                    status, headers, data = 500, {'Content-Type': 'application/json'}, json.dumps(
+                        {'success': False, 'message': str(e)}).encode()
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.dispatch('GET')
+
+            def do_POST(self):
+                self.dispatch('POST')
+
+        return Handler
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            'upstream': self.config['api_base_url'],
+            'wanDown': self.wan_down(),
+            'counts': self.counts,
+            'upstreamAuthP50Ms': percentile(self.upstream_ms['auth'], 50),
+            'upstreamAuthP95Ms': percentile(self.upstream_ms['auth'], 95),
+            'connection': dict(self.api.get_connection_status(), warmer=self.warmer.get_status()),
+            'heartbeats': self.heartbeats.get_status(),
+            'events': self.events.get_status(),
+            'prices': {machine_id: cache.get_status() for machine_id, cache in self.prices.items()}
+        }
+
+    def run(self):
+        self.heartbeats.start()
+        self.events.start()
+        self.warmer.start()
+
+        server = ThreadingHTTPServer((self.config['listen_host'], self.config['listen_port']), self.make_handler())
+        server.daemon_threads = True
+        self.logger.info(f"🏢 Edge gateway on {self.config['listen_host']}:{self.config['listen_port']} "
+                         f"→ {self.config['api_base_url']}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.logger.info("⏹️  Shutdown requested...")
+        finally:
+            server.server_close()
+            self.events.stop()
+
+
+def benchmark_target(base_url: str, kiosks: int, taps: int, cold: bool) -> Dict[str, Any]:
+    """Run taps (challenge + validate) from several kiosks and time them"""
+    tap_ms, request_ms, errors = [], {}, []
+    lock = threading.Lock()
+
+    def kiosk(index: int):
+        config = {'api_base_url': base_url, 'api_timeout': 10, 'machine_id': f"UK_{index + 1:04d}"}
+        api = ApiClient(lambda: config)
+        for tap in range(taps):
+            if cold:
+                api.session.close()  # Simulate the idle connection having been dropped
+            card_uid = f"04{index:02X}{tap:04X}BENCH"[:14]
+            started = time.perf_counter()
+            try:
+                steps = [('challenge', {'machineId': config['machine_id'], 'cardUid': card_uid})]
+                step_started = time.perf_counter()
+                response = api.post('/api/machine/auth/challenge', steps[0][1])
+                timings = {'challenge': (time.perf_counter() - step_started) * 1000}
+                if response.status_code == 200:
+                    challenge = response.json()
+                    step_started = time.perf_counter()
+                    api.post('/api/machine/auth/validate', {
+                        'challengeId': challenge.get('challengeId'),
+                        'response': os.urandom(16).hex().upper(),
+                        'cardUid': card_uid
+                    })
+                    timings['validate'] = (time.perf_counter() - step_started) * 1000
+                else:
+                    errors.append(response.status_code)
+            except Exception as e:
+                errors.append(str(e))
+                continue
+            with lock:
+                tap_ms.append((time.perf_counter() - started) * 1000)
+                for step, ms in timings.items():
+                    request_ms.setdefault(step, []).append(ms)
+
+    threads = [threading.Thread(target=kiosk, args=(i,)) for i in range(kiosks)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {
+        'taps': len(tap_ms),
+        'errors': len(errors),
+        'tapP50Ms': percentile(tap_ms, 50),
+        'tapP95Ms': percentile(tap_ms, 95),
+        'steps': {step: {'p50Ms': percentile(ms, 50), 'p95Ms': percentile(ms, 95)} for step, ms in request_ms.items()}
+    }
+
+
+def benchmark(args):
+    print(f"⏱️  {args.kiosks} kiosks x {args.taps} taps, {'cold' if args.cold else 'warm'} kiosk connections")
+    results = {}
+    for name, url in (('direct', args.cloud), ('gateway', args.gateway)):
+        results[name] = benchmark_target(url, args.kiosks, args.taps, args.cold)
+        r = results[name]
+        steps = ', '.join(f"{step} p50 {s['p50Ms']}ms" for step, s in r['steps'].items())
+        print(f"   {name:<8} tap p50 {r['tapP50Ms']}ms, p95 {r['tapP95Ms']}ms ({r['taps']} taps, {r['errors']} errors) - {steps}")
+    if results['direct']['tapP50Ms'] and results['gateway']['tapP50Ms']:
+        print(f"📊 Gateway p50 is {results['gateway']['tapP50Ms'] - results['direct']['tapP50Ms']:+.1f}ms vs direct")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UrbanKetl site-local edge gateway")
+    parser.add_argument('--config', default='gateway_config.json')
+    parser.add_argument('--benchmark', action='store_true', help="Compare per-tap latency via gateway vs direct")
+    parser.add_argument('--cloud', help="Cloud API base URL (benchmark)")
+    parser.add_argument('--gateway', default='http://localhost:8090', help="Gateway base URL (benchmark)")
+    parser.add_argument('--kiosks', type=int, default=10)
+    parser.add_argument('--taps', type=int, default=20, help="Taps per kiosk")
+    parser.add_argument('--cold', action='store_true', help="Drop each kiosk's connection before every tap")
+    parser.add_argument('--json', help="Write benchmark results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR if args.benchmark else logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.benchmark:
+        if not args.cloud:
+            parser.error("--benchmark needs --cloud")
+        benchmark(args)
+        return
+
+    EdgeGateway(args.config).run()
+
+
+if __name__ == "__main__":
+    main()
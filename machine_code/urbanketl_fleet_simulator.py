@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+UrbanKetl Fleet Load Simulator
+Runs N virtual tea machines (the unified controller with simulated readers)
+against a target server and reports server-side latency under realistic
+arrival curves such as the 9:00 morning rush
+
+Usage:
+    python3 urbanketl_fleet_simulator.py --target http://localhost:5000 \\
+        --machines 200 --profile morning_rush --duration 300 --peak-rate 40
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import queue
+import random
+import re
+import tempfile
+import threading
+import time
+from typing import Optional, Dict, Any, List
+
+from urbanketl_machine_unified import (
+    ApiClient,
+    ReaderInterface,
+    UrbanKetlUnifiedMachine,
+    percentile,
+)
+
+
+# Arrival curves: load multiplier (0-1) over the simulated window (0-1)
+PROFILES = {
+    # 08:00-10:00 compressed, peaking at 09:00 sharp
+    'morning_rush': lambda x: 0.1 + 0.9 * math.exp(-((x - 0.5) / 0.08) ** 2),
+    # 12:00-14:00 compressed, a quick spike at 13:00 on a steady base
+    'lunch_spike': lambda x: 0.3 + 0.7 * math.exp(-((x - 0.5) / 0.05) ** 2),
+    'flat': lambda x: 1.0,
+    # Linear ramp from zero to peak - finds the saturation point
+    'ramp': lambda x: x,
+}
+
+
+class FleetStats:
+    """Thread-safe request and tap measurements"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []  # (time, endpoint, latency, outcome)
+        self.taps = []  # (offered time, queue wait, duration, success)
+
+    def add_request(self, endpoint: str, latency: float, outcome: str):
+        with self.lock:
+            self.requests.append((time.monotonic(), endpoint, latency, outcome))
+
+    def add_tap(self, arrived: float, started: float, finished: float, success: bool):
+        with self.lock:
+            self.taps.append((arrived, started - arrived, finished - started, success))
+
+
+class MeasuredApiClient(ApiClient):
+    """ApiClient that records latency and outcome of every call"""
+
+    def __init__(self, get_config, stats: FleetStats):
+        super().__init__(get_config)
+        self.stats = stats
+
+    def request(self, method: str, path: str, timeout: Optional[float] = None, **kwargs):
+        # Group per-machine URLs under one endpoint name
+        endpoint = f"{method} {re.sub(r'/machines/[^/]+/', '/machines/:machineId/', path)}"
+        started = time.perf_counter()
+        try:
+            response = super().request(method, path, timeout=timeout, **kwargs)
+        except Exception as e:
+            outcome = 'timeout' if 'timed out' in str(e).lower() else 'network_error'
+            self.stats.add_request(endpoint, time.perf_counter() - started, outcome)
+            raise
+
+        status = response.status_code
+        if status < 400:
+            outcome = 'ok'
+        elif status in (400, 401, 404):
+            outcome = 'rejected'  # Application-level answer (e.g. unknown card)
+        else:
+            outcome = f'http_{status}'
+        self.stats.add_request(endpoint, time.perf_counter() - started, outcome)
+        return response
+
+
+class SimulatedReader(ReaderInterface):
+    """DESFire EV3 card that answers authentication with random cryptogram bytes"""
+
+    # GetVersion frames: hardware, software (91 AF), then production data (91 00)
+    VERSION_FRAMES = [bytes.fromhex('04010133001A05') + b'\x91\xaf',
+                      bytes.fromhex('04010103001A05') + b'\x91\xaf',
+                      bytes.fromhex('04A1B2C3D4E5F6BA34CC005021') + b'\x00\x91\x00']
+
+    def __init__(self, apdu_latency: float):
+        self.apdu_latency = apdu_latency
+        self.version_frame = 0
+
+    def initialize(self, config: Dict[str, Any]) -> bool:
+        return True
+
+    def read_uid(self, timeout: float = 0.05) -> Optional[bytes]:
+        return None
+
+    def send_apdu(self, apdu_command: list) -> Optional[bytes]:
+        time.sleep(self.apdu_latency)
+        if apdu_command[1] in (0x60, 0xAF):
+            self.version_frame = 0 if apdu_command[1] == 0x60 else self.version_frame + 1
+            return self.VERSION_FRAMES[min(self.version_frame, 2)]
+        return os.urandom(16) + b'\x91\xaf'
+
+    def get_reader_name(self) -> str:
+        return "Simulated"
+
+
+class VirtualMachine(UrbanKetlUnifiedMachine):
+    """One kiosk: taps queue up and are served one at a time, like a real line"""
+
+    def __init__(self, config_file: str, stats: FleetStats, args):
+        self.stats = stats
+        self.args = args
+        self.taps = queue.Queue()
+        super().__init__(
+            config_file,
+            reader=SimulatedReader(args.apdu_latency),
+            api=MeasuredApiClient(lambda: self.config, stats)
+        )
+
+    def setup_gpio(self, previous_pins=None):
+        pass
+
+    def set_led(self, color: str, mode: str = 'on'):
+        pass
+
+    def beep(self, duration: float = 0.1):
+        pass
+
+    def show_success(self):
+        pass
+
+    def show_error(self, error_type: str):
+        pass
+
+    def dispense_tea(self, profile=None):
+        time.sleep(self.args.dispense_time)
+
+    def worker(self, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                arrived, card_uid = self.taps.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            started = time.monotonic()
+            success = self.process_desfire_authentication(card_uid)
+            self.stats.add_tap(arrived, started, time.monotonic(), bool(success))
+
+    def heartbeat_worker(self, stop: threading.Event):
+        # Spread heartbeats so the fleet does not beat in lockstep
+        if stop.wait(random.uniform(0, self.args.heartbeat_interval)):
+            return
+        while True:
+            self.send_heartbeat()
+            if stop.wait(self.args.heartbeat_interval):
+                return
+
+
+def build_fleet(args, stats: FleetStats) -> List[VirtualMachine]:
+    config_dir = tempfile.mkdtemp(prefix='urbanketl-fleet-')
+    machines = []
+    for index in range(args.machines):
+        machine_id = f"{args.machine_prefix}{index + 1:04d}"
+        config_file = os.path.join(config_dir, f"{machine_id}.json")
+        with open(config_file, 'w') as f:
+            json.dump({
+                'machine_id': machine_id,
+                'api_base_url': args.target,
+                'api_timeout': args.timeout,
+                'card_removal_delay': 0,
+                'push_enabled': False,
+                'dispense_journal_file': os.path.join(config_dir, f"{machine_id}-journal.jsonl")
+            }, f)
+        machines.append(VirtualMachine(config_file, stats, args))
+    return machines
+
+
+def load_cards(spec: Optional[str], count: int) -> List[str]:
+    """Card UIDs from a file or comma list; random UIDs if not given"""
+    if not spec:
+        return [os.urandom(7).hex().upper() for _ in range(count)]
+    if os.path.exists(spec):
+        with open(spec, 'r') as f:
+            return [line.strip().replace(':', '').upper() for line in f if line.strip()]
+    return [uid.strip().replace(':', '').upper() for uid in spec.split(',') if uid.strip()]
+
+
+def generate_arrivals(machines: List[VirtualMachine], cards: List[str], args, stop: threading.Event):
+    """Non-homogeneous Poisson arrivals by thinning at the peak rate"""
+    curve = PROFILES[args.profile]
+    started = time.monotonic()
+    while not stop.is_set():
+        elapsed = time.monotonic() - started
+        if elapsed >= args.duration:
+            return
+        if random.random() < curve(elapsed / args.duration):
+            machine = random.choice(machines)
+            machine.taps.put((time.monotonic(), random.choice(cards)))
+        stop.wait(random.expovariate(args.peak_rate))
+
+
+def summarize(stats: FleetStats, args, started: float) -> Dict[str, Any]:
+    with stats.lock:
+        requests = list(stats.requests)
+        taps = list(stats.taps)
+
+    endpoints = {}
+    for _, endpoint, latency, outcome in requests:
+        entry = endpoints.setdefault(endpoint, {'latencies': [], 'outcomes': {}})
+        entry['latencies'].append(latency * 1000)
+        entry['outcomes'][outcome] = entry['outcomes'].get(outcome, 0) + 1
+
+    endpoint_report = {}
+    for endpoint, entry in sorted(endpoints.items()):
+        total = len(entry['latencies'])
+        errors = sum(n for o, n in entry['outcomes'].items() if o not in ('ok', 'rejected'))
+        endpoint_report[endpoint] = {
+            'requests': total,
+            'p50Ms': percentile(entry['latencies'], 50),
+            'p95Ms': percentile(entry['latencies'], 95),
+            'p99Ms': percentile(entry['latencies'], 99),
+            'maxMs': percentile(entry['latencies'], 100),
+            'errorRate': round(errors / total, 4) if total else 0.0,
+            'outcomes': entry['outcomes']
+        }
+
+    # Per-window load vs latency to find where the server saturates
+    windows = {}
+    for at, _, latency, outcome in requests:
+        window = windows.setdefault(int((at - started) // args.window), {'latencies': [], 'errors': 0})
+        window['latencies'].append(latency * 1000)
+        if outcome not in ('ok', 'rejected'):
+            window['errors'] += 1
+
+    timeline = []
+    saturation = None
+    for index in sorted(windows):
+        window = windows[index]
+        rate = len(window['latencies']) / args.window
+        p95 = percentile(window['latencies'], 95)
+        error_rate = window['errors'] / len(window['latencies'])
+        timeline.append({'second': index * args.window, 'requestsPerSec': round(rate, 1),
+                         'p95Ms': p95, 'errorRate': round(error_rate, 4)})
+        if saturation is None and (p95 > args.slo_ms or error_rate > args.max_error_rate):
+            saturation = {'second': index * args.window, 'requestsPerSec': round(rate, 1),
+                          'p95Ms': p95, 'errorRate': round(error_rate, 4)}
+
+    waits = [wait * 1000 for _, wait, _, _ in taps]
+    durations = [duration * 1000 for _, _, duration, _ in taps]
+    return {
+        'target': args.target,
+        'machines': args.machines,
+        'profile': args.profile,
+        'durationSec': args.duration,
+        'taps': {
+            'completed': len(taps),
+            'succeeded': sum(1 for t in taps if t[3]),
+            'queueWaitP95Ms': percentile(waits, 95),
+            'tapP50Ms': percentile(durations, 50),
+            'tapP95Ms': percentile(durations, 95)
+        },
+        'endpoints': endpoint_report,
+        'saturation': saturation,
+        'timeline': timeline
+    }
+
+
+def print_report(report: Dict[str, Any], args):
+    taps = report['taps']
+    print(f"\n📊 Fleet simulation: {report['machines']} machines, {report['profile']}, {report['durationSec']}s")
+    print(f"   Taps: {taps['completed']} completed, {taps['succeeded']} dispensed, "
+          f"tap p50/p95 {taps['tapP50Ms']}/{taps['tapP95Ms']}ms, queue wait p95 {taps['queueWaitP95Ms']}ms")
+    print("")
+    print(f"   {'Endpoint':<48} {'Reqs':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'Err%':>6}")
+    for endpoint, entry in report['endpoints'].items():
+        print(f"   {endpoint:<48} {entry['requests']:>6} {entry['p50Ms']:>8} {entry['p95Ms']:>8} "
+              f"{entry['p99Ms']:>8} {entry['errorRate'] * 100:>5.1f}%")
+    print("")
+    if report['saturation']:
+        s = report['saturation']
+        print(f"⚠️  Saturated at {s['requestsPerSec']} req/s (t={s['second']}s): "
+              f"p95 {s['p95Ms']}ms, errors {s['errorRate'] * 100:.1f}%")
+    else:
+        print(f"✅ No saturation (p95 stayed under {args.slo_ms}ms, errors under {args.max_error_rate * 100:.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of UrbanKetl tea machines")
+    parser.add_argument('--target', default='http://localhost:5000', help="Server base URL")
+    parser.add_argument('--machines', type=int, default=50, help="Number of virtual machines")
+    parser.add_argument('--machine-prefix', default='UK_', help="Machine IDs are <prefix>0001, <prefix>0002, ...")
+    parser.add_argument('--cards', help="Card UIDs: file (one per line) or comma list; random if omitted")
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='morning_rush')
+    parser.add_argument('--duration', type=float, default=120, help="Length of the simulated window in seconds")
+    parser.add_argument('--peak-rate', type=float, default=10, help="Fleet-wide taps per second at the peak")
+    parser.add_argument('--dispense-time', type=float, default=3.0, help="Seconds a kiosk is busy pouring")
+    parser.add_argument('--apdu-latency', type=float, default=0.03, help="Simulated card response time")
+    parser.add_argument('--heartbeat-interval', type=float, default=60, help="Per-machine heartbeat (0 = off)")
+    parser.add_argument('--timeout', type=float, default=5, help="HTTP timeout per request")
+    parser.add_argument('--window', type=float, default=5, help="Seconds per timeline window")
+    parser.add_argument('--slo-ms', type=float, default=1000, help="p95 latency that counts as saturated")
+    parser.add_argument('--max-error-rate', type=float, default=0.01, help="Error rate that counts as saturated")
+    parser.add_argument('--json', help="Also write the full report to this file")
+    args = parser.parse_args()
+
+    # Rejected taps are expected under load and show up in the report instead
+    logging.basicConfig(level=logging.CRITICAL, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    stats = FleetStats()
+    machines = build_fleet(args, stats)
+    cards = load_cards(args.cards, max(args.machines * 5, 100))
+
+    print(f"🚀 Starting {len(machines)} virtual machines against {args.target} ({args.profile})")
+    stop = threading.Event()
+    threads = []
+    for machine in machines:
+        threads.append(threading.Thread(target=machine.worker, args=(stop,), daemon=True))
+        if args.heartbeat_interval > 0:
+            threads.append(threading.Thread(target=machine.heartbeat_worker, args=(stop,), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    started = time.monotonic()
+    try:
+        generate_arrivals(machines, cards, args, stop)
+        # Let queued taps drain (bounded so a dead server cannot hang the run)
+        drain_deadline = time.monotonic() + args.timeout * 3 + args.dispense_time
+        while any(not m.taps.empty() for m in machines) and time.monotonic() < drain_deadline:
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        print("\n⏹️  Interrupted - reporting partial results")
+    finally:
+        stop.set()
+
+    report = summarize(stats, args, started)
+    print_report(report, args)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"📝 Full report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
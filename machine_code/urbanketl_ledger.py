@@ -0,0 +1,233 @@
+"""
+UrbanKetl Tea Machine Controller - Dispense Ledger
+Write-ahead dispense journal and the balance cache behind optimistic
+dispensing
+"""
+
+import time
+import json
+import logging
+import threading
+import os
+from collections import deque
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Callable
+
+from urbanketl_common import percentile
+
+
+class DispenseJournal:
+    """
+    Write-ahead journal of dispense authorizations (JSON lines, fsynced)
+    
+    Each tap's idempotency key is journalled as "authorizing" before the
+    dispense call goes out, then "authorized" before the valve opens and
+    "dispensed" after it closes ("failed" / "unknown" when the call did not
+    succeed). Optimistic pours are journalled "queued" before the valve
+    opens and "poured" after it closes; only poured taps are charged.
+    After a crash or power loss, entries without a final state are what
+    the startup recovery pass reconciles.
+    """
+    
+    FINAL_STATES = ('dispensed', 'failed', 'reconciled', 'expired')
+    COMPACT_EVERY = 200  # Appends between rewrites that drop finished taps
+    
+    def __init__(self, get_config: Callable[[], Dict[str, Any]]):
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.appends = 0
+        self.fsync_ms = deque(maxlen=200)  # Rolling window for the status percentiles
+        self.load()
+    
+    def path(self) -> str:
+        return self.get_config().get('dispense_journal_file', 'dispense_journal.jsonl')
+    
+    def load(self):
+        """Read the journal, skipping a line torn by power loss, and drop finished taps"""
+        try:
+            with open(self.path(), 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries.setdefault(record['key'], {}).update(record)
+        except OSError:
+            pass
+        self.compact()
+        if self.entries:
+            self.logger.warning(f"📒 {len(self.entries)} unfinished dispense(s) in the journal")
+    
+    def append(self, key: str, state: str, **fields):
+        record = dict(fields, key=key, state=state, ts=datetime.now().isoformat(timespec='milliseconds'))
+        with self.lock:
+            self.entries.setdefault(key, {}).update(record)
+            started = time.perf_counter()
+            try:
+                with open(self.path(), 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                self.logger.error(f"❌ Dispense journal write failed: {e}")
+            self.fsync_ms.append((time.perf_counter() - started) * 1000)
+            if state in self.FINAL_STATES:
+                del self.entries[key]
+            
+            self.appends += 1
+            if self.appends >= self.COMPACT_EVERY:
+                self.appends = 0
+                self.compact()
+    
+    def compact(self):
+        """Rewrite the journal with only the unfinished entries"""
+        self.entries = {k: e for k, e in self.entries.items() if e.get('state') not in self.FINAL_STATES}
+        path = self.path()
+        try:
+            with open(path + '.tmp', 'w') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            self.logger.error(f"❌ Dispense journal compaction failed: {e}")
+    
+    def unfinished(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [dict(entry) for entry in self.entries.values()]
+    
+    def get_status(self) -> Dict[str, Any]:
+        samples = list(self.fsync_ms)
+        states = {}
+        for entry in self.unfinished():
+            states[entry['state']] = states.get(entry['state'], 0) + 1
+        return {
+            'unfinished': states,
+            'fsyncP50Ms': percentile(samples, 50),
+            'fsyncP95Ms': percentile(samples, 95)
+        }
+
+
+class BalanceCache:
+    """
+    Last known business-unit wallet balances for optimistic dispensing
+    
+    Balances come from validate (walletBalance) and dispense (newBalance)
+    responses, stamped with the time their request was sent. A balance
+    read before the unit's last settled debit is ignored: the debit is no
+    longer counted as pending, so that balance would overstate the
+    headroom. reserve() decides whether a tap may pour before its debit
+    has settled: the cached balance must be fresh, cover the tap on top of
+    everything still unsettled, and the unsettled amount must stay within
+    the per-card, per-unit and per-machine exposure limits. release()
+    returns the reservation when the debit settles; a conflict (declined
+    or unknown debit) also forgets the unit's balance, so its next tap
+    goes online.
+    """
+    
+    def __init__(self, get_config: Callable[[], Dict[str, Any]]):
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.units = {}  # businessUnitId -> {'balance', 'updatedAt', 'observedAt'}
+        self.unit_pending = {}
+        self.card_pending = {}
+        self.machine_pending = 0.0
+        self.released_at = {}  # businessUnitId -> monotonic time its last pending debit settled
+        self.stats = {'optimistic': 0, 'online': 0, 'settled': 0, 'conflicts': 0, 'staleBalances': 0,
+                      'declinedReasons': {}}
+    
+    def update(self, business_unit_id: str, balance: Any, observed_at: Optional[float] = None):
+        """Cache a server balance; observed_at is the time.monotonic() its request was sent"""
+        try:
+            balance = float(balance)
+        except (TypeError, ValueError):
+            return
+        if observed_at is None:
+            observed_at = time.monotonic()
+        with self.lock:
+            self.set_balance(business_unit_id, balance, observed_at)
+    
+    def set_balance(self, business_unit_id: str, balance: float, observed_at: float):
+        """Keep the balance unless it predates the cached one or a settled debit (caller holds the lock)"""
+        cached = self.units.get(business_unit_id)
+        if observed_at < self.released_at.get(business_unit_id, 0.0) or \
+                (cached is not None and observed_at < cached['observedAt']):
+            self.stats['staleBalances'] += 1
+            return
+        self.units[business_unit_id] = {'balance': balance, 'updatedAt': time.time(), 'observedAt': observed_at}
+    
+    def refusal(self, business_unit_id: str, card_number: str, amount: float) -> Optional[str]:
+        """Why this tap cannot pour optimistically, or None if it can (caller holds the lock)"""
+        config = self.get_config()
+        unit = self.units.get(business_unit_id)
+        if unit is None:
+            return 'noBalance'
+        if time.time() - unit['updatedAt'] > config.get('optimistic_balance_max_age', 3600):
+            return 'staleBalance'
+        if amount > config.get('optimistic_max_amount', 20):
+            return 'amount'
+        pending = self.unit_pending.get(business_unit_id, 0.0)
+        if unit['balance'] - pending - amount < config.get('optimistic_min_balance', 0):
+            return 'balance'
+        if self.card_pending.get(card_number, 0.0) + amount > config.get('optimistic_card_exposure', 20):
+            return 'cardExposure'
+        if pending + amount > config.get('optimistic_unit_exposure', 100):
+            return 'unitExposure'
+        if self.machine_pending + amount > config.get('optimistic_machine_exposure', 500):
+            return 'machineExposure'
+        return None
+    
+    def reserve(self, business_unit_id: str, card_number: str, amount: float) -> bool:
+        """Reserve exposure for an optimistic pour. False means authorize online first."""
+        with self.lock:
+            reason = self.refusal(business_unit_id, card_number, amount)
+            if reason:
+                self.stats['online'] += 1
+                self.stats['declinedReasons'][reason] = self.stats['declinedReasons'].get(reason, 0) + 1
+                return False
+            self.hold(business_unit_id, card_number, amount)
+            self.stats['optimistic'] += 1
+            return True
+    
+    def hold(self, business_unit_id: str, card_number: str, amount: float):
+        """Count an unsettled debit (also used for taps recovered from the journal)"""
+        self.unit_pending[business_unit_id] = self.unit_pending.get(business_unit_id, 0.0) + amount
+        self.card_pending[card_number] = self.card_pending.get(card_number, 0.0) + amount
+        self.machine_pending += amount
+    
+    def release(self, business_unit_id: str, card_number: str, amount: float,
+                new_balance: Any = None, conflict: bool = False):
+        with self.lock:
+            for pending, key in ((self.unit_pending, business_unit_id), (self.card_pending, card_number)):
+                remaining = pending.get(key, 0.0) - amount
+                if remaining > 0.005:
+                    pending[key] = remaining
+                else:
+                    pending.pop(key, None)
+            self.machine_pending = max(self.machine_pending - amount, 0.0)
+            self.stats['conflicts' if conflict else 'settled'] += 1
+            
+            # Balances read before now may not include this debit
+            now = time.monotonic()
+            self.released_at[business_unit_id] = now
+            if conflict:
+                self.units.pop(business_unit_id, None)
+            elif new_balance is not None:
+                try:
+                    self.set_balance(business_unit_id, float(new_balance), now)
+                except (TypeError, ValueError):
+                    pass
+    
+    def get_status(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(
+                self.stats,
+                declinedReasons=dict(self.stats['declinedReasons']),
+                cachedUnits=len(self.units),
+                unsettledAmount=round(self.machine_pending, 2),
+                unsettledCards=len(self.card_pending)
+            )
@@ -1,294 +1,290 @@
 #!/usr/bin/env python3
 """
 UrbanKetl Tea Machine Controller - Unified Reader Support
-Supports both ACR122U (USB/PC-SC) and MCRN2 (SPI/PN532) readers
+Supports ACR122U (USB/PC-SC), MCRN2 (SPI/PN532) and MFRC522 (SPI) readers
 Auto-detects which reader is available and uses it
 """
 
 import time
 import json
-import requests
 import logging
 import threading
+import uuid
 import binascii
-from datetime import datetime
-from typing import Optional, Dict, Any
+import copy
+import queue
+import re
+import signal
 import os
+from datetime import datetime
+from typing import Optional, Dict, Any, List
 
-# Try importing ACR122U (PC/SC) support
-try:
-    from smartcard.System import readers
-    from smartcard.util import toHexString, toBytes
-    ACR122U_AVAILABLE = True
-except ImportError:
-    ACR122U_AVAILABLE = False
-
-# Try importing MCRN2 (PN532) support
-try:
-    import board
-    import busio
-    from digitalio import DigitalInOut
-    from adafruit_pn532.spi import PN532_SPI
-    import RPi.GPIO as GPIO
-    MCRN2_AVAILABLE = True
-except ImportError:
-    MCRN2_AVAILABLE = False
-
-# Cryptography for DESFire
-try:
-    from Crypto.Cipher import AES
-    from Crypto.Util.Padding import pad, unpad
-    CRYPTO_AVAILABLE = True
-except ImportError:
-    CRYPTO_AVAILABLE = False
-
-
-class ReaderInterface:
-    """Abstract interface for RFID readers"""
-    
-    def initialize(self, config: Dict[str, Any]) -> bool:
-        """Initialize the reader hardware"""
-        raise NotImplementedError
-    
-    def read_uid(self, timeout: float = 0.05) -> Optional[bytes]:
-        """Read card UID. Returns None if no card present."""
-        raise NotImplementedError
-    
-    def send_apdu(self, apdu_command: list) -> Optional[bytes]:
-        """Send APDU command to card and return response"""
-        raise NotImplementedError
-    
-    def get_reader_name(self) -> str:
-        """Get reader type name"""
-        raise NotImplementedError
-
+# Subsystems live in sibling modules; everything is re-exported here for the
+# benchmarks, replay driver, fleet simulator, edge gateway and tests
+from urbanketl_common import (
+    percentile,
+    sd_notify,
+)
+from urbanketl_readers import (
+    ReaderInterface,
+    ACR122UReader,
+    MCRN2Reader,
+    MFRC522Reader,
+    ReaderSupervisor,
+    reader_drivers,
+    CardCapabilities,
+    ACR122U_AVAILABLE,
+    MCRN2_AVAILABLE,
+    MFRC522_AVAILABLE,
+)
+from urbanketl_dispenser import (
+    DispenseStats,
+    FlowMeter,
+    SimulatedFlowSensor,
+    Actuator,
+    GPIO_AVAILABLE,
+    PIGPIO_AVAILABLE,
+)
+from urbanketl_workers import (
+    start_child_process,
+    serve_call,
+    reader_process_main,
+    actuator_process_main,
+    WorkerProcess,
+    ProcessReader,
+    ProcessActuator,
+    TapWorker,
+)
+from urbanketl_diagnostics import (
+    LivenessMonitor,
+    TapRecorder,
+    Profiler,
+    MemoryMonitor,
+    StatusServer,
+    PSUTIL_AVAILABLE,
+)
+from urbanketl_api import (
+    WireCodec,
+    DnsCache,
+    request_never_sent,
+    acknowledged,
+    EndpointSelector,
+    ApiClient,
+    ConnectionWarmer,
+    PushChannel,
+    EventUploader,
+    CBOR_AVAILABLE,
+    MSGPACK_AVAILABLE,
+)
+from urbanketl_ledger import (
+    DispenseJournal,
+    BalanceCache,
+)
+from urbanketl_catalog import (
+    TeaPriceCache,
+    BeverageProfiles,
+    CardKeyStore,
+    CRYPTO_AVAILABLE,
+)
 
-class ACR122UReader(ReaderInterface):
-    """ACR122U reader implementation using PC/SC"""
-    
-    def __init__(self):
-        self.connection = None
-        self.reader = None
-        self.logger = logging.getLogger(__name__)
-        self.current_uid = None
-    
-    def initialize(self, config: Dict[str, Any]) -> bool:
-        """Initialize ACR122U via PC/SC"""
-        try:
-            # Get available readers
-            reader_list = readers()
-            
-            if not reader_list:
-                self.logger.error("❌ No PC/SC readers found")
-                return False
-            
-            # Find ACR122U or use first available reader
-            self.reader = None
-            for r in reader_list:
-                reader_name = str(r).upper()
-                if 'ACR122' in reader_name or 'ACS' in reader_name:
-                    self.reader = r
-                    break
-            
-            if not self.reader:
-                # Use first available reader
-                self.reader = reader_list[0]
-            
-            self.logger.info(f"✅ ACR122U reader found: {self.reader}")
-            return True
-            
-        except Exception as e:
-            self.logger.error(f"❌ Failed to initialize ACR122U: {e}")
-            return False
-    
-    def read_uid(self, timeout: float = 0.05) -> Optional[bytes]:
-        """Read card UID using PC/SC"""
-        try:
-            # Try to connect to card
-            if not self.connection:
-                try:
-                    self.connection = self.reader.createConnection()
-                    self.connection.connect()
-                except:
-                    self.connection = None
-                    self.current_uid = None
-                    return None
-            
-            # Get UID using standard APDU command
-            # Command: FF CA 00 00 00 (Get UID)
-            get_uid_apdu = [0xFF, 0xCA, 0x00, 0x00, 0x00]
-            
-            try:
-                data, sw1, sw2 = self.connection.transmit(get_uid_apdu)
-                
-                if sw1 == 0x90 and sw2 == 0x00:
-                    # Success - convert to bytes
-                    uid = bytes(data)
-                    self.current_uid = uid
-                    return uid
-                else:
-                    # No card or error
-                    self.connection = None
-                    self.current_uid = None
-                    return None
-                    
-            except Exception as e:
-                # Card removed or connection lost
-                self.connection = None
-                self.current_uid = None
-                return None
-                
-        except Exception as e:
-            self.logger.debug(f"Read UID error: {e}")
-            return None
-    
-    def send_apdu(self, apdu_command: list) -> Optional[bytes]:
-        """Send APDU command to card via PC/SC"""
-        try:
-            if not self.connection:
-                return None
-            
-            data, sw1, sw2 = self.connection.transmit(apdu_command)
-            
-            if sw1 == 0x90 and sw2 == 0x00:
-                return bytes(data)
-            else:
-                self.logger.error(f"❌ APDU error: SW={sw1:02X}{sw2:02X}")
-                return None
-                
-        except Exception as e:
-            self.logger.error(f"❌ APDU transmission error: {e}")
-            return None
-    
-    def get_reader_name(self) -> str:
-        return "ACR122U (USB/PC-SC)"
-
-
-class MCRN2Reader(ReaderInterface):
-    """MCRN2 reader implementation using PN532 SPI"""
-    
-    def __init__(self):
-        self.nfc_reader = None
-        self.logger = logging.getLogger(__name__)
-    
-    def initialize(self, config: Dict[str, Any]) -> bool:
-        """Initialize MCRN2 via SPI"""
-        try:
-            # Initialize SPI bus
-            spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
-            
-            # Get pin configuration
-            spi_pins = config.get('spi_pins', {})
-            cs_gpio = spi_pins.get('cs', 8)
-            reset_gpio = spi_pins.get('reset', 25)
-            
-            # Initialize CS and Reset pins
-            cs_pin = DigitalInOut(getattr(board, f'D{cs_gpio}'))
-            reset_pin = DigitalInOut(getattr(board, f'D{reset_gpio}'))
-            
-            # Initialize PN532 on SPI
-            self.nfc_reader = PN532_SPI(spi, cs_pin, reset=reset_pin, debug=False)
-            
-            # Configure SAM (Security Access Module)
-            self.nfc_reader.SAM_configuration()
-            
-            self.logger.info("✅ MCRN2 (PN532) reader initialized")
-            return True
-            
-        except Exception as e:
-            self.logger.error(f"❌ Failed to initialize MCRN2: {e}")
-            return False
-    
-    def read_uid(self, timeout: float = 0.05) -> Optional[bytes]:
-        """Read card UID using PN532"""
-        try:
-            if not self.nfc_reader:
-                return None
-            
-            # Read card UID with timeout in seconds
-            uid = self.nfc_reader.read_passive_target(timeout=timeout)
-            return uid
-            
-        except Exception as e:
-            self.logger.debug(f"Read UID error: {e}")
-            return None
-    
-    def send_apdu(self, apdu_command: list) -> Optional[bytes]:
-        """Send APDU command to card via PN532"""
-        try:
-            if not self.nfc_reader:
-                return None
-            
-            # Send APDU via PN532's InDataExchange
-            response = self.nfc_reader.in_data_exchange(apdu_command)
-            
-            if response and len(response) >= 1:
-                # PN532 prepends status byte (0x00 on success)
-                if response[0] == 0x00:
-                    # Skip PN532 status byte, return all DESFire data
-                    # This includes DESFire payload + status words (0x91xx)
-                    desfire_response = bytes(response[1:])
-                    
-                    # Log DESFire status if present
-                    if len(desfire_response) >= 2:
-                        sw1 = desfire_response[-2]
-                        sw2 = desfire_response[-1]
-                        if sw1 == 0x91:
-                            self.logger.debug(f"DESFire status: 91{sw2:02X}")
-                    
-                    return desfire_response
-                else:
-                    self.logger.error(f"❌ PN532 communication error: Status={response[0]:02X}")
-                    return None
-            else:
-                return None
-                
-        except Exception as e:
-            self.logger.error(f"❌ APDU transmission error: {e}")
-            return None
-    
-    def get_reader_name(self) -> str:
-        return "MCRN2 (SPI/PN532)"
+__all__ = [
+    'UrbanKetlUnifiedMachine',
+    'percentile',
+    'sd_notify',
+    'ReaderInterface',
+    'ACR122UReader',
+    'MCRN2Reader',
+    'MFRC522Reader',
+    'ReaderSupervisor',
+    'reader_drivers',
+    'CardCapabilities',
+    'ACR122U_AVAILABLE',
+    'MCRN2_AVAILABLE',
+    'MFRC522_AVAILABLE',
+    'DispenseStats',
+    'FlowMeter',
+    'SimulatedFlowSensor',
+    'Actuator',
+    'GPIO_AVAILABLE',
+    'PIGPIO_AVAILABLE',
+    'start_child_process',
+    'serve_call',
+    'reader_process_main',
+    'actuator_process_main',
+    'WorkerProcess',
+    'ProcessReader',
+    'ProcessActuator',
+    'TapWorker',
+    'LivenessMonitor',
+    'TapRecorder',
+    'Profiler',
+    'MemoryMonitor',
+    'StatusServer',
+    'PSUTIL_AVAILABLE',
+    'WireCodec',
+    'DnsCache',
+    'request_never_sent',
+    'acknowledged',
+    'EndpointSelector',
+    'ApiClient',
+    'ConnectionWarmer',
+    'PushChannel',
+    'EventUploader',
+    'CBOR_AVAILABLE',
+    'MSGPACK_AVAILABLE',
+    'DispenseJournal',
+    'BalanceCache',
+    'TeaPriceCache',
+    'BeverageProfiles',
+    'CardKeyStore',
+    'CRYPTO_AVAILABLE',
+]
 
 
 class UrbanKetlUnifiedMachine:
     """Unified tea machine controller supporting multiple reader types"""
     
-    def __init__(self, config_file="machine_config.json"):
-        """Initialize the tea machine with auto-detection"""
+    # Keys the server may change (heartbeat config / push). Identity, endpoints,
+    # the status API, file paths, secrets and pins only come from the config file.
+    REMOTE_CONFIG_KEYS = frozenset({
+        'tea_price', 'dispense_time', 'polling_interval', 'card_removal_delay', 'api_timeout',
+        'api_hedging', 'api_hedge_budget', 'api_hedge_delay', 'api_hedge_min_delay',
+        'api_endpoint_down_after', 'api_endpoint_down_for', 'api_endpoint_probe_interval',
+        'keepalive_interval', 'prewarm_idle', 'wire_format', 'heartbeat_interval', 'price_ttl',
+        'push_wait', 'push_max_backoff', 'push_heartbeat_interval',
+        'events_enabled', 'events_batch_size', 'events_max_age', 'events_bulk_recheck',
+        'trace_recording', 'memory_top_types', 'memory_warn_mb',
+        'server_idempotency', 'dispense_attempts', 'dispense_attempt_timeout',
+        'journal_recovery_interval', 'optimistic_dispensing', 'optimistic_max_amount',
+        'optimistic_card_exposure', 'optimistic_unit_exposure', 'optimistic_machine_exposure',
+        'optimistic_balance_max_age', 'optimistic_min_balance', 'settlement_retry_interval',
+        'card_detection', 'desfire_auth_commands', 'auth_mode', 'local_auth_refresh',
+        'beverage_default', 'beverage_select_timeout', 'beverage_ttl',
+        'dispense_mode', 'dispense_volume_ml', 'flow_pulses_per_ml', 'flow_timeout', 'flow_settle'
+    })
+    
+    def __init__(self, config_file="machine_config.json",
+                 reader: Optional[ReaderInterface] = None, api: Optional[ApiClient] = None):
+        """Initialize the tea machine with auto-detection
+        
+        reader and api replace the detected reader and the HTTP client
+        (used by the replay driver and simulators).
+        """
         
         # Load configuration
+        self.config_file = config_file
         self.config = self.load_config(config_file)
         
         # Setup logging
         self.setup_logging()
         
+        # Refuse to start on a config a reload would have rejected
+        errors = self.validate_config(self.config)
+        if errors:
+            for error in errors:
+                self.logger.error(f"❌ {config_file}: {error}")
+            raise ValueError(f"invalid configuration in {config_file}: {'; '.join(errors)}")
+        
+        # Hot reload state (see reload_config)
+        self.config_overrides = {}
+        self.config_lock = threading.RLock()
+        self.dispense_lock = threading.Lock()
+        self.config_mtime = self.get_config_mtime()
+        self.reload_requested = False
+        self.shutdown_requested = False
+        
         # API settings
         self.api_base = self.config.get('api_base_url', 'https://your-domain.replit.app')
         self.machine_id = self.config.get('machine_id', 'UK_0001')
         
+        # Server API client (with tap trace recording) and cached tea price
+        self.recorder = TapRecorder(lambda: self.config)
+        self.api = api or ApiClient(lambda: self.config)
+        self.api.recorder = self.recorder
+        self.price_cache = TeaPriceCache(self.api, lambda: self.config)
+        self.beverages = BeverageProfiles(self.api, lambda: self.config)
+        self.journal = DispenseJournal(lambda: self.config)
+        self.card_keys = CardKeyStore(self.api, lambda: self.config)
+        self.balances = BalanceCache(lambda: self.config)
+        self.card_capabilities = CardCapabilities(lambda: self.config)
+        self.settlements = queue.Queue()
+        self.settling = set()  # Idempotency keys queued for settlement
+        self.events = EventUploader(self.api, lambda: self.config)
+        self.warmer = ConnectionWarmer(self.api, self.price_cache.refresh, lambda: self.config)
+        self.profiler = Profiler(lambda: self.config)
+        self.memory = MemoryMonitor(lambda: self.config)
+        
+        # Server push channel and the commands it can deliver
+        self.push_channel = PushChannel(self.api, lambda: self.config, {
+            'config': lambda payload: self.apply_config_update(payload, "push"),
+            'refresh_price': lambda payload: self.price_cache.refresh_now(),
+            'refresh_profiles': lambda payload: self.beverages.refresh_now(),
+            'refresh_card_keys': lambda payload: self.card_keys.refresh_now(),
+            'disable': lambda payload: self.set_enabled(False, payload.get('reason')),
+            'enable': lambda payload: self.set_enabled(True),
+            'block_card': lambda payload: self.block_card(payload['cardUid'], True),
+            'unblock_card': lambda payload: self.block_card(payload['cardUid'], False),
+            'diagnostics': lambda payload: self.send_diagnostics(),
+            'reinit_reader': lambda payload: self.reinit_reader(),
+            'profile_start': lambda payload: self.profiler.start(payload.get('mode'), payload.get('duration')),
+            'profile_stop': lambda payload: self.profiler.stop(),
+            'stack_dump': lambda payload: self.profiler.dump_stacks(),
+            'tracemalloc_start': lambda payload: self.memory.start_tracing(payload.get('frames')),
+            'tracemalloc_snapshot': lambda payload: self.send_memory_diff(),
+            'tracemalloc_stop': lambda payload: self.memory.stop_tracing(),
+            'ping': lambda payload: None
+        })
+        
+        # Per-thread liveness for the systemd watchdog
+        self.liveness = LivenessMonitor()
+        
+        # Tap worker thread (started with polling)
+        self.tap_worker = TapWorker(self.run_tap, self.liveness)
+        self.tap_local = threading.local()  # Liveness entry of the tap running on this thread
+        
+        # Local status/control API for technicians
+        self.started_at = time.monotonic()
+        self.status_server = StatusServer(lambda: self.config, {
+            '/status': lambda params: self.get_status_report(),
+            '/taps': lambda params: self.recorder.get_recent(int(params.get('limit', 20)))
+        }, {
+            '/actions/test-dispense': lambda params: self.test_dispense(),
+            '/actions/reinit-reader': lambda params: self.reinit_reader(),
+            '/actions/select-beverage': lambda params: self.beverages.select(params['id']),
+            '/actions/profile/start': lambda params: self.profiler.start(
+                params.get('mode'), float(params['duration']) if 'duration' in params else None),
+            '/actions/profile/stop': lambda params: self.profiler.stop() or False,
+            '/actions/stack-dump': lambda params: self.profiler.dump_stacks() or False
+        })
+        
         # Machine status
         self.is_online = True
+        self.machine_enabled = True
+        self.blocked_cards = set()
         self.polling_active = False
         self.current_card_uid = None
         self.processing_card = False
+        self.tap_lock = threading.Lock()  # Poller and test dispense check-and-set processing_card under it
         
         # Statistics
         self.daily_dispensed = 0
         self.total_dispensed = 0
         self.auth_failures = 0
         
-        # Reader interface
-        self.reader = None
+        # Reader interface and GPIO (child processes in process_mode "processes")
+        self.reader = reader
+        self.actuator = Actuator(lambda: self.config)
+        self.dispense_stats = DispenseStats()
+        self.workers = []
         
         # Initialize hardware
         self.setup_hardware()
         
         self.logger.info(f"✅ UrbanKetl Unified Machine {self.machine_id} initialized")
 
-    def load_config(self, config_file: str) -> Dict[str, Any]:
-        """Load machine configuration from JSON file"""
-        default_config = {
+    def get_default_config(self) -> Dict[str, Any]:
+        """Default machine configuration"""
+        return {
             "machine_id": "UK_0001",
             "api_base_url": "https://your-domain.replit.app",
             "tea_price": 5.0,
@@ -296,7 +292,98 @@ class UrbanKetlUnifiedMachine:
             "polling_interval": 0.05,
             "card_removal_delay": 0.5,
             "api_timeout": 5,
-            "reader_type": "auto",  # "auto", "acr122u", or "mcrn2"
+            "api_endpoints": [],  # Base URLs to choose between (empty = api_base_url only)
+            "api_hedging": True,  # Duplicate slow heartbeat calls to the next endpoint
+            "api_hedge_budget": 0.1,  # Hedges allowed per eligible call
+            "api_hedge_delay": 1.0,  # Hedge delay until an endpoint has 20 latency samples
+            "api_hedge_min_delay": 0.05,
+            "api_endpoint_down_after": 3,  # Failures in a row before an endpoint is skipped
+            "api_endpoint_down_for": 30,
+            "api_endpoint_probe_interval": 60,  # Heartbeats re-measure endpoints idle this long
+            "dns_ttl": 300,  # Seconds an API host lookup is reused
+            "dns_stale_max": 86400,  # Use an expired lookup up to this old if DNS fails
+            "keepalive_interval": 45,  # Idle seconds before a keep-alive probe (0 = off)
+            "prewarm_idle": 20,  # Idle seconds after which a card detect starts warming the connection
+            "wire_format": "json",  # "json", "msgpack" or "cbor" for auth and heartbeat calls
+            "heartbeat_interval": 60,
+            "price_ttl": 120,  # Seconds between tea price refreshes
+            "push_enabled": True,  # Long-poll /api/machine/commands
+            "push_wait": 25,  # Seconds the server may hold a poll open
+            "push_max_backoff": 300,
+            "push_heartbeat_interval": 300,  # Heartbeat interval while push is connected
+            "poll_stall_timeout": 10,  # Seconds the poll loop may go without progress
+            "tap_stall_timeout": 60,  # Seconds a tap may go without progress (the pour gets its own time on top)
+            "trace_recording": False,  # Record tap traces for urbanketl_replay.py
+            "trace_file": "tap_traces.jsonl",
+            "trace_max_bytes": 5000000,  # Rotate the trace file above this size
+            "reader_error_threshold": 5,  # Consecutive read errors before failing over
+            "reader_health_interval": 5,  # Seconds between reader presence checks
+            "reader_retry_max": 60,  # Max backoff between reader re-initialisations
+            "config_watch_interval": 5,  # Seconds between config file checks (0 = off)
+            "events_enabled": True,  # Batched tap event upload to /api/machine/events/bulk
+            "events_batch_size": 50,  # Upload when this many events are buffered...
+            "events_max_age": 60,  # ...or the oldest is this many seconds old
+            "events_spool_dir": "event_spool",  # Undelivered batches wait here
+            "events_spool_max_bytes": 20000000,  # Oldest spooled batches are dropped above this
+            "events_bulk_recheck": 600,  # Seconds between bulk endpoint checks while it answers 404/405
+            "status_enabled": True,  # Local status/control API (applied at startup)
+            "status_host": "127.0.0.1",
+            "status_port": 8088,
+            "status_token": None,  # Required as X-Status-Token on actions when set
+            "profile_dir": "profiles",  # CPU profiles and stack dumps
+            "profile_mode": "sampling",  # "sampling" (all threads) or "deterministic" (taps, cProfile)
+            "profile_interval": 0.005,  # Seconds between stack samples
+            "profile_max_seconds": 300,  # Profiler stops on its own after this long
+            "memory_top_types": 10,  # Most common object types in the heartbeat (0 = off)
+            "memory_warn_mb": 200,  # Log a warning above this RSS (MemoryLimit is 256M)
+            "tracemalloc_frames": 10,  # Stack depth recorded per allocation
+            "tracemalloc_top": 20,  # Entries reported per snapshot diff
+            "tracemalloc_max_seconds": 3600,  # tracemalloc stops on its own after this long
+            "server_idempotency": False,  # Server honours Idempotency-Key on dispense (enables timeout retries)
+            "dispense_attempts": 3,
+            "dispense_attempt_timeout": 2,  # Per-attempt timeout when server_idempotency is on
+            "dispense_journal_file": "dispense_journal.jsonl",
+            "journal_recovery_interval": 300,  # Seconds between recovery passes while taps are unresolved
+            "journal_max_age": 604800,  # Unresolved taps are reported as expired after this long
+            "optimistic_dispensing": False,  # Pour on cached balance without waiting for the dispense call; settle the debit in the background
+            "optimistic_max_amount": 20,  # Largest tap poured before its debit settles
+            "optimistic_card_exposure": 20,  # Unsettled amount allowed per card
+            "optimistic_unit_exposure": 100,  # Unsettled amount allowed per business unit
+            "optimistic_machine_exposure": 500,  # Unsettled amount allowed across the machine
+            "optimistic_balance_max_age": 3600,  # Cached balances older than this go online
+            "optimistic_min_balance": 0,  # Balance left after unsettled debits and this tap
+            "settlement_retry_interval": 10,
+            "card_detection": True,  # Read the DESFire generation (GetVersion) once per UID
+            "card_capability_cache_size": 1024,
+            "desfire_auth_commands": {},  # Auth INS per generation, e.g. {"EV1": "AA"} (defaults EV1 1A, EV2/EV3 AA)
+            "auth_mode": "server",  # "local" authenticates provisioned cards on the Pi (needs pycryptodome and /card-keys on the server)
+            "card_key_store_file": "card_keys.bin",
+            "card_key_secret_file": "card_keys.secret",  # Device secret encrypting the key store (0600)
+            "local_auth_refresh": 300,  # Seconds between key store refreshes
+            "local_auth_max_age": 86400,  # Stop trusting a key store not refreshed for this long
+            "local_auth_cache_size": 256,  # Cards whose expanded AES key schedule is kept
+            "beverage_profiles": [],  # Used until the server provides profiles
+            "beverage_default": None,  # Profile id poured when no button was pressed
+            "beverage_buttons": {},  # {profile id: BCM pin} selection buttons (applied at startup)
+            "beverage_select_timeout": 30,  # Seconds a button selection waits for a tap
+            "beverage_ttl": 300,  # Seconds between profile refreshes
+            "beverage_cache_file": "beverage_profiles.json",
+            "reader_type": "auto",  # "auto", "acr122u", "mcrn2" or "mfrc522"
+            "mfrc522_spi_hz": 4000000,  # MFRC522 SPI clock (chip maximum 10 MHz)
+            "mfrc522_presence_misses": 2,  # Unanswered WUPAs before a held card counts as removed
+            "dispense_mode": "time",  # "time" (dispense_time) or "volume" (flow sensor on gpio_pins.flow_sensor)
+            "dispense_volume_ml": 150,
+            "flow_pulses_per_ml": 0.45,  # YF-S201: 450 pulses per litre
+            "flow_timeout": 15,  # Valve closes after this many seconds whatever the count
+            "flow_settle": 0.3,  # Seconds after closing that trailing pulses still count
+            "flow_simulated_ml_per_sec": 25,  # Simulated flow when running without GPIO
+            "dispense_timing": "auto",  # "auto" (pigpio wave if pigpiod runs), "pigpio" or "sleep"
+            "dispense_spin_ms": 2,  # Busy-wait the last ms of a sleep-timed pour
+            "process_mode": "threads",  # "threads" or "processes" (reader and GPIO in child processes, at startup)
+            "process_call_timeout": 5,  # Seconds a child may take to answer before it is restarted
+            "process_ping_interval": 5,  # Idle seconds between child liveness pings
+            "process_restart_max": 30,  # Max backoff between child restarts
+            "process_start_timeout": 30,  # Seconds to wait for the reader process at startup
             "gpio_pins": {
                 "dispenser": 18
             },
@@ -305,6 +392,10 @@ class UrbanKetlUnifiedMachine:
                 "reset": 25
             }
         }
+
+    def load_config(self, config_file: str) -> Dict[str, Any]:
+        """Load machine configuration from JSON file"""
+        default_config = self.get_default_config()
         
         try:
             if os.path.exists(config_file):
@@ -322,6 +413,308 @@ class UrbanKetlUnifiedMachine:
             print(f"❌ Error loading config: {e}")
             return default_config
 
+    def validate_config(self, config: Dict[str, Any]) -> List[str]:
+        """Check a configuration before it is applied. Returns a list of errors."""
+        errors = []
+        
+        def check_number(key, minimum, maximum):
+            value = config.get(key)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                errors.append(f"{key} must be a number")
+            elif not minimum <= value <= maximum:
+                errors.append(f"{key} must be between {minimum} and {maximum}")
+        
+        check_number('tea_price', 0.01, 10000)
+        check_number('dispense_time', 0.1, 60)
+        check_number('polling_interval', 0.01, 5)
+        check_number('card_removal_delay', 0, 30)
+        check_number('api_timeout', 0.5, 60)
+        check_number('api_hedge_budget', 0, 1)
+        check_number('api_hedge_delay', 0.01, 60)
+        check_number('api_hedge_min_delay', 0.001, 10)
+        check_number('api_endpoint_down_after', 1, 100)
+        check_number('api_endpoint_down_for', 1, 3600)
+        check_number('api_endpoint_probe_interval', 5, 3600)
+        check_number('heartbeat_interval', 5, 3600)
+        check_number('dns_ttl', 0, 86400)
+        check_number('dns_stale_max', 0, 604800)
+        check_number('keepalive_interval', 0, 3600)
+        check_number('prewarm_idle', 0, 3600)
+        check_number('price_ttl', 10, 86400)
+        check_number('push_wait', 1, 120)
+        check_number('push_max_backoff', 1, 3600)
+        check_number('push_heartbeat_interval', 5, 3600)
+        check_number('poll_stall_timeout', 2, 600)
+        check_number('tap_stall_timeout', 10, 600)
+        check_number('reader_error_threshold', 1, 1000)
+        check_number('reader_health_interval', 1, 3600)
+        check_number('reader_retry_max', 1, 3600)
+        check_number('config_watch_interval', 0, 3600)
+        check_number('status_port', 1, 65535)
+        check_number('events_batch_size', 1, 10000)
+        check_number('events_max_age', 1, 3600)
+        check_number('events_spool_max_bytes', 100000, 1000000000)
+        check_number('events_bulk_recheck', 10, 86400)
+        check_number('profile_interval', 0.001, 1)
+        check_number('profile_max_seconds', 1, 3600)
+        check_number('memory_top_types', 0, 100)
+        check_number('memory_warn_mb', 16, 4096)
+        check_number('tracemalloc_frames', 1, 100)
+        check_number('tracemalloc_top', 1, 200)
+        check_number('tracemalloc_max_seconds', 10, 86400)
+        check_number('dispense_attempts', 1, 10)
+        check_number('dispense_attempt_timeout', 0.5, 60)
+        check_number('journal_recovery_interval', 10, 86400)
+        check_number('journal_max_age', 3600, 31536000)
+        check_number('optimistic_max_amount', 0, 10000)
+        check_number('optimistic_card_exposure', 0, 100000)
+        check_number('optimistic_unit_exposure', 0, 1000000)
+        check_number('optimistic_machine_exposure', 0, 1000000)
+        check_number('optimistic_balance_max_age', 10, 604800)
+        check_number('optimistic_min_balance', -100000, 100000)
+        check_number('settlement_retry_interval', 1, 3600)
+        check_number('card_capability_cache_size', 1, 100000)
+        check_number('mfrc522_spi_hz', 100000, 10000000)
+        check_number('mfrc522_presence_misses', 1, 20)
+        check_number('local_auth_refresh', 10, 86400)
+        check_number('local_auth_max_age', 300, 2592000)
+        check_number('local_auth_cache_size', 1, 100000)
+        check_number('beverage_select_timeout', 1, 600)
+        check_number('beverage_ttl', 10, 86400)
+        check_number('dispense_spin_ms', 0, 50)
+        check_number('dispense_volume_ml', 10, 2000)
+        check_number('flow_pulses_per_ml', 0.01, 100)
+        check_number('flow_timeout', 1, 120)
+        check_number('flow_settle', 0, 5)
+        check_number('flow_simulated_ml_per_sec', 1, 500)
+        check_number('process_call_timeout', 0.5, 60)
+        check_number('process_ping_interval', 1, 3600)
+        check_number('process_restart_max', 1, 3600)
+        check_number('process_start_timeout', 1, 300)
+        
+        # A tap beats its liveness entry between steps; the longest step is one server
+        # call failing over across every endpoint, or the card_removal_delay wait
+        timings = [config.get(key) for key in ('tap_stall_timeout', 'api_timeout', 'card_removal_delay')]
+        if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in timings):
+            endpoints = config.get('api_endpoints') if isinstance(config.get('api_endpoints'), list) else []
+            longest_step = max(config['api_timeout'] * max(1, len(endpoints)), config['card_removal_delay'] + 1)
+            if config['tap_stall_timeout'] <= longest_step:
+                errors.append(f"tap_stall_timeout must be longer than {longest_step:g}s "
+                              f"(api_timeout for each endpoint, or card_removal_delay + 1)")
+        
+        if not isinstance(config.get('machine_id'), str) or not config.get('machine_id'):
+            errors.append("machine_id must be a non-empty string")
+        
+        api_base_url = config.get('api_base_url')
+        if not isinstance(api_base_url, str) or not api_base_url.startswith(('http://', 'https://')):
+            errors.append("api_base_url must start with http:// or https://")
+        
+        api_endpoints = config.get('api_endpoints', [])
+        if not isinstance(api_endpoints, list) or not all(
+                isinstance(url, str) and url.startswith(('http://', 'https://')) for url in api_endpoints):
+            errors.append("api_endpoints must be a list of http:// or https:// URLs")
+        
+        if config.get('reader_type') not in ('auto', 'acr122u', 'mcrn2', 'mfrc522'):
+            errors.append("reader_type must be 'auto', 'acr122u', 'mcrn2' or 'mfrc522'")
+        
+        if not isinstance(config.get('status_host'), str) or not config.get('status_host'):
+            errors.append("status_host must be a non-empty string")
+        
+        if config.get('status_token') is not None and not isinstance(config.get('status_token'), str):
+            errors.append("status_token must be a string or null")
+        elif config.get('status_enabled', True) and isinstance(config.get('status_host'), str) and \
+                not StatusServer.is_loopback(config['status_host']) and not config.get('status_token'):
+            errors.append("status_host other than localhost needs a status_token")
+        
+        if config.get('wire_format') not in ('json', 'msgpack', 'cbor'):
+            errors.append("wire_format must be 'json', 'msgpack' or 'cbor'")
+        
+        
+        try:
+            BeverageProfiles.validate(config.get('beverage_profiles'))
+        except (ValueError, TypeError, AttributeError) as e:
+            errors.append(f"beverage_profiles: {e}")
+        
+        buttons = config.get('beverage_buttons')
+        if not isinstance(buttons, dict) or any(
+                isinstance(pin, bool) or not isinstance(pin, int) or not 0 <= pin <= 27 for pin in buttons.values()):
+            errors.append("beverage_buttons must map profile ids to BCM pin numbers (0-27)")
+        else:
+            if len(set(buttons.values())) != len(buttons):
+                errors.append("beverage_buttons must not reuse the same pin")
+            for group in ('gpio_pins', 'spi_pins'):
+                pins = config.get(group)
+                if not isinstance(pins, dict):
+                    continue
+                for profile_id, pin in buttons.items():
+                    clashes = [name for name, used in pins.items() if used == pin]
+                    if clashes:
+                        errors.append(f"beverage_buttons.{profile_id} uses GPIO{pin}, already {group}.{clashes[0]}")
+        
+        if config.get('dispense_mode') not in ('time', 'volume'):
+            errors.append("dispense_mode must be 'time' or 'volume'")
+        elif config.get('dispense_mode') == 'volume' and 'flow_sensor' not in (config.get('gpio_pins') or {}):
+            errors.append("dispense_mode volume needs gpio_pins.flow_sensor")
+        
+        auth_commands = config.get('desfire_auth_commands')
+        if not isinstance(auth_commands, dict) or any(
+                generation not in CardCapabilities.AUTH_COMMANDS or not re.fullmatch(r'[0-9A-Fa-f]{2}', str(command))
+                for generation, command in auth_commands.items()):
+            errors.append("desfire_auth_commands must map EV1/EV2/EV3 to a hex INS byte such as \"AA\"")
+        
+        if config.get('auth_mode') not in ('server', 'local'):
+            errors.append("auth_mode must be 'server' or 'local'")
+        elif config.get('auth_mode') == 'local' and not CRYPTO_AVAILABLE:
+            errors.append("auth_mode local needs pycryptodome")
+        
+        if config.get('dispense_timing') not in ('auto', 'pigpio', 'sleep'):
+            errors.append("dispense_timing must be 'auto', 'pigpio' or 'sleep'")
+        
+        if config.get('process_mode') not in ('threads', 'processes'):
+            errors.append("process_mode must be 'threads' or 'processes'")
+        
+        if config.get('profile_mode') not in ('sampling', 'deterministic'):
+            errors.append("profile_mode must be 'sampling' or 'deterministic'")
+        
+        for group in ('gpio_pins', 'spi_pins'):
+            pins = config.get(group)
+            if not isinstance(pins, dict):
+                errors.append(f"{group} must be an object")
+                continue
+            for name, pin in pins.items():
+                if isinstance(pin, bool) or not isinstance(pin, int) or not 0 <= pin <= 27:
+                    errors.append(f"{group}.{name} must be a BCM pin number (0-27)")
+        
+        gpio_pins = config.get('gpio_pins')
+        if isinstance(gpio_pins, dict):
+            if 'dispenser' not in gpio_pins:
+                errors.append("gpio_pins.dispenser is required")
+            if len(set(gpio_pins.values())) != len(gpio_pins):
+                errors.append("gpio_pins must not reuse the same pin")
+        
+        return errors
+
+    def get_config_mtime(self) -> Optional[float]:
+        """Modification time of the config file, or None if it is missing"""
+        try:
+            return os.path.getmtime(self.config_file)
+        except OSError:
+            return None
+
+    def request_config_reload(self, signum=None, frame=None):
+        """SIGHUP handler - the reload itself runs on the main loop"""
+        self.reload_requested = True
+
+    def check_config_file(self):
+        """Reload the config if SIGHUP was received or the file changed on disk"""
+        mtime = self.get_config_mtime()
+        
+        if self.reload_requested:
+            self.reload_requested = False
+            self.config_mtime = mtime
+            self.reload_config("SIGHUP")
+        elif mtime is not None and mtime != self.config_mtime:
+            self.config_mtime = mtime
+            self.reload_config("file change")
+
+    def reload_config(self, source: str = "manual") -> bool:
+        """Re-read the config file and apply it to the running machine"""
+        try:
+            with open(self.config_file, 'r') as f:
+                file_config = json.load(f)
+        except Exception as e:
+            self.logger.error(f"❌ Config reload ({source}) failed, keeping current config: {e}")
+            return False
+        
+        if not isinstance(file_config, dict):
+            self.logger.error(f"❌ Config reload ({source}) failed: top level must be an object")
+            return False
+        
+        return self.apply_config(self.merge_config(file_config), source)
+
+    def merge_config(self, file_config: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Config after a file reload: defaults, then the file, then the
+        values pushed by the server since startup (REMOTE_CONFIG_KEYS only).
+        A pushed value keeps winning over the file until the restart.
+        """
+        new_config = self.get_default_config()
+        new_config.update(file_config)
+        
+        shadowed = sorted(key for key, value in self.config_overrides.items()
+                          if key in file_config and file_config[key] != value)
+        if shadowed:
+            self.logger.info(f"📡 Server-pushed values kept over the file: {', '.join(shadowed)}")
+        new_config.update(self.config_overrides)
+        return new_config
+
+    def apply_config_update(self, updates: Dict[str, Any], source: str = "server") -> bool:
+        """Apply a partial config pushed by the server on top of the current config"""
+        if not isinstance(updates, dict) or not updates:
+            return False
+        
+        ignored = sorted(key for key in updates if key not in self.REMOTE_CONFIG_KEYS)
+        if ignored:
+            self.logger.warning(f"⚠️  Ignoring keys that cannot be set from {source}: {', '.join(ignored)}")
+        updates = {key: value for key, value in updates.items() if key in self.REMOTE_CONFIG_KEYS}
+        if not updates:
+            return False
+        
+        new_config = copy.deepcopy(self.config)
+        new_config.update(updates)
+        
+        if not self.apply_config(new_config, source):
+            return False
+        
+        # Keep pushed values across later file reloads
+        self.config_overrides.update(updates)
+        return True
+
+    def apply_config(self, new_config: Dict[str, Any], source: str) -> bool:
+        """
+        Validate and atomically swap in a new configuration
+        
+        Components read self.config when they need a value, so replacing the
+        dict is enough for polling interval, timeouts, price and dispense time.
+        GPIO pins are re-initialised under dispense_lock so a cup that is
+        being poured finishes on the pins it started with.
+        """
+        errors = self.validate_config(new_config)
+        if errors:
+            self.logger.error(f"❌ Rejected config from {source}: {'; '.join(errors)}")
+            return False
+        
+        with self.config_lock:
+            old_config = self.config
+            changed = sorted(
+                key for key in set(old_config) | set(new_config)
+                if old_config.get(key) != new_config.get(key)
+            )
+            
+            if not changed:
+                self.logger.debug(f"Config from {source} unchanged")
+                return True
+            
+            if 'gpio_pins' in changed:
+                with self.dispense_lock:
+                    self.config = new_config
+                    self.setup_gpio(old_config.get('gpio_pins'))
+            else:
+                self.config = new_config
+            
+            self.api_base = new_config['api_base_url']
+            self.machine_id = new_config['machine_id']
+            
+            if isinstance(self.reader, ProcessReader):
+                self.reader.configure(new_config)
+        
+        self.logger.info(f"🔄 Config reloaded from {source}: {', '.join(changed)}")
+        
+        if any(key in ('reader_type', 'spi_pins') or key.startswith('mfrc522_') for key in changed):
+            self.logger.warning("⚠️  reader_type/spi_pins/mfrc522_* changes take effect after restart")
+        
+        return True
+
     def setup_logging(self):
         """Setup logging configuration"""
         logging.basicConfig(
@@ -337,78 +730,50 @@ class UrbanKetlUnifiedMachine:
     def setup_hardware(self):
         """Initialize hardware with auto-detection"""
         
+        if self.reader is not None:
+            self.logger.info(f"✅ Using {self.reader.get_reader_name()}")
+            self.setup_gpio()
+            return
+        
+        if self.config.get('process_mode') == 'processes':
+            self.setup_processes()
+            return
+        
         # Auto-detect or use configured reader type
         reader_type = self.config.get('reader_type', 'auto')
         
         self.logger.info("🔍 Detecting RFID reader...")
         
-        # Try readers based on configuration
-        if reader_type == 'auto':
-            # Try ACR122U first (USB is more common)
-            if ACR122U_AVAILABLE and self.try_acr122u():
-                pass  # Success
-            elif MCRN2_AVAILABLE and self.try_mcrn2():
-                pass  # Success
+        drivers = reader_drivers(reader_type, self.logger)
+        if drivers:
+            # Supervisor keeps rescanning if no reader is attached yet
+            self.reader = ReaderSupervisor(drivers, lambda: self.config)
+            if self.reader.initialize(self.config):
+                self.logger.info(f"✅ Using {self.reader.get_reader_name()}")
             else:
-                self.logger.warning("⚠️  No readers available - running in simulation mode")
-        
-        elif reader_type == 'acr122u':
-            if ACR122U_AVAILABLE:
-                self.try_acr122u()
-            else:
-                self.logger.error("❌ ACR122U libraries not installed")
-        
-        elif reader_type == 'mcrn2':
-            if MCRN2_AVAILABLE:
-                self.try_mcrn2()
-            else:
-                self.logger.error("❌ MCRN2 libraries not installed")
+                self.logger.warning("⚠️  No reader attached yet - will keep scanning")
+        else:
+            self.logger.warning("⚠️  No readers available - running in simulation mode")
         
         # Initialize GPIO for dispenser and optional components
-        if MCRN2_AVAILABLE:  # GPIO only available on Raspberry Pi
-            try:
-                pins = self.config['gpio_pins']
-                GPIO.setup(pins['dispenser'], GPIO.OUT)
-                GPIO.output(pins['dispenser'], GPIO.LOW)
-                
-                # Initialize optional pins
-                if 'led_green' in pins:
-                    GPIO.setup(pins['led_green'], GPIO.OUT)
-                    GPIO.output(pins['led_green'], GPIO.LOW)
-                if 'led_red' in pins:
-                    GPIO.setup(pins['led_red'], GPIO.OUT)
-                    GPIO.output(pins['led_red'], GPIO.LOW)
-                if 'buzzer' in pins:
-                    GPIO.setup(pins['buzzer'], GPIO.OUT)
-                    GPIO.output(pins['buzzer'], GPIO.LOW)
-                
-                self.logger.info(f"✅ GPIO pins initialized: {list(pins.keys())}")
-            except Exception as e:
-                self.logger.error(f"❌ Failed to initialize GPIO: {e}")
+        self.setup_gpio()
 
-    def try_acr122u(self) -> bool:
-        """Try to initialize ACR122U reader"""
-        try:
-            reader = ACR122UReader()
-            if reader.initialize(self.config):
-                self.reader = reader
-                self.logger.info(f"✅ Using {reader.get_reader_name()}")
-                return True
-        except Exception as e:
-            self.logger.debug(f"ACR122U not available: {e}")
-        return False
-    
-    def try_mcrn2(self) -> bool:
-        """Try to initialize MCRN2 reader"""
-        try:
-            reader = MCRN2Reader()
-            if reader.initialize(self.config):
-                self.reader = reader
-                self.logger.info(f"✅ Using {reader.get_reader_name()}")
-                return True
-        except Exception as e:
-            self.logger.debug(f"MCRN2 not available: {e}")
-        return False
+    def setup_gpio(self, previous_pins: Optional[Dict[str, int]] = None):
+        """Initialize GPIO outputs, releasing pins from a previous config"""
+        self.actuator.setup(previous_pins)
+
+    def setup_processes(self):
+        """Run the reader and the actuator in supervised child processes"""
+        self.logger.info("🧩 Starting reader and actuator processes...")
+        self.actuator = ProcessActuator(lambda: self.config)
+        self.reader = ProcessReader(lambda: self.config)
+        self.workers = [self.reader.worker, self.actuator.worker]
+        
+        self.actuator.start()
+        if self.reader.initialize(self.config):
+            self.logger.info(f"✅ Using {self.reader.get_reader_name()} (reader process)")
+        else:
+            self.logger.warning("⚠️  Reader process not ready yet - it will keep retrying")
 
     def start_polling(self):
         """Start continuous polling for RFID cards"""
@@ -421,26 +786,37 @@ class UrbanKetlUnifiedMachine:
         
         def poll_loop():
             while self.polling_active:
+                self.liveness.beat('poller')
                 try:
                     if not self.processing_card:
                         # Read card UID
+                        read_started = time.perf_counter()
                         uid = self.reader.read_uid(timeout=0.05)
                         
                         if uid and uid != self.current_card_uid:
                             # New card detected!
                             card_uid_hex = binascii.hexlify(uid).decode('utf-8').upper()
+                            if not self.claim_tap():
+                                continue  # A test dispense took the valve; the card is read again after it
                             self.current_card_uid = uid
-                            self.processing_card = True
                             
                             self.logger.info(f"⚡ Card detected: {card_uid_hex}")
+                            self.warmer.on_card_detected()
+                            
+                            if not self.machine_enabled:
+                                self.record_rejected_tap(card_uid_hex, "MACHINE_DISABLED")
+                                self.show_error("MACHINE_DISABLED")
+                                self.processing_card = False
+                                continue
+                            
                             self.beep(0.1)
                             
-                            # Process card in separate thread
-                            threading.Thread(
-                                target=self.process_desfire_authentication,
-                                args=(card_uid_hex,),
-                                daemon=True
-                            ).start()
+                            # Hand the card to the tap worker
+                            read_ms = round((time.perf_counter() - read_started) * 1000, 2)
+                            if not self.tap_worker.submit(card_uid_hex, read_ms):
+                                self.record_rejected_tap(card_uid_hex, "BUSY")
+                                self.show_error("BUSY")
+                                self.processing_card = False
                         
                         elif not uid and self.current_card_uid:
                             # Card removed
@@ -454,8 +830,11 @@ class UrbanKetlUnifiedMachine:
                     self.logger.error(f"❌ Polling error: {e}")
                     time.sleep(1)
         
+        self.tap_worker.start()
+        
         # Run polling in background thread
-        poll_thread = threading.Thread(target=poll_loop, daemon=True)
+        self.liveness.register('poller', lambda: self.config.get('poll_stall_timeout', 10))
+        poll_thread = threading.Thread(target=poll_loop, name='poller', daemon=True)
         poll_thread.start()
         
         self.logger.info("✅ Polling started - tap your card anytime")
@@ -465,59 +844,170 @@ class UrbanKetlUnifiedMachine:
         self.polling_active = False
         self.logger.info("⏹️  Polling stopped")
 
+    def record_rejected_tap(self, card_uid_hex: str, reason: str):
+        """Event for a tap refused before authentication started"""
+        self.events.add({
+            'type': 'tap_rejected',
+            'ts': datetime.now().isoformat(timespec='milliseconds'),
+            'cardUid': card_uid_hex,
+            'reason': reason
+        })
+
+    def run_tap(self, card_uid_hex: str, read_ms: Optional[float] = None):
+        """Process one tap as a tracked auth worker"""
+        name = f"tap:{card_uid_hex}:{threading.get_ident()}"
+        self.liveness.register(name, lambda: self.config.get('tap_stall_timeout', 60))
+        self.tap_local.liveness = name
+        self.recorder.begin(card_uid_hex, read_ms, {
+            'reader': self.reader.get_reader_name() if self.reader else None,
+            'price': self.price_cache.get_price(),
+            'dispense_time': self.config.get('dispense_time', 3.0),
+            'card_removal_delay': self.config.get('card_removal_delay', 0.5)
+        })
+        result = False
+        try:
+            result = self.profiler.profile_call(self.process_desfire_authentication, card_uid_hex)
+            return result
+        finally:
+            summary = self.recorder.end(result)
+            if summary:
+                self.events.add({
+                    'type': 'tap',
+                    'ts': summary['ts'],
+                    'cardUid': card_uid_hex,
+                    'outcome': 'dispensed' if result else 'failed',
+                    'error': summary['error'],
+                    'readMs': summary['readMs'],
+                    'totalMs': summary['totalMs'],
+                    'stages': summary['stages']
+                })
+            self.tap_local.liveness = None
+            self.liveness.unregister(name)
+
+    def tap_progress(self, allowance: float = 0.0):
+        """Beat this thread's tap liveness entry; allowance is extra time the next step may take"""
+        name = getattr(self.tap_local, 'liveness', None)
+        if name:
+            self.liveness.beat(name, allowance)
+
     def process_desfire_authentication(self, card_uid_hex: str):
         """Complete DESFire challenge-response authentication flow"""
         
         try:
+            if card_uid_hex in self.blocked_cards:
+                self.logger.warning(f"🚫 Card {card_uid_hex} is blocked")
+                self.show_error("CARD_BLOCKED")
+                self.processing_card = False
+                return False
+            
             self.logger.info(f"🔐 Starting DESFire authentication for UID: {card_uid_hex}")
             self.set_led('green', 'blink')
             
-            # Step 1: Request challenge from server
-            challenge_data = self.request_challenge(card_uid_hex)
-            if not challenge_data:
-                self.show_error("AUTH_FAILED")
-                self.processing_card = False
-                return False
+            # Card generation from the capability cache (GetVersion on first sight)
+            auth_command = CardCapabilities.DEFAULT_AUTH_COMMAND
+            card_type = None
+            if self.reader and self.config.get('card_detection', True):
+                started = time.perf_counter()
+                capability = self.card_capabilities.detect(card_uid_hex, self.reader)
+                self.recorder.record('card', started, **capability)
+                if not capability['supported']:
+                    self.logger.warning(f"🚫 Unsupported card {card_uid_hex}: {capability['reason']}")
+                    self.show_error("UNSUPPORTED_CARD")
+                    self.processing_card = False
+                    return False
+                auth_command = capability['authCommand']
+                card_type = capability.get('type')
             
-            challenge_id = challenge_data['challengeId']
-            challenge_hex = challenge_data['challenge']
+            # Beverage is fixed at the tap; a later button press applies to the next one
+            profile = self.beverages.take()
             
-            self.logger.info(f"📨 Received challenge: {challenge_hex[:16]}...")
+            # Steps 1-3 on the Pi when the card is provisioned locally (None: use the server)
+            validation = None
+            if self.config.get('auth_mode', 'server') == 'local':
+                validation = self.authenticate_locally(card_uid_hex, card_type)
             
-            # Step 2: Send challenge to DESFire card and get response
-            card_response = self.get_desfire_response(challenge_hex)
-            if not card_response:
-                self.show_error("CARD_ERROR")
-                self.processing_card = False
-                return False
+            # Validate and dispense go to the endpoint holding the challenge
+            endpoint = None
             
-            self.logger.info(f"📤 Card response: {card_response[:16]}...")
+            # Balances in the replies are no newer than the request that carried them
+            validate_sent = time.monotonic()
+            
+            if validation is None:
+                # Step 1: Request challenge from server
+                challenge = self.request_challenge(card_uid_hex)
+                if not challenge:
+                    self.show_error("AUTH_FAILED")
+                    self.processing_card = False
+                    return False
+                challenge_data, endpoint = challenge
+                self.tap_progress()
+                
+                challenge_id = challenge_data['challengeId']
+                challenge_hex = challenge_data['challenge']
+                
+                self.logger.info(f"📨 Received challenge: {challenge_hex[:16]}...")
+                
+                # Step 2: Send challenge to DESFire card and get response
+                card_response = self.get_desfire_response(challenge_hex, auth_command)
+                if not card_response:
+                    self.show_error("CARD_ERROR")
+                    self.processing_card = False
+                    return False
+                
+                self.logger.info(f"📤 Card response: {card_response[:16]}...")
+                self.tap_progress()
+                
+                # Step 3: Validate response with server
+                validation = self.validate_response(challenge_id, card_response, card_uid_hex, endpoint)
             
-            # Step 3: Validate response with server
-            validation = self.validate_response(challenge_id, card_response, card_uid_hex)
             if not validation or not validation.get('success'):
                 error_msg = validation.get('errorMessage', 'Unknown error') if validation else 'No response'
                 self.logger.warning(f"❌ Authentication failed: {error_msg}")
-                self.show_error("INVALID_CARD")
+                self.show_error(validation.get('errorCode', 'INVALID_CARD') if validation else 'INVALID_CARD')
                 self.auth_failures += 1
                 self.processing_card = False
                 return False
             
             self.logger.info(f"✅ Authentication successful for card: {validation['cardNumber']}")
+            self.tap_progress()
             
-            # Step 4: Authorize dispensing
-            dispense_result = self.authorize_dispensing(
-                validation['cardNumber'],
-                validation['businessUnitId']
-            )
+            business_unit_id = validation['businessUnitId']
+            if validation.get('walletBalance') is not None:
+                self.balances.update(business_unit_id, validation['walletBalance'], validate_sent)
+            
+            # Step 4: Authorize dispensing (journalled under this tap's idempotency key)
+            tap_key = str(uuid.uuid4())
+            payload = self.dispense_payload(validation['cardNumber'], business_unit_id, profile, tap_key)
+            
+            if self.config.get('optimistic_dispensing', False) and \
+                    self.balances.reserve(business_unit_id, payload['cardNumber'], payload['amount']):
+                # Enough cached headroom: pour now, the debit settles in the background
+                self.journal.append(tap_key, 'queued', request=payload, optimistic=True)
+                self.logger.info(f"⚡ Optimistic dispense - debit of ₹{payload['amount']} queued")
+                self.show_success()
+                self.dispense_tea(profile)
+                self.journal.append(tap_key, 'poured')  # Only poured taps are charged after a crash
+                self.settle_dispense(tap_key, payload)
+                
+                self.daily_dispensed += 1
+                self.total_dispensed += 1
+                time.sleep(self.config.get('card_removal_delay', 0.5))
+                self.processing_card = False
+                return True
+            
+            dispense_sent = time.monotonic()
+            dispense_result, _ = self.send_dispense(tap_key, payload, endpoint=endpoint)
             
             if dispense_result and dispense_result.get('success'):
-                balance = dispense_result.get('remainingBalance', 'Unknown')
-                self.logger.info(f"💰 Balance deducted. Remaining: ₹{balance}")
+                # The server sends newBalance (older builds: remainingBalance)
+                balance = dispense_result.get('newBalance', dispense_result.get('remainingBalance'))
+                self.balances.update(business_unit_id, balance, dispense_sent)
+                self.logger.info(f"💰 Balance deducted. Remaining: ₹{balance if balance is not None else 'Unknown'}")
                 
                 # Dispense tea
                 self.show_success()
-                self.dispense_tea()
+                self.dispense_tea(profile)
+                self.journal.append(tap_key, 'dispensed')
                 
                 self.daily_dispensed += 1
                 self.total_dispensed += 1
@@ -541,20 +1031,47 @@ class UrbanKetlUnifiedMachine:
             self.processing_card = False
             return False
 
-    def request_challenge(self, card_uid_hex: str) -> Optional[Dict]:
-        """Request cryptographic challenge from server"""
+    def authenticate_locally(self, card_uid_hex: str, card_type: Optional[str] = None) -> Optional[Dict]:
+        """
+        Mutual authentication against the local key store, with no network call
+        
+        Returns None when the card is not provisioned, the store is stale or
+        the card does not authenticate with the stored key, so the tap goes
+        through the server's challenge/validate instead.
+        """
+        card = self.card_keys.lookup(card_uid_hex)
+        if card is None:
+            self.logger.info(f"🔑 {card_uid_hex} not in the local key store - using server authentication")
+            return None
+        
+        if not card.get('active', True):
+            return {'success': False, 'errorMessage': 'Card not active'}
+        
+        if not self.reader:
+            return None
+        
+        authenticated = self.card_keys.authenticate(card, self.exchange_apdu, card_type in ('EV2', 'EV3'))
+        if not authenticated:
+            outcome = "exchange failed" if authenticated is None else "key mismatch"
+            self.logger.warning(f"🔑 Local authentication of {card_uid_hex} failed ({outcome}) - using server authentication")
+            return None
+        
+        self.logger.info("🔑 Card verified on-device")
+        return {'success': True, 'cardNumber': card['cardNumber'], 'businessUnitId': card['businessUnitId']}
+
+    def request_challenge(self, card_uid_hex: str) -> Optional[tuple]:
+        """Request cryptographic challenge from server -> (challenge data, endpoint that issued it)"""
         try:
-            response = requests.post(
-                f"{self.api_base}/api/machine/auth/challenge",
-                json={
+            response = self.api.post(
+                "/api/machine/auth/challenge",
+                {
                     'machineId': self.machine_id,
                     'cardUid': card_uid_hex
-                },
-                timeout=self.config.get('api_timeout', 5)
+                }
             )
             
             if response.status_code == 200:
-                return response.json()
+                return response.json(), getattr(response, 'endpoint', None)
             else:
                 self.logger.error(f"❌ Challenge request failed: {response.status_code}")
                 return None
@@ -563,7 +1080,8 @@ class UrbanKetlUnifiedMachine:
             self.logger.error(f"❌ Challenge request error: {e}")
             return None
 
-    def get_desfire_response(self, challenge_hex: str) -> Optional[str]:
+    def get_desfire_response(self, challenge_hex: str,
+                             auth_command: int = CardCapabilities.DEFAULT_AUTH_COMMAND) -> Optional[str]:
         """Send challenge to DESFire card and get encrypted response"""
         
         if not CRYPTO_AVAILABLE:
@@ -582,7 +1100,7 @@ class UrbanKetlUnifiedMachine:
             # Build APDU command
             apdu = [
                 0x90,  # CLA: DESFire
-                0xAA,  # INS: AuthenticateEV2First
+                auth_command,  # INS: authenticate command for the card generation
                 0x00,  # P1: Key number 0
                 0x00,  # P2
                 0x10   # Lc: 16 bytes
@@ -591,7 +1109,7 @@ class UrbanKetlUnifiedMachine:
             apdu.append(0x00)  # Le: expect response
             
             # Send APDU via reader
-            response = self.reader.send_apdu(apdu)
+            response = self.exchange_apdu(apdu)
             
             if response and len(response) >= 2:
                 # DESFire response format: [data bytes] + SW1 + SW2
@@ -625,17 +1143,25 @@ class UrbanKetlUnifiedMachine:
             challenge_bytes = bytes.fromhex(challenge_hex)
             return binascii.hexlify(challenge_bytes).decode('utf-8').upper()
 
-    def validate_response(self, challenge_id: str, response: str, card_uid: str) -> Optional[Dict]:
-        """Validate challenge response with server"""
+    def exchange_apdu(self, apdu: list) -> Optional[bytes]:
+        """Send an APDU through the reader, recording it into the tap trace"""
+        started = time.perf_counter()
+        response = self.reader.send_apdu(apdu)
+        self.recorder.record('apdu', started, c=bytes(apdu).hex(), r=response.hex() if response else None)
+        return response
+
+    def validate_response(self, challenge_id: str, response: str, card_uid: str,
+                          endpoint: Optional[str] = None) -> Optional[Dict]:
+        """Validate challenge response with the server (endpoint) that issued the challenge"""
         try:
-            response_obj = requests.post(
-                f"{self.api_base}/api/machine/auth/validate",
-                json={
+            response_obj = self.api.post(
+                "/api/machine/auth/validate",
+                {
                     'challengeId': challenge_id,
                     'response': response,
                     'cardUid': card_uid
                 },
-                timeout=self.config.get('api_timeout', 5)
+                endpoint=endpoint
             )
             
             if response_obj.status_code == 200:
@@ -648,108 +1174,263 @@ class UrbanKetlUnifiedMachine:
             self.logger.error(f"❌ Validation error: {e}")
             return None
 
-    def authorize_dispensing(self, card_number: str, business_unit_id: str) -> Optional[Dict]:
+    def dispense_payload(self, card_number: str, business_unit_id: str,
+                         profile: Optional[Dict[str, Any]], key: str) -> Dict[str, Any]:
+        # The server price applies unless the profile sets a price of its own
+        price = profile.get('price') if profile else None
+        return {
+            'machineId': self.machine_id,
+            'cardNumber': card_number,
+            'businessUnitId': business_unit_id,
+            'amount': float(price) if price is not None else self.price_cache.get_price(),
+            'teaType': profile['name'] if profile else 'Regular Tea',
+            'idempotencyKey': key
+        }
+
+    def authorize_dispensing(self, card_number: str, business_unit_id: str,
+                             profile: Optional[Dict[str, Any]] = None,
+                             idempotency_key: Optional[str] = None) -> Optional[Dict]:
         """Authorize tea dispensing and deduct from wallet"""
-        try:
-            response = requests.post(
-                f"{self.api_base}/api/machine/auth/dispense",
-                json={
-                    'machineId': self.machine_id,
-                    'cardNumber': card_number,
-                    'businessUnitId': business_unit_id,
-                    'amount': self.config.get('tea_price', 5.0),
-                    'teaType': 'Regular Tea'
-                },
-                timeout=self.config.get('api_timeout', 5)
-            )
+        key = idempotency_key or str(uuid.uuid4())
+        return self.send_dispense(key, self.dispense_payload(card_number, business_unit_id, profile, key))[0]
+
+    def send_dispense(self, key: str, payload: Dict[str, Any], unsent_state: str = 'failed',
+                      endpoint: Optional[str] = None) -> tuple:
+        """
+        (result, outcome) of a dispense call: outcome is "authorized",
+        "declined", "unsent" (never reached the server) or "unknown"
+        
+        The request is journalled under its idempotency key before it is
+        sent. Attempts that never reached the server are always retried.
+        Timeouts and 5xx are retried, with dispense_attempt_timeout per try,
+        only when the server honours the key (server_idempotency).
+        endpoint pins the call to the server that validated the card.
+        """
+        self.journal.append(key, 'authorizing', request=payload)
+        
+        idempotent = self.config.get('server_idempotency', False)
+        attempts = self.config.get('dispense_attempts', 3)
+        timeout = self.config.get('dispense_attempt_timeout', 2) if idempotent else None
+        
+        for attempt in range(1, attempts + 1):
+            self.tap_progress()
+            try:
+                response = self.api.post("/api/machine/auth/dispense", payload, timeout=timeout,
+                                         headers={'Idempotency-Key': key}, endpoint=endpoint)
+            except Exception as e:
+                never_sent = request_never_sent(e)
+                if attempt < attempts and (idempotent or never_sent):
+                    self.logger.warning(f"🔁 Dispense attempt {attempt} failed ({e}) - retrying")
+                    time.sleep(0.2 * attempt)
+                    continue
+                self.logger.error(f"❌ Dispensing authorization error: {e}")
+                self.journal.append(key, unsent_state if never_sent else 'unknown', request=payload)
+                return None, 'unsent' if never_sent else 'unknown'
             
             if response.status_code == 200:
-                return response.json()
-            else:
-                self.logger.error(f"❌ Dispensing authorization failed: {response.status_code}")
-                return None
+                result = response.json()
+                success = result.get('success')
+                self.journal.append(key, 'authorized' if success else 'failed')
+                return result, 'authorized' if success else 'declined'
+            
+            retryable = response.status_code >= 500 or response.status_code in (408, 429)
+            if idempotent and retryable and attempt < attempts:
+                self.logger.warning(f"🔁 Dispense attempt {attempt} got {response.status_code} - retrying")
+                time.sleep(0.2 * attempt)
+                continue
+            
+            self.logger.error(f"❌ Dispensing authorization failed: {response.status_code}")
+            self.journal.append(key, 'unknown' if retryable else 'failed')
+            try:
+                result = response.json()
+            except ValueError:
+                result = None
+            return result, 'unknown' if retryable else 'declined'
+
+    def settle_dispense(self, key: str, payload: Dict[str, Any]):
+        """Queue the debit of an optimistic pour"""
+        self.settling.add(key)
+        self.settlements.put((key, payload))
+
+    def settlement_loop(self):
+        """
+        Settle optimistic pours in order
         
-        except Exception as e:
-            self.logger.error(f"❌ Dispensing authorization error: {e}")
-            return None
+        The exposure stays reserved until the debit is settled. Debits that
+        could not be sent are retried every settlement_retry_interval
+        (ambiguous ones too when server_idempotency is set). A declined debit is
+        a conflict: the cup was poured without payment. It goes out as a
+        settlement_conflict event and the unit's next tap goes online.
+        """
+        while True:
+            key, payload = self.settlements.get()
+            result, outcome = self.send_dispense(key, payload, unsent_state='poured')
+            retry = outcome == 'unsent' or (outcome == 'unknown' and self.config.get('server_idempotency', False))
+            if retry:
+                time.sleep(self.config.get('settlement_retry_interval', 10))
+                self.settlements.put((key, payload))
+                continue
+            
+            self.settling.discard(key)
+            unit, card, amount = payload['businessUnitId'], payload['cardNumber'], payload['amount']
+            if outcome == 'authorized':
+                self.journal.append(key, 'dispensed')
+                self.balances.release(unit, card, amount, result.get('newBalance', result.get('remainingBalance')))
+                continue
+            
+            reason = (result or {}).get('message') or outcome
+            self.logger.warning(f"⚠️  Optimistic dispense {key} not settled: {reason}")
+            self.balances.release(unit, card, amount, conflict=True)
+            self.events.add({
+                'type': 'settlement_conflict',
+                'ts': datetime.now().isoformat(timespec='milliseconds'),
+                'idempotencyKey': key,
+                'outcome': outcome,
+                'reason': reason,
+                'cardNumber': card,
+                'businessUnitId': unit,
+                'amount': amount
+            })
+            if outcome == 'unknown':
+                self.journal.append(key, 'reconciled', outcome='settlement_unknown')
 
-    def dispense_tea(self):
-        """Activate tea dispensing mechanism"""
-        try:
-            dispense_time = self.config.get('dispense_time', 3.0)
+    OPTIMISTIC_OUTCOMES = {
+        'dispense_interrupted': 'settled',
+        'charged_not_dispensed': 'settled',
+        'not_charged': 'poured_not_charged',
+        'outcome_unknown': 'poured_charge_unknown'
+    }
+
+    def recover_dispenses(self) -> int:
+        """
+        Reconcile taps left unfinished by a crash, power loss or lost reply
+        
+        "authorized" taps may or may not have poured; "authorizing" and
+        "unknown" taps may or may not have been charged. With
+        server_idempotency the original request is replayed under its key to
+        learn the outcome; otherwise it is reported for manual review. Every
+        result goes out as a dispense_reconcile event. "poured" optimistic
+        taps whose debit was never sent go back to the settlement queue;
+        "queued" ones stopped before the valve closed and are not charged
+        (not_poured). Returns the number of entries still unresolved.
+        """
+        max_age = self.config.get('journal_max_age', 604800)
+        for entry in self.journal.unfinished():
+            key, state = entry['key'], entry['state']
+            outcome = None
             
-            if MCRN2_AVAILABLE:
-                pins = self.config['gpio_pins']
-                
-                self.logger.info(f"☕ Dispensing tea for {dispense_time} seconds...")
-                
-                # Activate dispenser
-                GPIO.output(pins['dispenser'], GPIO.HIGH)
-                
-                # Activate green LED if available
-                if 'led_green' in pins:
-                    GPIO.output(pins['led_green'], GPIO.HIGH)
-                
-                time.sleep(dispense_time)
-                
-                # Deactivate
-                GPIO.output(pins['dispenser'], GPIO.LOW)
-                if 'led_green' in pins:
-                    GPIO.output(pins['led_green'], GPIO.LOW)
+            if state == 'poured':
+                # Optimistic pour whose debit was never sent - settle it now
+                if key not in self.settling and entry.get('request'):
+                    request = entry['request']
+                    with self.balances.lock:
+                        self.balances.hold(request['businessUnitId'], request['cardNumber'], request['amount'])
+                    self.settle_dispense(key, request)
+                continue
+            
+            if state == 'queued':
+                outcome = 'not_poured'  # Crashed before the valve closed; the debit was never sent
+            elif state == 'authorized':
+                outcome = 'dispense_interrupted'  # Charged; the cup may not have been poured
+            elif self.config.get('server_idempotency', False) and entry.get('request'):
+                try:
+                    response = self.api.post("/api/machine/auth/dispense", entry['request'],
+                                             headers={'Idempotency-Key': key})
+                    if response.status_code == 200 and response.json().get('success'):
+                        outcome = 'charged_not_dispensed'
+                    elif 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                        outcome = 'not_charged'
+                except Exception as e:
+                    self.logger.warning(f"⚠️  Dispense recovery for {key} deferred: {e}")
             else:
-                self.logger.info(f"🔧 [SIMULATION] Dispensing tea for {dispense_time} seconds...")
-                time.sleep(dispense_time)
+                outcome = 'outcome_unknown'
+            
+            if outcome is None:
+                try:
+                    age = (datetime.now() - datetime.fromisoformat(entry['ts'])).total_seconds()
+                except (KeyError, ValueError):
+                    age = 0
+                if age < max_age:
+                    continue
+                outcome = 'expired'
             
-            self.logger.info("✅ Dispensing complete")
+            if entry.get('optimistic'):
+                # The cup was poured before the debit: only the charge is in question
+                outcome = self.OPTIMISTIC_OUTCOMES.get(outcome, outcome)
+            
+            request = entry.get('request', {})
+            self.logger.warning(f"📒 Reconciled dispense {key}: {outcome}")
+            self.events.add({
+                'type': 'dispense_reconcile',
+                'ts': datetime.now().isoformat(timespec='milliseconds'),
+                'idempotencyKey': key,
+                'journalState': state,
+                'outcome': outcome,
+                'cardNumber': request.get('cardNumber'),
+                'amount': request.get('amount')
+            })
+            self.journal.append(key, 'expired' if outcome == 'expired' else 'reconciled', outcome=outcome)
         
-        except Exception as e:
-            self.logger.error(f"❌ Dispensing error: {e}")
+        return len(self.journal.unfinished())
 
-    def set_led(self, color: str, mode: str = 'on'):
-        """Control LED indicators (optional)"""
-        if not MCRN2_AVAILABLE:
-            return
+    def start_dispense_recovery(self):
+        """Run the recovery pass now and every journal_recovery_interval until the journal is clean"""
+        def recovery_loop():
+            while self.recover_dispenses():
+                time.sleep(self.config.get('journal_recovery_interval', 300))
         
+        if self.journal.unfinished():
+            threading.Thread(target=recovery_loop, name='dispense-recovery', daemon=True).start()
+
+    def dispense_tea(self, profile: Optional[Dict[str, Any]] = None):
+        """Activate tea dispensing mechanism (with the tap's beverage profile, if any)"""
+        started = time.perf_counter()
+        profile = profile or {}
         try:
-            pins = self.config['gpio_pins']
-            led_key = f'led_{color}'
+            dispense_time = profile.get('dispenseTime', self.config.get('dispense_time', 3.0))
+            volume_mode = self.config.get('dispense_mode', 'time') == 'volume' and 'sequence' not in profile
             
-            if led_key not in pins:
-                return
+            # A long pour must not look like a stuck tap to the watchdog
+            if 'sequence' in profile:
+                pour_seconds = sum(step['seconds'] for step in profile['sequence'])
+            elif volume_mode:
+                pour_seconds = self.config.get('flow_timeout', 15) + self.config.get('flow_settle', 0.3)
+            else:
+                pour_seconds = dispense_time
+            self.tap_progress(pour_seconds)
             
-            led_pin = pins[led_key]
+            # Pins cannot be re-assigned by a config reload mid-pour
+            with self.dispense_lock:
+                if 'sequence' in profile:
+                    timing = self.actuator.dispense_sequence(profile['sequence'])
+                elif volume_mode:
+                    timing = self.actuator.dispense_volume(profile.get('volumeMl', self.config.get('dispense_volume_ml', 150)))
+                else:
+                    timing = self.actuator.dispense(dispense_time)
             
-            if mode == 'on':
-                GPIO.output(led_pin, GPIO.HIGH)
-            elif mode == 'off':
-                GPIO.output(led_pin, GPIO.LOW)
-            elif mode == 'blink':
-                for _ in range(3):
-                    GPIO.output(led_pin, GPIO.HIGH)
-                    time.sleep(0.1)
-                    GPIO.output(led_pin, GPIO.LOW)
-                    time.sleep(0.1)
+            self.tap_progress()
+            self.dispense_stats.record(timing)
+            if volume_mode:
+                self.logger.info(f"✅ Dispensing complete ({timing['volumeMl']}ml in {timing['actualMs'] / 1000:.1f}s, "
+                                 f"{timing['flowMlPerSec']}ml/s)")
+            else:
+                deviation = timing['actualMs'] - timing['requestedMs']
+                self.logger.info(f"✅ Dispensing complete ({timing['actualMs']:.1f}ms, {deviation:+.1f}ms {timing['method']})")
         
         except Exception as e:
-            self.logger.debug(f"LED not available: {e}")
+            self.logger.error(f"❌ Dispensing error: {e}")
+            timing = {}
+        
+        finally:
+            self.recorder.record('dispense', started, **timing)
+
+    def set_led(self, color: str, mode: str = 'on'):
+        """Control LED indicators (optional)"""
+        self.actuator.set_led(color, mode)
 
     def beep(self, duration: float = 0.1):
         """Sound buzzer (optional)"""
-        if not MCRN2_AVAILABLE:
-            return
-        
-        try:
-            pins = self.config['gpio_pins']
-            
-            if 'buzzer' not in pins:
-                return
-            
-            GPIO.output(pins['buzzer'], GPIO.HIGH)
-            time.sleep(duration)
-            GPIO.output(pins['buzzer'], GPIO.LOW)
-        
-        except Exception as e:
-            self.logger.debug(f"Buzzer not available: {e}")
+        self.actuator.beep(duration)
 
     def show_success(self):
         """Show success indication"""
@@ -760,6 +1441,7 @@ class UrbanKetlUnifiedMachine:
 
     def show_error(self, error_type: str):
         """Show error indication"""
+        self.recorder.record('error', type=error_type)
         self.set_led('red', 'blink')
         self.beep(0.1)
         time.sleep(0.05)
@@ -768,23 +1450,132 @@ class UrbanKetlUnifiedMachine:
         
         self.logger.warning(f"⚠️  Error: {error_type}")
 
+    def set_enabled(self, enabled: bool, reason: Optional[str] = None):
+        """Enable or disable card processing (server command)"""
+        self.machine_enabled = enabled
+        if enabled:
+            self.logger.info("✅ Machine enabled by server")
+        else:
+            self.logger.warning(f"⛔ Machine disabled by server{': ' + reason if reason else ''}")
+
+    def block_card(self, card_uid: str, blocked: bool):
+        """Block or unblock a card UID locally (server command)"""
+        card_uid = card_uid.replace(':', '').upper()
+        if blocked:
+            self.blocked_cards.add(card_uid)
+        else:
+            self.blocked_cards.discard(card_uid)
+        self.logger.info(f"🚫 Card {card_uid} {'blocked' if blocked else 'unblocked'}")
+
+    def reinit_reader(self) -> bool:
+        """Re-initialise the reader from the polling thread"""
+        if not isinstance(self.reader, (ReaderSupervisor, ProcessReader)):
+            return False
+        self.logger.info("🔌 Reader reinit requested")
+        self.reader.request_reinit()
+        return True
+
+    def claim_tap(self) -> bool:
+        """Set processing_card unless a tap or a test dispense already holds it"""
+        with self.tap_lock:
+            if self.processing_card:
+                return False
+            self.processing_card = True
+            return True
+
+    def test_dispense(self) -> bool:
+        """Run the dispenser once without a card (local status API)"""
+        if not self.claim_tap():
+            raise RuntimeError("A tap is in progress")
+        try:
+            self.logger.info("🧪 Test dispense requested from the status API")
+            self.dispense_tea()
+            return True
+        finally:
+            self.processing_card = False
+
+    def get_diagnostics(self) -> Dict[str, Any]:
+        """Snapshot of machine state for remote diagnostics"""
+        return {
+            'machineId': self.machine_id,
+            'reader': self.reader.get_reader_name() if self.reader else None,
+            'readerHealth': self.reader.get_status() if isinstance(self.reader, (ReaderSupervisor, ProcessReader)) else None,
+            'processes': {worker.name: worker.get_status() for worker in self.workers} or None,
+            'enabled': self.machine_enabled,
+            'online': self.is_online,
+            'processingCard': self.processing_card,
+            'blockedCards': len(self.blocked_cards),
+            'dailyDispensed': self.daily_dispensed,
+            'totalDispensed': self.total_dispensed,
+            'authFailures': self.auth_failures,
+            'price': self.price_cache.get_status(),
+            'beverages': self.beverages.get_status(),
+            'cardKeys': self.card_keys.get_status(),
+            'cardCapabilities': self.card_capabilities.get_status(),
+            'balances': self.balances.get_status(),
+            'journal': self.journal.get_status(),
+            'push': self.push_channel.get_status(),
+            'profiler': self.profiler.get_status(),
+            'memory': self.memory.get_status(),
+            'tapWorker': self.tap_worker.get_status(),
+            'dispenseTiming': self.dispense_stats.get_status(),
+            'wire': self.api.get_wire_status(),
+            'events': self.events.get_status(),
+            'connection': dict(self.api.get_connection_status(), warmer=self.warmer.get_status())
+        }
+
+    def get_status_report(self) -> Dict[str, Any]:
+        """Diagnostics plus process details for the local status API"""
+        report = self.get_diagnostics()
+        report.update({
+            'uptimeSec': round(time.monotonic() - self.started_at),
+            'pid': os.getpid(),
+            'liveness': self.liveness.get_status(),
+            'lastTap': (self.recorder.get_recent(1) or [None])[0]
+        })
+        return report
+
+    def send_memory_diff(self):
+        """Diff tracemalloc snapshots and upload the result with diagnostics"""
+        if self.memory.snapshot_diff() is not None:
+            self.send_diagnostics()
+
+    def send_diagnostics(self):
+        """Upload a diagnostics snapshot (requested via push channel)"""
+        try:
+            response = self.api.post("/api/machine/diagnostics", self.get_diagnostics())
+            if not acknowledged(response):
+                self.logger.warning(f"⚠️  Diagnostics upload not acknowledged: {response.status_code}")
+        except Exception as e:
+            self.logger.error(f"❌ Diagnostics upload error: {e}")
+
     def send_heartbeat(self):
         """Send heartbeat to server"""
         try:
-            response = requests.post(
-                f"{self.api_base}/api/machine/heartbeat",
-                json={
+            response = self.api.post(
+                "/api/machine/heartbeat",
+                {
                     'machineId': self.machine_id,
-                    'status': 'online',
+                    'status': 'online' if self.machine_enabled else 'disabled',
+                    'pushConnected': self.push_channel.connected,
                     'dailyDispensed': self.daily_dispensed,
-                    'totalDispensed': self.total_dispensed
-                },
-                timeout=5
+                    'totalDispensed': self.total_dispensed,
+                    'memory': self.memory.get_snapshot(),
+                    'dispenseTiming': self.dispense_stats.get_status()
+                }
             )
             
             if response.status_code == 200:
                 self.is_online = True
                 self.logger.debug("💓 Heartbeat sent")
+                
+                # Server may push config changes in the heartbeat response
+                try:
+                    pushed_config = response.json().get('config')
+                except ValueError:
+                    pushed_config = None
+                if pushed_config:
+                    self.apply_config_update(pushed_config, "server heartbeat")
             else:
                 self.logger.warning(f"⚠️  Heartbeat failed: {response.status_code}")
         
@@ -793,53 +1584,143 @@ class UrbanKetlUnifiedMachine:
             self.is_online = False
 
     def start_heartbeat(self, interval: int = 60):
-        """Start periodic heartbeat"""
+        """Start periodic heartbeat (interval follows config reloads)"""
         def heartbeat_loop():
             while True:
+                self.liveness.beat('heartbeat')
                 self.send_heartbeat()
-                time.sleep(interval)
+                self.liveness.beat('heartbeat')
+                
+                # Server changes arrive over the push channel while it is up,
+                # so the heartbeat only needs to run occasionally
+                if self.push_channel.connected:
+                    time.sleep(self.config.get('push_heartbeat_interval', 300))
+                else:
+                    time.sleep(self.config.get('heartbeat_interval', interval))
         
-        thread = threading.Thread(target=heartbeat_loop, daemon=True)
+        # Longest sleep plus two request timeouts before the loop counts as stuck
+        self.liveness.register('heartbeat', lambda: (
+            max(self.config.get('heartbeat_interval', interval), self.config.get('push_heartbeat_interval', 300))
+            + 2 * self.config.get('api_timeout', 5) + 30
+        ))
+        
+        thread = threading.Thread(target=heartbeat_loop, name='heartbeat', daemon=True)
         thread.start()
         self.logger.info(f"💓 Heartbeat started (every {interval}s)")
 
+    def request_shutdown(self, signum=None, frame=None):
+        """SIGTERM (systemctl stop/restart, watchdog restart): leave the main loop and clean up"""
+        self.shutdown_requested = True
+    
     def cleanup(self):
         """Cleanup resources"""
+        sd_notify("STOPPING=1")
         self.stop_polling()
+        self.tap_worker.stop()
+        for worker in self.workers:
+            worker.stop()
+        self.push_channel.stop()
+        self.status_server.stop()
+        self.events.stop()
         
-        if MCRN2_AVAILABLE:
-            try:
-                GPIO.cleanup()
+        if not self.workers:
+            self.actuator.release()
+            if GPIO_AVAILABLE:
                 self.logger.info("🧹 GPIO cleanup complete")
-            except:
-                pass
         
         self.logger.info("👋 UrbanKetl Machine shutdown complete")
 
     def run(self):
         """Main run loop"""
         try:
+            # Shut down through cleanup() on SIGTERM too, so buffered events are spooled
+            signal.signal(signal.SIGTERM, self.request_shutdown)
+            
             self.logger.info("🚀 UrbanKetl Unified Machine starting...")
             self.logger.info(f"📡 Machine ID: {self.machine_id}")
-            self.logger.info(f"🌐 API Base: {self.api_base}")
+            self.logger.info(f"🌐 API Base: {', '.join(self.api.endpoints.urls())}")
             
             if self.reader:
                 self.logger.info(f"🔧 Reader: {self.reader.get_reader_name()}")
             else:
                 self.logger.warning("⚠️  No reader detected - simulation mode")
             
-            # Start heartbeat
-            self.start_heartbeat(60)
+            # Reload config on SIGHUP (systemctl reload urbanketl)
+            signal.signal(signal.SIGHUP, self.request_config_reload)
+            
+            # SIGUSR1 toggles the CPU profiler, SIGUSR2 writes a stack dump
+            signal.signal(signal.SIGUSR1, self.profiler.toggle)
+            signal.signal(signal.SIGUSR2, self.profiler.dump_stacks)
+            
+            # Beverage selection buttons (the reader and valve were set up in __init__)
+            self.beverages.setup_buttons()
+            
+            # Upload tap events in batches (plus anything spooled while offline)
+            self.events.start()
+            
+            # Settle optimistic pours, then reconcile taps a crash or power cut left half-done
+            threading.Thread(target=self.settlement_loop, name='settlement', daemon=True).start()
+            self.start_dispense_recovery()
             
             # Start polling
             self.start_polling()
             
+            # Local status API (separate threads from the card path)
+            if self.config.get('status_enabled', True):
+                self.status_server.start()
+            
+            # Tell systemd we are up (Type=notify) as soon as taps can be served;
+            # nothing before this waits on the network. WatchdogSec enables pings.
+            sd_notify(f"READY=1\nSTATUS=Ready, machine {self.machine_id}")
+            watchdog_enabled = bool(os.environ.get('WATCHDOG_USEC'))
+            if watchdog_enabled:
+                watchdog_sec = int(os.environ['WATCHDOG_USEC']) / 1_000_000
+                self.logger.info(f"🐕 systemd watchdog enabled ({watchdog_sec:.0f}s)")
+            
+            # Server price, beverage profiles and card keys are fetched by their
+            # refresh threads; until they answer, taps use tea_price, the cached or
+            # configured profiles and server authentication
+            self.price_cache.start()
+            self.price_cache.refresh_now()
+            self.beverages.start()
+            self.beverages.refresh_now()
+            self.card_keys.start()
+            self.card_keys.refresh_now()  # Only fetches in auth_mode local
+            
+            # Start heartbeat
+            self.start_heartbeat(self.config.get('heartbeat_interval', 60))
+            
+            # Keep the API connection warm between taps
+            self.warmer.start()
+            
+            # Start server push channel
+            if self.config.get('push_enabled', True):
+                self.push_channel.start()
+            
             self.logger.info("✅ Machine ready - waiting for cards...")
             self.logger.info("👆 Tap your RFID card to dispense tea")
             
             # Keep main thread alive
-            while True:
+            last_config_check = time.monotonic()
+            while not self.shutdown_requested:
                 time.sleep(1)
+                
+                # Only pet the watchdog while every tracked thread is making progress
+                stalled = self.liveness.check()
+                if watchdog_enabled:
+                    if stalled:
+                        sd_notify(f"STATUS=Stalled: {', '.join(stalled)}")
+                    else:
+                        sd_notify("WATCHDOG=1")
+                
+                watch_interval = self.config.get('config_watch_interval', 5)
+                now = time.monotonic()
+                if self.reload_requested or (watch_interval and now - last_config_check >= watch_interval):
+                    last_config_check = now
+                    self.check_config_file()
+            
+            self.logger.info("⏹️  SIGTERM received - shutting down...")
+            self.cleanup()
         
         except KeyboardInterrupt:
             self.logger.info("\n⏹️  Shutdown requested...")
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+UrbanKetl MFRC522 Benchmark
+Compares the MFRC522Reader UID fast path (WUPA + anticollision/select only)
+with SimpleMFRC522.read_no_block() as polled by urbanketl_machine_desfire.py:
+time per poll and SPI transfers/bytes per poll, on the same chip.
+
+Run it on the Pi with the reader wired. Without --card the field must be empty
+(idle polls, what the controller does between taps). With --card hold a card
+on the reader: detection polls see it as a new card every time, presence polls
+are the unified controller's polls while the card stays on the reader.
+
+Usage:
+    python3 urbanketl_mfrc522_benchmark.py                      # empty field
+    python3 urbanketl_mfrc522_benchmark.py --card --polls 500
+    python3 urbanketl_mfrc522_benchmark.py --config machine_config.json --json
+"""
+
+import argparse
+import json
+import os
+import time
+from typing import Dict, Any, Callable
+
+from urbanketl_machine_unified import MFRC522Reader, MFRC522_AVAILABLE, percentile
+
+if MFRC522_AVAILABLE:
+    from mfrc522 import SimpleMFRC522
+
+
+class CountingSpi:
+    """spidev wrapper counting transfers and bytes clocked"""
+
+    def __init__(self, spi):
+        self.spi = spi
+        self.transfers = 0
+        self.bytes = 0
+
+    def xfer2(self, data, *args):
+        self.transfers += 1
+        self.bytes += len(data)
+        return self.spi.xfer2(data, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.spi, name)
+
+
+def measure(spi: CountingSpi, poll: Callable[[], Any], polls: int) -> Dict[str, Any]:
+    """Per-poll time and SPI traffic, and how many polls returned a UID"""
+    samples = []
+    hits = 0
+    spi.transfers = spi.bytes = 0
+    for _ in range(polls):
+        started = time.perf_counter()
+        if poll():
+            hits += 1
+        samples.append((time.perf_counter() - started) * 1000)
+    return {
+        'p50Ms': percentile(samples, 50),
+        'p95Ms': percentile(samples, 95),
+        'spiTransfersPerPoll': round(spi.transfers / polls, 1),
+        'spiBytesPerPoll': round(spi.bytes / polls, 1),
+        'uidPolls': hits
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MFRC522 UID polling against SimpleMFRC522.read_no_block")
+    parser.add_argument('--config', default='machine_config.json', help="Machine config (spi_pins, mfrc522_spi_hz)")
+    parser.add_argument('--polls', type=int, default=200, help="Polls per measurement")
+    parser.add_argument('--card', action='store_true', help="A card is held on the reader")
+    parser.add_argument('--json', action='store_true', help="Print the full report as JSON")
+    args = parser.parse_args()
+
+    if not MFRC522_AVAILABLE:
+        parser.error("mfrc522 / RPi.GPIO are not installed")
+
+    config = {'spi_pins': {'cs': 8, 'reset': 25}, 'mfrc522_spi_hz': 4000000}
+    if os.path.exists(args.config):
+        with open(args.config, 'r') as f:
+            config.update(json.load(f))
+
+    reader = MFRC522Reader()
+    if not reader.initialize(config):
+        parser.error("MFRC522 not found - check wiring and spi_pins")
+    spi = reader.chip.spi = CountingSpi(reader.chip.spi)
+
+    # Same chip for the legacy path (SimpleMFRC522() would set up its own with BOARD pin numbering)
+    legacy = SimpleMFRC522.__new__(SimpleMFRC522)
+    legacy.READER = reader.chip
+
+    def legacy_poll():
+        return legacy.read_no_block()[0]
+
+    def detect_poll():
+        reader.uid = None  # Forget the card so it is selected again (after halting it, as between taps)
+        return reader.read_uid()
+
+    # read_no_block relies on the library's timer settings; the fast path programs its own
+    reader.chip.MFRC522_Init()
+    report = {'card': args.card, 'spiHz': config['mfrc522_spi_hz'], 'readNoBlock': measure(spi, legacy_poll, args.polls)}
+    reader.timer = None
+    report['uidDetect'] = measure(spi, detect_poll, args.polls)
+    if args.card:
+        reader.read_uid()
+        report['uidPresence'] = measure(spi, reader.read_uid, args.polls)
+    report['uid'] = reader.uid.hex().upper() if reader.uid else None
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    field = f"card {report['uid']}" if args.card else "empty field"
+    print(f"📡 MFRC522 polling - {field}, {args.polls} polls, SPI {config['mfrc522_spi_hz'] / 1e6:g} MHz")
+    for name, label in (('readNoBlock', 'read_no_block'), ('uidDetect', 'UID detect'), ('uidPresence', 'UID presence')):
+        result = report.get(name)
+        if result:
+            print(f"   {label:<15}{result['p50Ms']:>8} ms p50  {result['p95Ms']} ms p95  "
+                  f"{result['spiTransfersPerPoll']} transfers / {result['spiBytesPerPoll']} bytes per poll  "
+                  f"({result['uidPolls']} with UID)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,985 @@
+"""
+UrbanKetl Tea Machine Controller - Card Readers
+ACR122U (USB/PC-SC), MCRN2 (SPI/PN532) and MFRC522 (SPI) drivers, the
+supervisor that fails over between them and the DESFire capability cache
+"""
+
+import time
+import logging
+import threading
+import math
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Callable
+
+# Try importing ACR122U (PC/SC) support
+try:
+    from smartcard.System import readers
+    ACR122U_AVAILABLE = True
+except ImportError:
+    ACR122U_AVAILABLE = False
+
+# RPi.GPIO (Raspberry Pi only) - the MFRC522 library drives the reset pin with it
+try:
+    import RPi.GPIO as GPIO
+    GPIO_AVAILABLE = True
+except ImportError:
+    GPIO_AVAILABLE = False
+
+# Try importing MCRN2 (PN532) support
+try:
+    import board
+    import busio
+    from digitalio import DigitalInOut
+    from adafruit_pn532.spi import PN532_SPI
+    MCRN2_AVAILABLE = True
+except ImportError:
+    MCRN2_AVAILABLE = False
+
+# Try importing MFRC522 (SPI register access) support - the library needs RPi.GPIO itself
+try:
+    from mfrc522 import MFRC522
+    MFRC522_AVAILABLE = GPIO_AVAILABLE
+except ImportError:
+    MFRC522_AVAILABLE = False
+
+
+class ReaderInterface:
+    """Abstract interface for RFID readers"""
+    
+    # Error counters read by ReaderSupervisor
+    read_errors = 0  # Reader/bus failures while polling (not "no card")
+    rf_errors = 0  # Failed APDU exchanges with a present card
+    
+    def initialize(self, config: Dict[str, Any]) -> bool:
+        """Initialize the reader hardware"""
+        raise NotImplementedError
+    
+    def read_uid(self, timeout: float = 0.05) -> Optional[bytes]:
+        """Read card UID. Returns None if no card present."""
+        raise NotImplementedError
+    
+    def send_apdu(self, apdu_command: list) -> Optional[bytes]:
+        """Send APDU command to card and return response"""
+        raise NotImplementedError
+    
+    def card_info(self) -> Dict[str, Any]:
+        """ATQA/SAK/ATS (or ATR) of the card in the field, where the reader reports them"""
+        return {}
+    
+    def get_reader_name(self) -> str:
+        """Get reader type name"""
+        raise NotImplementedError
+    
+    def is_connected(self) -> bool:
+        """Check the reader is still attached (used for hot-plug detection)"""
+        return True
+
+
+class ACR122UReader(ReaderInterface):
+    """ACR122U reader implementation using PC/SC"""
+    
+    def __init__(self):
+        self.connection = None
+        self.reader = None
+        self.logger = logging.getLogger(__name__)
+        self.current_uid = None
+    
+    def initialize(self, config: Dict[str, Any]) -> bool:
+        """Initialize ACR122U via PC/SC"""
+        try:
+            # Get available readers
+            reader_list = readers()
+            
+            if not reader_list:
+                self.logger.error("❌ No PC/SC readers found")
+                return False
+            
+            # Find ACR122U or use first available reader
+            self.reader = None
+            for r in reader_list:
+                reader_name = str(r).upper()
+                if 'ACR122' in reader_name or 'ACS' in reader_name:
+                    self.reader = r
+                    break
+            
+            if not self.reader:
+                # Use first available reader
+                self.reader = reader_list[0]
+            
+            self.logger.info(f"✅ ACR122U reader found: {self.reader}")
+            return True
+            
+        except Exception as e:
+            self.logger.error(f"❌ Failed to initialize ACR122U: {e}")
+            return False
+    
+    def read_uid(self, timeout: float = 0.05) -> Optional[bytes]:
+        """Read card UID using PC/SC"""
+        try:
+            # Try to connect to card
+            if not self.connection:
+                try:
+                    self.connection = self.reader.createConnection()
+                    self.connection.connect()
+                except Exception as e:
+                    self.connection = None
+                    self.current_uid = None
+                    if not self.is_no_card_error(e):
+                        # Reader unplugged or pcscd restarted
+                        self.read_errors += 1
+                        self.logger.debug(f"Reader connect error: {e}")
+                    return None
+            
+            # Get UID using standard APDU command
+            # Command: FF CA 00 00 00 (Get UID)
+            get_uid_apdu = [0xFF, 0xCA, 0x00, 0x00, 0x00]
+            
+            try:
+                data, sw1, sw2 = self.connection.transmit(get_uid_apdu)
+                
+                if sw1 == 0x90 and sw2 == 0x00:
+                    # Success - convert to bytes
+                    uid = bytes(data)
+                    self.current_uid = uid
+                    return uid
+                else:
+                    # No card or error
+                    self.connection = None
+                    self.current_uid = None
+                    return None
+                    
+            except Exception as e:
+                # Card removed or connection lost
+                self.connection = None
+                self.current_uid = None
+                return None
+                
+        except Exception as e:
+            self.read_errors += 1
+            self.logger.debug(f"Read UID error: {e}")
+            return None
+    
+    @staticmethod
+    def is_no_card_error(error: Exception) -> bool:
+        """True if a connect failure just means no card is on the reader"""
+        if type(error).__name__ == 'NoCardException':
+            return True
+        message = str(error).lower()
+        return any(text in message for text in ('no smart card', 'unpowered', 'removed'))
+    
+    def send_apdu(self, apdu_command: list) -> Optional[bytes]:
+        """Send APDU command to card via PC/SC"""
+        try:
+            if not self.connection:
+                return None
+            
+            data, sw1, sw2 = self.connection.transmit(apdu_command)
+            
+            if sw1 == 0x90 and sw2 == 0x00:
+                return bytes(data)
+            elif sw1 == 0x91:
+                # Wrapped DESFire command: the caller reads the native status
+                return bytes(data) + bytes([sw1, sw2])
+            else:
+                self.logger.error(f"❌ APDU error: SW={sw1:02X}{sw2:02X}")
+                return None
+                
+        except Exception as e:
+            self.rf_errors += 1
+            self.logger.error(f"❌ APDU transmission error: {e}")
+            return None
+    
+    def card_info(self) -> Dict[str, Any]:
+        try:
+            return {'atr': bytes(self.connection.getATR()).hex().upper()} if self.connection else {}
+        except Exception:
+            return {}
+    
+    def get_reader_name(self) -> str:
+        return "ACR122U (USB/PC-SC)"
+    
+    def is_connected(self) -> bool:
+        """Check the reader is still listed by pcscd"""
+        try:
+            return str(self.reader) in [str(r) for r in readers()]
+        except Exception:
+            return False
+
+
+class MCRN2Reader(ReaderInterface):
+    """MCRN2 reader implementation using PN532 SPI"""
+    
+    def __init__(self):
+        self.nfc_reader = None
+        self.logger = logging.getLogger(__name__)
+        self.card = {}
+    
+    def initialize(self, config: Dict[str, Any]) -> bool:
+        """Initialize MCRN2 via SPI"""
+        try:
+            # Initialize SPI bus
+            spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
+            
+            # Get pin configuration
+            spi_pins = config.get('spi_pins', {})
+            cs_gpio = spi_pins.get('cs', 8)
+            reset_gpio = spi_pins.get('reset', 25)
+            
+            # Initialize CS and Reset pins
+            cs_pin = DigitalInOut(getattr(board, f'D{cs_gpio}'))
+            reset_pin = DigitalInOut(getattr(board, f'D{reset_gpio}'))
+            
+            # Initialize PN532 on SPI
+            self.nfc_reader = PN532_SPI(spi, cs_pin, reset=reset_pin, debug=False)
+            
+            # Configure SAM (Security Access Module)
+            self.nfc_reader.SAM_configuration()
+            
+            self.logger.info("✅ MCRN2 (PN532) reader initialized")
+            return True
+            
+        except Exception as e:
+            self.logger.error(f"❌ Failed to initialize MCRN2: {e}")
+            return False
+    
+    def read_uid(self, timeout: float = 0.05) -> Optional[bytes]:
+        """Read card UID using PN532"""
+        try:
+            if not self.nfc_reader:
+                return None
+            
+            # Same as read_passive_target, keeping ATQA/SAK/ATS from the InListPassiveTarget answer
+            if not self.nfc_reader.listen_for_passive_target(timeout=timeout):
+                return None
+            response = self.nfc_reader.process_response(0x4A, response_length=30, timeout=timeout)
+            if response is None:
+                return None
+            if response[0] != 0x01:
+                # Two cards in the field: nothing to read until one is taken away, but the reader is fine
+                self.logger.debug(f"{response[0]} cards in the field - ignoring")
+                return None
+            if response[5] > 7:
+                raise RuntimeError(f"unexpected InListPassiveTarget answer {bytes(response).hex()}")
+            
+            uid_end = 6 + response[5]
+            ats = bytes(response[uid_end + 1:uid_end + response[uid_end]]) if len(response) > uid_end else b''
+            self.card = {'atqa': bytes(response[2:4]).hex().upper(), 'sak': response[4],
+                         'ats': ats.hex().upper() or None}
+            return bytes(response[6:uid_end])
+            
+        except Exception as e:
+            # No card is a None result - exceptions are SPI/PN532 failures
+            self.read_errors += 1
+            self.logger.debug(f"Read UID error: {e}")
+            return None
+    
+    def send_apdu(self, apdu_command: list) -> Optional[bytes]:
+        """Send APDU command to card via PN532"""
+        try:
+            if not self.nfc_reader:
+                return None
+            
+            # Send APDU via PN532's InDataExchange
+            response = self.nfc_reader.in_data_exchange(apdu_command)
+            
+            if response and len(response) >= 1:
+                # PN532 prepends status byte (0x00 on success)
+                if response[0] == 0x00:
+                    # Skip PN532 status byte, return all DESFire data
+                    # This includes DESFire payload + status words (0x91xx)
+                    desfire_response = bytes(response[1:])
+                    
+                    # Log DESFire status if present
+                    if len(desfire_response) >= 2:
+                        sw1 = desfire_response[-2]
+                        sw2 = desfire_response[-1]
+                        if sw1 == 0x91:
+                            self.logger.debug(f"DESFire status: 91{sw2:02X}")
+                    
+                    return desfire_response
+                else:
+                    self.rf_errors += 1
+                    self.logger.error(f"❌ PN532 communication error: Status={response[0]:02X}")
+                    return None
+            else:
+                self.rf_errors += 1
+                return None
+                
+        except Exception as e:
+            self.rf_errors += 1
+            self.logger.error(f"❌ APDU transmission error: {e}")
+            return None
+    
+    def card_info(self) -> Dict[str, Any]:
+        return dict(self.card)
+    
+    def get_reader_name(self) -> str:
+        return "MCRN2 (SPI/PN532)"
+    
+    def is_connected(self) -> bool:
+        """Check the PN532 still answers on the SPI bus"""
+        try:
+            return bool(self.nfc_reader and self.nfc_reader.firmware_version)
+        except Exception:
+            return False
+
+
+class MFRC522Reader(ReaderInterface):
+    """
+    MFRC522 reader implementation driving the chip registers over SPI
+    
+    SimpleMFRC522.read_no_block() authenticates and reads three sectors on
+    every poll and waits out the chip's 15 ms timer when no card answers.
+    This driver only does what a tap needs: WUPA, anticollision and select
+    (all cascade levels, so 7-byte DESFire UIDs come out whole), with a 1 ms
+    answer timeout and software CRC_A. A selected card is halted after its
+    tap and then only woken with WUPA to confirm it is still in the field.
+    Cards with SAK bit 6 get ISO14443-4 (RATS + I-blocks) for send_apdu().
+    Collisions (two cards in the field) read as no card.
+    """
+    
+    # Registers
+    COMMAND = 0x01
+    COM_IRQ = 0x04
+    ERROR = 0x06
+    FIFO_DATA = 0x09
+    FIFO_LEVEL = 0x0A
+    BIT_FRAMING = 0x0D
+    T_MODE = 0x2A
+    T_PRESCALER = 0x2B
+    T_RELOAD_H = 0x2C
+    T_RELOAD_L = 0x2D
+    VERSION = 0x37
+    
+    IDLE = 0x00
+    TRANSCEIVE = 0x0C
+    CHIP_VERSIONS = {0x12, 0x88, 0x90, 0x91, 0x92, 0xB2}  # MFRC522 v0/v1/v2 and common clones
+    
+    WUPA = 0x52
+    HLTA = (0x50, 0x00)
+    CASCADE = (0x93, 0x95, 0x97)
+    ACTIVATION_TIMEOUT = 0.001  # ATQA/UID/SAK arrive within ~100 µs
+    FSD = 64  # MFRC522 FIFO size - the largest frame we can receive (FSDI 5)
+    FSC_TABLE = (16, 24, 32, 40, 48, 64, 96, 128, 256)
+    
+    def __init__(self):
+        self.chip = None
+        self.logger = logging.getLogger(__name__)
+        self.presence_misses = 2
+        self.timer = None
+        self.reset_card()
+    
+    def reset_card(self):
+        self.uid = None
+        self.card = {}
+        self.state = None  # 'ready', 'active' (selected), 'protocol' (ISO14443-4) or 'halt'
+        self.misses = 0
+        self.fsc = 16
+        self.fwt = 0.005
+        self.block_number = 0
+    
+    def initialize(self, config: Dict[str, Any]) -> bool:
+        """Initialize MFRC522 via SPI"""
+        try:
+            spi_pins = config.get('spi_pins', {})
+            device = 1 if spi_pins.get('cs', 8) == 7 else 0  # CE0 = GPIO8, CE1 = GPIO7
+            self.chip = MFRC522(bus=0, device=device, spd=config.get('mfrc522_spi_hz', 4000000),
+                                pin_mode=GPIO.BCM, pin_rst=spi_pins.get('reset', 25))
+            self.presence_misses = config.get('mfrc522_presence_misses', 2)
+            
+            version = self.read(self.VERSION)
+            if version not in self.CHIP_VERSIONS:
+                raise RuntimeError(f"no MFRC522 on the SPI bus (version register {version:02X})")
+            
+            self.logger.info(f"✅ MFRC522 reader initialized (version {version:02X})")
+            return True
+            
+        except Exception as e:
+            self.logger.error(f"❌ Failed to initialize MFRC522: {e}")
+            return False
+    
+    def read(self, register: int) -> int:
+        return self.chip.spi.xfer2([(register << 1) & 0x7E | 0x80, 0])[1]
+    
+    def write(self, register: int, value: int):
+        self.chip.spi.xfer2([(register << 1) & 0x7E, value])
+    
+    @staticmethod
+    def crc_a(data: bytes) -> bytes:
+        """ISO14443-3 CRC_A, computed here rather than on the chip's coprocessor"""
+        crc = 0x6363
+        for byte in data:
+            byte ^= crc & 0xFF
+            byte = (byte ^ (byte << 4)) & 0xFF
+            crc = (crc >> 8) ^ (byte << 8) ^ (byte << 3) ^ (byte >> 4)
+        return bytes([crc & 0xFF, crc >> 8])
+    
+    def set_timeout(self, seconds: float):
+        """Program the chip timer (started at the end of each transmission)"""
+        prescaler = 169 if seconds <= 1.6 else 3390  # 25 µs or 0.5 ms ticks
+        ticks = min(0xFFFF, max(1, math.ceil(seconds * 13.56e6 / (2 * prescaler + 1))))
+        if self.timer == (prescaler, ticks):
+            return
+        self.write(self.T_MODE, 0x80 | prescaler >> 8)  # TAuto
+        self.write(self.T_PRESCALER, prescaler & 0xFF)
+        self.write(self.T_RELOAD_H, ticks >> 8)
+        self.write(self.T_RELOAD_L, ticks & 0xFF)
+        self.timer = (prescaler, ticks)
+    
+    def transceive(self, data: bytes, last_bits: int = 0, timeout: float = ACTIVATION_TIMEOUT,
+                   allow_collision: bool = False) -> Optional[bytes]:
+        """Send a frame and return the answer; None if no (clean) answer before timeout"""
+        self.set_timeout(timeout)
+        self.write(self.COMMAND, self.IDLE)
+        self.write(self.COM_IRQ, 0x7F)
+        self.write(self.FIFO_LEVEL, 0x80)
+        self.write(self.BIT_FRAMING, last_bits)
+        self.chip.spi.xfer2([(self.FIFO_DATA << 1) & 0x7E] + list(data))
+        self.write(self.COMMAND, self.TRANSCEIVE)
+        self.write(self.BIT_FRAMING, 0x80 | last_bits)  # StartSend
+        
+        deadline = time.perf_counter() + timeout + 0.05
+        while True:
+            irq = self.read(self.COM_IRQ)
+            if irq & 0x32:  # RxIRq, IdleIRq, ErrIRq
+                break
+            if irq & 0x01:  # TimerIRq - nothing answered
+                return None
+            if time.perf_counter() > deadline:
+                raise RuntimeError("MFRC522 timer did not fire")
+            if timeout > 0.005:
+                time.sleep(0.0005)
+        
+        error = self.read(self.ERROR)
+        if error & 0x13 or (error & 0x08 and not allow_collision):  # BufferOvfl/Parity/Protocol, CollErr
+            return None
+        count = self.read(self.FIFO_LEVEL) & 0x7F
+        if not count:
+            return None
+        return bytes(self.chip.spi.xfer2([(self.FIFO_DATA << 1) & 0x7E | 0x80] * count + [0])[1:])
+    
+    def transceive_crc(self, data: bytes, timeout: float = ACTIVATION_TIMEOUT) -> Optional[bytes]:
+        """Transceive a standard frame with CRC_A appended and checked"""
+        response = self.transceive(data + self.crc_a(data), timeout=timeout)
+        if response is None or len(response) < 3 or self.crc_a(response[:-2]) != response[-2:]:
+            return None
+        return response[:-2]
+    
+    def select(self) -> Optional[tuple]:
+        """Anticollision + select through the cascade levels -> (uid, sak)"""
+        uid = b''
+        for level in self.CASCADE:
+            answer = self.transceive(bytes([level, 0x20]))
+            if answer is None or len(answer) != 5 or answer[0] ^ answer[1] ^ answer[2] ^ answer[3] != answer[4]:
+                return None
+            sak = self.transceive_crc(bytes([level, 0x70]) + answer)
+            if sak is None or len(sak) != 1:
+                return None
+            if answer[0] != 0x88:  # Cascade tag - UID continues at the next level
+                return uid + answer[:4], sak[0]
+            if not sak[0] & 0x04:
+                return None
+            uid += answer[1:4]
+        return None
+    
+    def release(self):
+        """End the previous session so the card sits in HALT and answers WUPA"""
+        if self.state == 'protocol':
+            if self.transceive_crc(bytes([0xC2]), timeout=self.fwt) is None:  # S(DESELECT)
+                self.logger.debug("No answer to S(DESELECT)")
+        elif self.state in ('ready', 'active'):
+            self.transceive(bytes(self.HLTA) + self.crc_a(bytes(self.HLTA)))  # Not answered
+        self.state = 'halt'
+    
+    def read_uid(self, timeout: float = 0.05) -> Optional[bytes]:
+        """Read card UID: WUPA, then anticollision/select only for a new card"""
+        try:
+            if not self.chip:
+                return None
+            
+            self.release()
+            atqa = self.transceive(bytes([self.WUPA]), last_bits=7, allow_collision=True)
+            if atqa is None:
+                self.misses += 1
+                if self.uid and self.misses < self.presence_misses:
+                    return self.uid
+                self.reset_card()
+                return None
+            
+            self.misses = 0
+            self.state = 'ready'
+            if self.uid:
+                return self.uid
+            
+            selected = self.select()
+            if selected is None:
+                return None
+            self.uid, sak = selected
+            self.state = 'active'
+            self.card = {'atqa': atqa[::-1].hex().upper(), 'sak': sak, 'ats': None}
+            return self.uid
+            
+        except Exception as e:
+            # No card is a None result - exceptions are SPI/MFRC522 failures
+            self.read_errors += 1
+            self.state = None
+            self.logger.debug(f"Read UID error: {e}")
+            return None
+    
+    def activate(self) -> bool:
+        """Bring the tracked card to ISO14443-4 protocol state"""
+        if self.state == 'protocol':
+            return True
+        if self.state not in ('ready', 'active'):
+            if self.transceive(bytes([self.WUPA]), last_bits=7) is None:
+                return False
+            self.state = 'ready'
+        if self.state == 'ready':
+            selected = self.select()
+            if selected is None or selected[0] != self.uid:
+                return False
+            self.state = 'active'
+        if not self.card.get('sak', 0) & 0x20:
+            self.logger.debug("Card does not support ISO14443-4")
+            return False
+        
+        ats = self.transceive_crc(bytes([0xE0, 0x50]), timeout=0.005)  # RATS, FSDI 5, CID 0
+        if ats is None or not ats or ats[0] != len(ats):
+            return False
+        fsci, fwi, sfgi = 2, 4, 0
+        if len(ats) > 1:
+            t0 = ats[1]
+            fsci = t0 & 0x0F
+            if t0 & 0x20:
+                tb = ats[2 + bool(t0 & 0x10)]
+                fwi, sfgi = tb >> 4, tb & 0x0F
+        self.fsc = min(self.FSC_TABLE[min(fsci, 8)], self.FSD)
+        self.fwt = 256 * 16 / 13.56e6 * 2 ** min(fwi, 14)
+        if sfgi:
+            time.sleep(256 * 16 / 13.56e6 * 2 ** min(sfgi, 14))
+        self.card['ats'] = ats.hex().upper()
+        self.block_number = 0
+        self.state = 'protocol'
+        return True
+    
+    def block_exchange(self, block: bytes) -> bytes:
+        """Send one ISO14443-4 block, answering S(WTX) requests"""
+        response = self.transceive_crc(block, timeout=self.fwt)
+        while response and response[0] & 0xF7 == 0xF2:
+            multiplier = response[1] & 0x3F
+            response = self.transceive_crc(bytes([0xF2, multiplier]), timeout=self.fwt * max(multiplier, 1))
+        if not response:
+            raise RuntimeError(f"no answer to block {block[:1].hex().upper()}")
+        return response
+    
+    def send_apdu(self, apdu_command: list) -> Optional[bytes]:
+        """Send APDU command to card over ISO14443-4 I-blocks"""
+        try:
+            if not self.chip or not self.uid:
+                return None
+            if not self.activate():
+                self.rf_errors += 1
+                self.state = None
+                return None
+            
+            apdu = bytes(apdu_command)
+            size = self.fsc - 3  # PCB + CRC_A
+            chunks = [apdu[offset:offset + size] for offset in range(0, len(apdu), size)] or [b'']
+            for index, chunk in enumerate(chunks):
+                chaining = 0x10 if index < len(chunks) - 1 else 0x00
+                block = self.block_exchange(bytes([0x02 | chaining | self.block_number]) + chunk)
+                if chaining:
+                    if block[0] & 0xF6 != 0xA2:
+                        raise RuntimeError(f"expected R(ACK), got {block[:1].hex().upper()}")
+                    self.block_number ^= 1
+            
+            response = b''
+            while True:
+                if block[0] & 0xE2 != 0x02:
+                    raise RuntimeError(f"unexpected PCB {block[:1].hex().upper()}")
+                self.block_number ^= 1
+                response += block[1:]
+                if not block[0] & 0x10:
+                    break
+                block = self.block_exchange(bytes([0xA2 | self.block_number]))  # R(ACK) - next chained block
+            
+            if len(response) >= 2 and response[-2] == 0x91:
+                self.logger.debug(f"DESFire status: 91{response[-1]:02X}")
+            return response
+            
+        except Exception as e:
+            self.rf_errors += 1
+            self.state = None
+            self.logger.error(f"❌ APDU transmission error: {e}")
+            return None
+    
+    def card_info(self) -> Dict[str, Any]:
+        return dict(self.card)
+    
+    def get_reader_name(self) -> str:
+        return "MFRC522 (SPI)"
+    
+    def is_connected(self) -> bool:
+        """Check the MFRC522 still answers on the SPI bus"""
+        try:
+            return bool(self.chip) and self.read(self.VERSION) in self.CHIP_VERSIONS
+        except Exception:
+            return False
+
+
+class ReaderSupervisor(ReaderInterface):
+    """
+    Keeps a working reader available at runtime
+    
+    Wraps one driver per reader type, in priority order. The active driver
+    is marked failed after reader_error_threshold consecutive read errors or
+    when a periodic health check finds it unplugged; polling then fails over
+    to the next healthy driver. Failed and missing drivers are re-initialised
+    with exponential backoff, which also picks up hot-plugged readers, and
+    the preferred driver is switched back in once it recovers.
+    
+    All maintenance runs inside read_uid() on the polling thread, so reader
+    hardware is never touched from two threads at once.
+    """
+    
+    def __init__(self, drivers: List[tuple], get_config: Callable[[], Dict[str, Any]]):
+        # drivers: [(name, reader class)] in order of preference
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.drivers = [
+            {
+                'name': name,
+                'factory': factory,
+                'reader': None,
+                'state': 'down',
+                'consecutive_errors': 0,
+                'read_errors': 0,
+                'rf_errors': 0,
+                'reinit_count': 0,
+                'failovers': 0,
+                'backoff': 1.0,
+                'next_retry': 0.0,
+                'degraded_since': None,
+                'degraded_total': 0.0
+            }
+            for name, factory in drivers
+        ]
+        self.active = None
+        self.no_reader_since = None
+        self.no_reader_total = 0.0
+        self.last_health_check = time.monotonic()
+        self.reinit_requested = False
+    
+    def initialize(self, config: Dict[str, Any]) -> bool:
+        """Bring up every available driver; the first healthy one becomes active"""
+        for driver in self.drivers:
+            self.start_driver(driver, config)
+        
+        self.select_active()
+        return self.active is not None
+    
+    def start_driver(self, driver: Dict[str, Any], config: Dict[str, Any]) -> bool:
+        try:
+            reader = driver['factory']()
+            if reader.initialize(config):
+                driver['reader'] = reader
+                driver['state'] = 'ok'
+                driver['consecutive_errors'] = 0
+                driver['backoff'] = 1.0
+                self.end_degraded(driver)
+                return True
+        except Exception as e:
+            self.logger.debug(f"{driver['name']} not available: {e}")
+        
+        driver['reader'] = None
+        if driver['state'] == 'ok':
+            driver['state'] = 'failed'
+        self.schedule_retry(driver)
+        return False
+    
+    def schedule_retry(self, driver: Dict[str, Any]):
+        max_backoff = self.get_config().get('reader_retry_max', 60)
+        driver['next_retry'] = time.monotonic() + driver['backoff']
+        driver['backoff'] = min(max_backoff, driver['backoff'] * 2)
+    
+    def end_degraded(self, driver: Dict[str, Any]):
+        if driver['degraded_since'] is not None:
+            degraded_for = time.monotonic() - driver['degraded_since']
+            driver['degraded_total'] += degraded_for
+            driver['degraded_since'] = None
+            self.logger.info(f"✅ {driver['name']} recovered after {degraded_for:.1f}s")
+    
+    def select_active(self):
+        """Use the most preferred healthy driver"""
+        previous = self.active
+        self.active = next((d for d in self.drivers if d['state'] == 'ok'), None)
+        
+        if self.active is previous:
+            return
+        
+        now = time.monotonic()
+        if self.active:
+            if self.no_reader_since is not None:
+                self.no_reader_total += now - self.no_reader_since
+                self.no_reader_since = None
+            if previous:
+                self.active['failovers'] += 1
+            self.logger.info(f"🔁 Using {self.active['reader'].get_reader_name()}")
+        else:
+            self.no_reader_since = now
+            self.logger.error("❌ No working RFID reader - rescanning")
+    
+    def mark_failed(self, driver: Dict[str, Any], reason: str):
+        self.logger.error(f"❌ {driver['name']} reader failed ({reason})")
+        driver['state'] = 'failed'
+        driver['reader'] = None
+        driver['consecutive_errors'] = 0
+        if driver['degraded_since'] is None:
+            driver['degraded_since'] = time.monotonic()
+        self.schedule_retry(driver)
+        self.select_active()
+    
+    def request_reinit(self):
+        """Re-initialise the active reader on the next poll (thread-safe)"""
+        self.reinit_requested = True
+    
+    def maintain(self):
+        """Health checks, reinit with backoff and failback"""
+        now = time.monotonic()
+        config = self.get_config()
+        
+        if self.reinit_requested:
+            self.reinit_requested = False
+            if self.active:
+                self.mark_failed(self.active, "manual reinit")
+            for driver in self.drivers:
+                driver['next_retry'] = 0.0
+        
+        if self.active and now - self.last_health_check >= config.get('reader_health_interval', 5):
+            self.last_health_check = now
+            if not self.active['reader'].is_connected():
+                self.mark_failed(self.active, "disconnected")
+        
+        for driver in self.drivers:
+            if driver['state'] != 'ok' and now >= driver['next_retry']:
+                if self.start_driver(driver, config):
+                    driver['reinit_count'] += 1
+                    self.logger.info(f"🔌 {driver['name']} reader re-initialised")
+                    self.select_active()
+    
+    def read_uid(self, timeout: float = 0.05) -> Optional[bytes]:
+        self.maintain()
+        
+        driver = self.active
+        if not driver:
+            return None
+        
+        reader = driver['reader']
+        errors_before = reader.read_errors
+        uid = reader.read_uid(timeout=timeout)
+        
+        new_errors = reader.read_errors - errors_before
+        if new_errors:
+            driver['read_errors'] += new_errors
+            driver['consecutive_errors'] += new_errors
+            if driver['consecutive_errors'] >= self.get_config().get('reader_error_threshold', 5):
+                self.mark_failed(driver, f"{driver['consecutive_errors']} consecutive read errors")
+        else:
+            driver['consecutive_errors'] = 0
+        
+        return uid
+    
+    def send_apdu(self, apdu_command: list) -> Optional[bytes]:
+        driver = self.active
+        if not driver:
+            return None
+        
+        reader = driver['reader']
+        errors_before = reader.rf_errors
+        response = reader.send_apdu(apdu_command)
+        driver['rf_errors'] += reader.rf_errors - errors_before
+        self.rf_errors += reader.rf_errors - errors_before
+        return response
+    
+    def card_info(self) -> Dict[str, Any]:
+        return self.active['reader'].card_info() if self.active else {}
+    
+    def get_reader_name(self) -> str:
+        if self.active:
+            return self.active['reader'].get_reader_name()
+        return "No reader (rescanning)"
+    
+    def get_status(self) -> Dict[str, Any]:
+        """Reader health diagnostics"""
+        now = time.monotonic()
+        
+        def degraded_seconds(since, total):
+            return round(total + (now - since if since is not None else 0.0), 1)
+        
+        return {
+            'active': self.active['name'] if self.active else None,
+            'noReaderSeconds': degraded_seconds(self.no_reader_since, self.no_reader_total),
+            'drivers': [
+                {
+                    'name': d['name'],
+                    'state': d['state'],
+                    'readErrors': d['read_errors'],
+                    'rfErrors': d['rf_errors'],
+                    'reinitCount': d['reinit_count'],
+                    'failovers': d['failovers'],
+                    'degradedSeconds': degraded_seconds(d['degraded_since'], d['degraded_total'])
+                }
+                for d in self.drivers
+            ]
+        }
+
+
+def reader_drivers(reader_type: str, logger: logging.Logger) -> List[tuple]:
+    """Reader drivers to try for reader_type, in order of preference"""
+    # ACR122U first - USB is more common
+    drivers = []
+    if reader_type in ('auto', 'acr122u'):
+        if ACR122U_AVAILABLE:
+            drivers.append(('acr122u', ACR122UReader))
+        elif reader_type == 'acr122u':
+            logger.error("❌ ACR122U libraries not installed")
+    if reader_type in ('auto', 'mcrn2'):
+        if MCRN2_AVAILABLE:
+            drivers.append(('mcrn2', MCRN2Reader))
+        elif reader_type == 'mcrn2':
+            logger.error("❌ MCRN2 libraries not installed")
+    if reader_type in ('auto', 'mfrc522'):
+        if MFRC522_AVAILABLE:
+            drivers.append(('mfrc522', MFRC522Reader))
+        elif reader_type == 'mfrc522':
+            logger.error("❌ MFRC522 libraries not installed")
+    return drivers
+
+
+class CardCapabilities:
+    """
+    Per-UID card type cache: DESFire generation and auth command
+    
+    The first tap of a UID checks the SAK (or PC/SC ATR) for ISO14443-4
+    support and reads GetVersion (90 60, chained with 90 AF). The result
+    picks the authentication command for that generation and is kept in a
+    bounded LRU (card_capability_cache_size), so later taps of the card go
+    straight to authentication. Cards that are not DESFire EV1 or later
+    are rejected before any network call. A card without GetVersion is
+    only cached as not DESFire when it refused the command with a definite
+    status word (NOT_DESFIRE_STATUS); a dropped connection or any other
+    answer is not cached and the card is probed again on its next tap.
+    """
+    
+    # GetVersion hardware major version -> generation
+    GENERATIONS = {0x00: 'EV0', 0x01: 'EV1', 0x12: 'EV2', 0x22: 'EV2', 0x30: 'EV3', 0x33: 'EV3'}
+    DESFIRE_HW_TYPES = (0x01, 0x81)
+    
+    # Auth command (INS) per generation; desfire_auth_commands overrides, e.g. {"EV1": "AA"}
+    AUTH_COMMANDS = {'EV1': 0x1A, 'EV2': 0xAA, 'EV3': 0xAA}
+    DEFAULT_AUTH_COMMAND = 0xAA  # Card type could not be read
+    
+    # ISO 7816 "CLA not supported" / "INS not supported": the card cannot speak DESFire
+    NOT_DESFIRE_STATUS = ('6E00', '6D00')
+    
+    # PC/SC part 3 ATR of a storage card (MIFARE Classic, Ultralight, ...): no ISO14443-4
+    PCSC_STORAGE_ATR = bytes.fromhex('804F0CA000000306')
+    
+    def __init__(self, get_config: Callable[[], Dict[str, Any]]):
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.cards = OrderedDict()
+        self.stats = {'hits': 0, 'probes': 0, 'uncertain': 0, 'rejected': 0, 'types': {}}
+    
+    def detect(self, uid_hex: str, reader: ReaderInterface) -> Dict[str, Any]:
+        """Capability of the card in the field: cached, or probed now"""
+        with self.lock:
+            capability = self.cards.get(uid_hex)
+            if capability is not None:
+                self.cards.move_to_end(uid_hex)
+                self.stats['hits'] += 1
+                return dict(capability, cached=True)
+        
+        capability, certain = self.probe(reader)
+        with self.lock:
+            self.stats['probes'] += 1
+            if not capability['supported']:
+                self.stats['rejected'] += 1
+            if not certain:
+                self.stats['uncertain'] += 1
+                return dict(capability, cached=False)
+            self.stats['types'][capability['type']] = self.stats['types'].get(capability['type'], 0) + 1
+        self.remember(uid_hex, capability)
+        return dict(capability, cached=False)
+    
+    def remember(self, uid_hex: str, capability: Dict[str, Any]):
+        with self.lock:
+            self.cards[uid_hex] = capability
+            while len(self.cards) > self.get_config().get('card_capability_cache_size', 1024):
+                self.cards.popitem(last=False)
+    
+    def auth_command(self, generation: str) -> int:
+        overrides = self.get_config().get('desfire_auth_commands') or {}
+        if generation in overrides:
+            return int(overrides[generation], 16)
+        return self.AUTH_COMMANDS[generation]
+    
+    def probe(self, reader: ReaderInterface) -> tuple:
+        """(capability, certain) from SAK/ATR and GetVersion"""
+        info = reader.card_info()
+        sak, atr = info.get('sak'), info.get('atr')
+        if sak is not None and not sak & 0x20:
+            return self.unsupported('no-iso14443-4', f"SAK {sak:02X} (not ISO14443-4)"), True
+        if atr and self.PCSC_STORAGE_ATR in bytes.fromhex(atr):
+            return self.unsupported('no-iso14443-4', "PC/SC storage card ATR (not ISO14443-4)"), True
+        
+        version, status = self.get_version(reader)
+        if version is None:
+            if status in self.NOT_DESFIRE_STATUS:
+                return self.unsupported('not-desfire', f"GetVersion refused ({status})"), True
+            # No answer (card pulled away, reader connection lost) or an unexpected
+            # status - try the default command, decide next time
+            return {'supported': True, 'type': 'unknown', 'authCommand': self.DEFAULT_AUTH_COMMAND}, False
+        
+        if version[1] not in self.DESFIRE_HW_TYPES:
+            return self.unsupported('not-desfire', f"hardware type {version[1]:02X} is not DESFire"), True
+        
+        major = version[3]
+        generation = self.GENERATIONS.get(major) or {1: 'EV2', 2: 'EV2', 3: 'EV3'}.get(major >> 4, 'EV3')
+        if generation == 'EV0':
+            return self.unsupported('EV0', "DESFire EV0 has no AES authentication"), True
+        return {'supported': True, 'type': generation, 'authCommand': self.auth_command(generation),
+                'version': version.hex().upper()}, True
+    
+    @staticmethod
+    def get_version(reader: ReaderInterface) -> tuple:
+        """
+        (GetVersion data or None, last status word as hex or None if there was no answer)
+        
+        GetVersion returns 3 frames of hardware, software and production data.
+        """
+        data = b''
+        command = [0x90, 0x60, 0x00, 0x00, 0x00]
+        for _ in range(3):
+            response = reader.send_apdu(command)
+            if not response or len(response) < 2:
+                return None, None
+            status = bytes(response[-2:]).hex().upper()
+            if response[-2] != 0x91:
+                return None, status
+            data += bytes(response[:-2])
+            if response[-1] == 0x00:
+                return (data if len(data) >= 7 else None), status
+            if response[-1] != 0xAF:
+                return None, status
+            command = [0x90, 0xAF, 0x00, 0x00, 0x00]
+        return None, status
+    
+    @staticmethod
+    def unsupported(card_type: str, reason: str) -> Dict[str, Any]:
+        return {'supported': False, 'type': card_type, 'authCommand': None, 'reason': reason}
+    
+    def get_status(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(self.stats, types=dict(self.stats['types']), cached=len(self.cards))
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+UrbanKetl Tap Replay - Deterministic Performance Regression Runs
+Feeds tap traces recorded by the unified controller ("trace_recording": true)
+back through UrbanKetlUnifiedMachine with a fake reader and stubbed HTTP layer
+
+Usage:
+    python3 urbanketl_replay.py tap_traces.jsonl           # original timings
+    python3 urbanketl_replay.py tap_traces.jsonl --fast    # as fast as possible
+"""
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import deque
+from typing import Optional, Dict, Any, List
+
+import requests
+
+from urbanketl_machine_unified import (
+    ApiClient,
+    CardCapabilities,
+    ReaderInterface,
+    UrbanKetlUnifiedMachine,
+    percentile,
+)
+
+
+class ReplayReader(ReaderInterface):
+    """Reader that answers APDUs from a recorded trace"""
+
+    def __init__(self, realtime: bool):
+        self.realtime = realtime
+        self.events = deque()
+        self.mismatches = 0
+
+    def load(self, trace: Dict[str, Any]):
+        self.events = deque(e for e in trace['events'] if e['k'] == 'apdu')
+
+    def initialize(self, config: Dict[str, Any]) -> bool:
+        return True
+
+    def read_uid(self, timeout: float = 0.05) -> Optional[bytes]:
+        return None
+
+    def send_apdu(self, apdu_command: list) -> Optional[bytes]:
+        if not self.events:
+            self.mismatches += 1
+            return None
+
+        event = self.events.popleft()
+        if event['c'] != bytes(apdu_command).hex():
+            self.mismatches += 1
+
+        if self.realtime:
+            time.sleep(event['ms'] / 1000.0)
+        return bytes.fromhex(event['r']) if event.get('r') else None
+
+    def get_reader_name(self) -> str:
+        return "Replay"
+
+
+class ReplayResponse:
+    """Minimal stand-in for requests.Response"""
+
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text or ''
+        self.headers = {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class ReplayApiClient(ApiClient):
+    """HTTP layer that returns recorded responses in order"""
+
+    def __init__(self, realtime: bool):
+        super().__init__(lambda: {'api_base_url': 'http://replay', 'api_timeout': 5})
+        self.realtime = realtime
+        self.events = deque()
+        self.mismatches = 0
+
+    def load(self, trace: Dict[str, Any]):
+        self.events = deque(e for e in trace['events'] if e['k'] == 'http')
+
+    def request(self, method: str, path: str, timeout: Optional[float] = None, **kwargs):
+        if not self.events:
+            self.mismatches += 1
+            raise requests.ConnectionError("replay: no recorded response left")
+
+        event = self.events.popleft()
+        if event['m'] != method or event['p'] != path:
+            self.mismatches += 1
+
+        if self.realtime:
+            time.sleep(event['ms'] / 1000.0)
+
+        if 'err' in event:
+            raise requests.ConnectionError(event['err'])
+        return ReplayResponse(event['s'], event.get('res'))
+
+
+class ReplayMachine(UrbanKetlUnifiedMachine):
+    """Controller with LEDs, buzzer and valve replaced by recorded timings"""
+
+    def __init__(self, config_file: str, realtime: bool):
+        self.realtime = realtime
+        self.dispense_ms = 0.0
+        super().__init__(config_file, reader=ReplayReader(realtime), api=ReplayApiClient(realtime))
+
+    def setup_gpio(self, previous_pins=None):
+        pass
+
+    def load(self, trace: Dict[str, Any]):
+        """Prepare reader, HTTP stub and config for one trace"""
+        self.reader.load(trace)
+        self.api.load(trace)
+
+        # Card type as detected when recorded (traces from before detection used the default command)
+        card = next((e for e in trace['events'] if e['k'] == 'card'), None)
+        fields = {k: v for k, v in card.items() if k not in ('k', 't', 'ms', 'cached')} if card else \
+            {'supported': True, 'type': 'unknown', 'authCommand': CardCapabilities.DEFAULT_AUTH_COMMAND}
+        self.card_capabilities.remember(trace.get('uid'), fields)
+
+        dispense = [e for e in trace['events'] if e['k'] == 'dispense']
+        self.dispense_ms = dispense[0]['ms'] if dispense else 0.0
+
+        cfg = trace.get('cfg', {})
+        self.config = dict(self.config, card_removal_delay=cfg.get('card_removal_delay', 0.5) if self.realtime else 0)
+        self.price_cache.price = cfg.get('price')
+        self.price_cache.machine_id = self.config['machine_id']
+
+    def dispense_tea(self, profile=None):
+        if self.realtime:
+            time.sleep(self.dispense_ms / 1000.0)
+
+    def set_led(self, color: str, mode: str = 'on'):
+        pass
+
+    def beep(self, duration: float = 0.1):
+        pass
+
+    def show_success(self):
+        if self.realtime:
+            time.sleep(0.5)
+
+
+def load_traces(path: str) -> List[Dict[str, Any]]:
+    traces = []
+    with open(path, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                traces.append(json.loads(line))
+            except ValueError:
+                print(f"⚠️  Skipping malformed trace on line {line_number}")
+    return traces
+
+
+def replay(traces: List[Dict[str, Any]], realtime: bool, repeat: int) -> Dict[str, Any]:
+    """Run every trace through the controller and collect timings"""
+    config_dir = tempfile.mkdtemp(prefix='urbanketl-replay-')
+    config_file = os.path.join(config_dir, 'machine_config.json')
+    with open(config_file, 'w') as f:
+        json.dump({'api_base_url': 'http://replay', 'push_enabled': False,
+                   'dispense_journal_file': os.path.join(config_dir, 'dispense_journal.jsonl')}, f)
+
+    machine = ReplayMachine(config_file, realtime)
+
+    results = []
+    for _ in range(repeat):
+        for trace in traces:
+            machine.load(trace)
+            started = time.perf_counter()
+            outcome = machine.process_desfire_authentication(trace['uid'])
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            results.append({
+                'uid': trace['uid'],
+                'ts': trace.get('ts'),
+                'recordedMs': trace.get('totalMs'),
+                'replayedMs': round(elapsed_ms, 2),
+                'outcomeMatches': bool(outcome) == bool(trace.get('outcome'))
+            })
+
+    recorded = [r['recordedMs'] for r in results if r['recordedMs'] is not None]
+    replayed = [r['replayedMs'] for r in results]
+    return {
+        'mode': 'realtime' if realtime else 'fast',
+        'taps': len(results),
+        'recordedP50': percentile(recorded, 50),
+        'recordedP95': percentile(recorded, 95),
+        'replayedP50': percentile(replayed, 50),
+        'replayedP95': percentile(replayed, 95),
+        'replayedMax': percentile(replayed, 100),
+        'outcomeMismatches': sum(1 for r in results if not r['outcomeMatches']),
+        'apduMismatches': machine.reader.mismatches,
+        'httpMismatches': machine.api.mismatches,
+        'results': results
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded UrbanKetl tap traces")
+    parser.add_argument('trace_file', help="JSON-lines trace file (trace_file in machine_config.json)")
+    parser.add_argument('--fast', action='store_true', help="Skip recorded delays and measure controller overhead only")
+    parser.add_argument('--repeat', type=int, default=1, help="Replay the trace set N times")
+    parser.add_argument('--json', action='store_true', help="Print the full report as JSON")
+    args = parser.parse_args()
+
+    # Keep controller logging quiet unless something goes wrong
+    logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    traces = load_traces(args.trace_file)
+    if not traces:
+        print("❌ No traces found")
+        return
+
+    report = replay(traces, realtime=not args.fast, repeat=args.repeat)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"🔁 Replayed {report['taps']} taps ({report['mode']})")
+    for r in report['results']:
+        marker = "✅" if r['outcomeMatches'] else "❌"
+        print(f"   {marker} {r['ts']} {r['uid']}: recorded {r['recordedMs']}ms, replayed {r['replayedMs']}ms")
+    print(f"📊 Recorded p50/p95: {report['recordedP50']}ms / {report['recordedP95']}ms")
+    print(f"📊 Replayed p50/p95/max: {report['replayedP50']}ms / {report['replayedP95']}ms / {report['replayedMax']}ms")
+    if report['outcomeMismatches'] or report['apduMismatches'] or report['httpMismatches']:
+        print(f"⚠️  Mismatches - outcome: {report['outcomeMismatches']}, "
+              f"APDU: {report['apduMismatches']}, HTTP: {report['httpMismatches']}")
+
+
+if __name__ == "__main__":
+    main()
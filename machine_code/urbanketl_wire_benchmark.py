@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+UrbanKetl Wire Format Benchmark
+Compares bytes on the wire and encode/decode CPU per tap for the current
+requests JSON path against MessagePack and CBOR (wire_format setting)
+
+Usage:
+    python3 urbanketl_wire_benchmark.py                 # run on the Pi itself
+    python3 urbanketl_wire_benchmark.py --iterations 5000 --json
+"""
+
+import argparse
+import json
+import time
+import uuid
+from typing import Dict, Any, List, Tuple
+
+import requests
+
+from urbanketl_machine_unified import WireCodec
+
+
+def tap_messages() -> List[Tuple[str, Dict[str, Any], Dict[str, Any]]]:
+    """(name, request, response) for one tap plus one heartbeat, shaped like the real server"""
+    card_uid = '04A1B2C3D4E5F6'
+    challenge = uuid.uuid4().hex.upper()
+    challenge_id = str(uuid.uuid4())
+    return [
+        ('challenge',
+         {'machineId': 'UK_0001', 'cardUid': card_uid},
+         {'success': True, 'challengeId': challenge_id, 'challenge': challenge}),
+        ('validate',
+         {'challengeId': challenge_id, 'response': uuid.uuid4().hex.upper(), 'cardUid': card_uid},
+         {'success': True, 'authenticated': True, 'cardNumber': 'UK-CARD-000123',
+          'businessUnitId': str(uuid.uuid4()), 'businessUnitName': 'Acme Offices Ltd',
+          'walletBalance': '1250.00', 'challengeData': {'challenge': challenge, 'challengeId': challenge_id}}),
+        ('dispense',
+         {'machineId': 'UK_0001', 'cardNumber': 'UK-CARD-000123', 'businessUnitId': str(uuid.uuid4()),
+          'amount': 5.0, 'quantity': 1},
+         {'success': True, 'newBalance': '1245.00', 'message': 'Tea dispensed successfully',
+          'transaction': {'id': 48213, 'amount': '5.00', 'type': 'tea_payment', 'createdAt': '2025-10-09T09:00:01.123Z'}}),
+        ('heartbeat',
+         {'machineId': 'UK_0001', 'status': 'online', 'pushConnected': True, 'dailyDispensed': 87,
+          'totalDispensed': 10432,
+          'memory': {'rssMb': 41.3, 'rssGrowthMbPerHour': 0.12, 'heapBlocks': 118204, 'gcCounts': [312, 4, 1],
+                     'threads': 6, 'tracemalloc': False,
+                     'topTypes': [['function', 5715], ['dict', 2593], ['tuple', 2401], ['list', 844]]}},
+         {'success': True}),
+    ]
+
+
+def json_encode(payload: Dict[str, Any]) -> bytes:
+    """What requests does for json= (PreparedRequest.prepare_body)"""
+    prepared = requests.models.PreparedRequest()
+    prepared.prepare_headers({})
+    prepared.prepare_body(data=None, files=None, json=payload)
+    return prepared.body
+
+
+def json_decode(body: bytes) -> Any:
+    """What response.json() does"""
+    response = requests.models.Response()
+    response._content = body
+    response.headers['Content-Type'] = 'application/json; charset=utf-8'
+    response.encoding = 'utf-8'
+    return response.json()
+
+
+def measure(encode, decode, messages, iterations: int) -> Dict[str, Any]:
+    # Encode the request and decode the response, like the controller does
+    request_bodies = [encode(request) for _, request, _ in messages]
+    response_bodies = [encode(response) for _, _, response in messages]
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for _, request, _ in messages:
+            encode(request)
+    encode_us = (time.perf_counter() - started) / iterations * 1_000_000
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for body in response_bodies:
+            decode(body)
+    decode_us = (time.perf_counter() - started) / iterations * 1_000_000
+
+    return {
+        'requestBytes': {name: len(body) for (name, _, _), body in zip(messages, request_bodies)},
+        'responseBytes': {name: len(body) for (name, _, _), body in zip(messages, response_bodies)},
+        'bytesPerTap': sum(len(b) for b in request_bodies) + sum(len(b) for b in response_bodies),
+        'encodeUsPerTap': round(encode_us, 1),
+        'decodeUsPerTap': round(decode_us, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark UrbanKetl wire formats")
+    parser.add_argument('--iterations', type=int, default=2000, help="Taps to encode/decode per format")
+    parser.add_argument('--json', action='store_true', help="Print the full report as JSON")
+    args = parser.parse_args()
+
+    messages = tap_messages()
+    report = {'json': measure(json_encode, json_decode, messages, args.iterations)}
+
+    for name in ('msgpack', 'cbor'):
+        if not WireCodec.available(name):
+            report[name] = None
+            continue
+        codec = WireCodec(name)
+        report[name] = measure(codec.encode, codec.decode, messages, args.iterations)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    baseline = report['json']['bytesPerTap']
+    print(f"📦 Wire formats - one tap (challenge, validate, dispense) + one heartbeat, {args.iterations} iterations")
+    print(f"   {'Format':<10} {'Bytes':>7} {'vs JSON':>8} {'Encode µs':>10} {'Decode µs':>10}")
+    for name, result in report.items():
+        if result is None:
+            print(f"   {name:<10} {'(not installed)':>37}")
+            continue
+        saving = (1 - result['bytesPerTap'] / baseline) * 100
+        print(f"   {name:<10} {result['bytesPerTap']:>7} {-saving:>+7.0f}% "
+              f"{result['encodeUsPerTap']:>10} {result['decodeUsPerTap']:>10}")
+    print("")
+    print("   Body bytes only. HTTP headers are the same size in every format, except the")
+    print("   ~40-byte Accept header that binary formats add. Per message:")
+    for name, result in report.items():
+        if result:
+            sizes = ', '.join(f"{m} {result['requestBytes'][m]}/{result['responseBytes'][m]}" for m in result['requestBytes'])
+            print(f"   {name:<10} {sizes}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,562 @@
+"""
+UrbanKetl Tea Machine Controller - Workers
+Reader and actuator child processes (process_mode "processes") and the
+tap worker
+"""
+
+import time
+import logging
+import threading
+import multiprocessing
+import signal
+from collections import deque
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Callable
+
+from urbanketl_common import percentile
+from urbanketl_diagnostics import LivenessMonitor
+from urbanketl_dispenser import Actuator
+from urbanketl_readers import ReaderInterface, ReaderSupervisor, reader_drivers
+
+
+def start_child_process() -> logging.Logger:
+    """Logging and signal setup shared by the controller's child processes"""
+    # The parent handles Ctrl-C, reloads and profiling, then stops its children
+    for signum in (signal.SIGINT, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2):
+        signal.signal(signum, signal.SIG_IGN)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('urbanketl_machine.log'),
+            logging.StreamHandler()
+        ]
+    )
+    return logging.getLogger(__name__)
+
+
+def serve_call(rpc, message: tuple, handlers: Dict[str, Callable]) -> bool:
+    """Run one request from the parent. Returns False when asked to stop."""
+    call_id, op, args = message
+    if op == 'stop':
+        if call_id is not None:
+            rpc.send((call_id, True, None))
+        return False
+    
+    try:
+        value, ok = handlers[op](*args), True
+    except Exception as e:
+        value, ok = f"{type(e).__name__}: {e}", False
+    if call_id is not None:
+        rpc.send((call_id, ok, value))
+    return True
+
+
+def reader_process_main(rpc, events, config: Dict[str, Any]):
+    """
+    Reader process: polls for cards on its own core
+    
+    Pushes ('uid', uid) whenever the card in the field changes. After a new
+    card it stops polling until the parent sends 'arm', so the card is left
+    alone while the tap's APDUs run. Between polls it serves 'apdu',
+    'card_info', 'configure', 'reinit', 'status' and 'ping' requests.
+    """
+    logger = start_child_process()
+    state = {'config': config}
+    reader = ReaderSupervisor(reader_drivers(config.get('reader_type', 'auto'), logger), lambda: state['config'])
+    if not reader.initialize(config):
+        logger.warning("⚠️  No reader attached yet - will keep scanning")
+    events.send(('ready', reader.get_reader_name()))
+    
+    polling = {'armed': True, 'uid': None}
+    
+    def arm():
+        polling['armed'] = True
+    
+    def configure(new_config):
+        state['config'] = new_config
+    
+    def apdu(command):
+        # RF error count travels back so the parent can tell a failed exchange from a refusal
+        errors_before = reader.rf_errors
+        response = reader.send_apdu(command)
+        return response, reader.rf_errors - errors_before
+    
+    handlers = {
+        'apdu': apdu,
+        'card_info': reader.card_info,
+        'arm': arm,
+        'configure': configure,
+        'reinit': reader.request_reinit,
+        'status': lambda: dict(reader.get_status(), name=reader.get_reader_name()),
+        'ping': lambda: True
+    }
+    
+    try:
+        while True:
+            interval = state['config'].get('polling_interval', 0.05)
+            if rpc.poll(interval if polling['armed'] else 1.0):
+                if not serve_call(rpc, rpc.recv(), handlers):
+                    return
+                continue
+            
+            if polling['armed']:
+                uid = reader.read_uid(timeout=0.05)
+                if uid != polling['uid']:
+                    polling['uid'] = uid
+                    events.send(('uid', uid))
+                    if uid:
+                        polling['armed'] = False
+    except (EOFError, OSError):
+        pass  # Parent went away
+
+
+def actuator_process_main(rpc, events, config: Dict[str, Any]):
+    """Actuator process: valve, LEDs and buzzer, one command at a time"""
+    start_child_process()
+    state = {'config': config}
+    actuator = Actuator(lambda: state['config'])
+    actuator.setup()
+    
+    def configure(new_config, previous_pins=None):
+        state['config'] = new_config
+        actuator.setup(previous_pins)
+    
+    handlers = {
+        'configure': configure,
+        'dispense': actuator.dispense,
+        'dispense_volume': actuator.dispense_volume,
+        'dispense_sequence': actuator.dispense_sequence,
+        'set_led': actuator.set_led,
+        'beep': actuator.beep,
+        'ping': lambda: True
+    }
+    
+    try:
+        while serve_call(rpc, rpc.recv(), handlers):
+            pass
+    except (EOFError, OSError):
+        pass  # Parent went away
+    finally:
+        actuator.release()
+
+
+class WorkerProcess:
+    """
+    Supervised child process driven over a pipe (process_mode "processes")
+    
+    Requests go over a duplex pipe as (call_id, op, args); call_id is None
+    for fire-and-forget commands. Events flow back on a second, one-way
+    pipe. A child that exits, stops answering pings or misses a reply
+    deadline is killed and restarted with exponential backoff; calls made
+    while it is down fail at once instead of blocking the tap.
+    """
+    
+    def __init__(self, name: str, target: Callable, get_config: Callable[[], Dict[str, Any]]):
+        self.name = name
+        self.target = target
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.context = multiprocessing.get_context('spawn')  # No forking a process that runs threads
+        self.lock = threading.Lock()
+        self.process = None
+        self.rpc = None
+        self.events = None
+        self.next_id = 0
+        self.running = False
+        self.started_at = None
+        self.restart_at = None
+        self.backoff = 1.0
+        self.restarts = 0
+        self.last_exit = None
+        self.last_call = time.monotonic()
+        self.call_ms = deque(maxlen=500)
+        self.failures = 0
+    
+    def start(self) -> bool:
+        """Spawn the child and its supervisor thread"""
+        self.running = True
+        started = self.spawn()
+        threading.Thread(target=self.supervise, name=f'{self.name}-supervisor', daemon=True).start()
+        return started
+    
+    def spawn(self) -> bool:
+        rpc, child_rpc = self.context.Pipe()
+        events, child_events = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=self.target, args=(child_rpc, child_events, self.get_config()),
+                                       name=f'urbanketl-{self.name}', daemon=True)
+        try:
+            process.start()
+        except OSError as e:
+            self.logger.error(f"❌ Could not start {self.name} process: {e}")
+            self.restart_at = time.monotonic() + self.backoff
+            return False
+        finally:
+            child_rpc.close()
+            child_events.close()
+        
+        with self.lock:
+            self.process, self.rpc, self.events = process, rpc, events
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        self.logger.info(f"🧩 {self.name} process started (pid {process.pid})")
+        return True
+    
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+    
+    def kill(self, reason: str):
+        """Terminate the child; the supervisor restarts it after the backoff"""
+        process = self.process
+        if process is None:
+            return
+        self.logger.error(f"❌ {self.name} process failed ({reason}) - restarting in {self.backoff:.0f}s")
+        self.failures += 1
+        if process.is_alive():
+            process.kill()
+        process.join(1)
+        self.last_exit = {'reason': reason, 'exitCode': process.exitcode, 'at': datetime.now().isoformat(timespec='seconds')}
+        self.process = None
+        for conn in (self.rpc, self.events):
+            if conn is not None:
+                conn.close()
+        self.rpc = self.events = None
+        
+        # A child that ran for a while earns a fast restart again
+        if self.started_at is not None and time.monotonic() - self.started_at > 60:
+            self.backoff = 1.0
+        self.restart_at = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, self.get_config().get('process_restart_max', 30))
+    
+    def supervise(self):
+        while self.running:
+            time.sleep(0.5)
+            if not self.running:
+                return
+            
+            if self.process is not None and not self.process.is_alive():
+                with self.lock:
+                    self.kill(f"exited with code {self.process.exitcode}")
+            
+            if self.process is None:
+                if self.restart_at is not None and time.monotonic() >= self.restart_at:
+                    self.restarts += 1
+                    self.spawn()
+                continue
+            
+            # A hung child (e.g. stuck in a driver call) only shows up as a missed ping
+            if time.monotonic() - self.last_call >= self.get_config().get('process_ping_interval', 5):
+                try:
+                    self.call('ping', blocking=False)
+                except RuntimeError:
+                    pass
+    
+    def call(self, op: str, *args, wait: bool = True, timeout: Optional[float] = None, blocking: bool = True):
+        """Run op in the child and return its result. Raises RuntimeError if the child is unavailable."""
+        if not self.lock.acquire(blocking):
+            return None  # Busy with a real call, which proves the child is alive
+        try:
+            if self.rpc is None:
+                raise RuntimeError(f"{self.name} process is not running")
+            
+            self.last_call = time.monotonic()
+            started = time.perf_counter()
+            call_id = None
+            if wait:
+                self.next_id += 1
+                call_id = self.next_id
+            
+            try:
+                self.rpc.send((call_id, op, args))
+                if not wait:
+                    return None
+                if timeout is None:
+                    timeout = self.get_config().get('process_call_timeout', 5)
+                if not self.rpc.poll(timeout):
+                    self.kill(f"no reply to {op} within {timeout}s")
+                    raise RuntimeError(f"{self.name} process timed out")
+                reply_id, ok, value = self.rpc.recv()
+            except (EOFError, OSError) as e:
+                self.kill(f"pipe closed during {op}: {e}")
+                raise RuntimeError(f"{self.name} process died")
+            
+            if reply_id != call_id:
+                self.kill(f"reply {reply_id} out of order for {op}")
+                raise RuntimeError(f"{self.name} process out of sync")
+            self.call_ms.append((time.perf_counter() - started) * 1000)
+            if not ok:
+                raise RuntimeError(f"{self.name} process {op} failed: {value}")
+            return value
+        finally:
+            self.lock.release()
+    
+    def next_event(self, timeout: float) -> Optional[tuple]:
+        """Next event from the child, waiting up to timeout seconds"""
+        events = self.events
+        if events is None:
+            time.sleep(timeout)
+            return None
+        try:
+            if events.poll(timeout):
+                return events.recv()
+        except (EOFError, OSError):
+            time.sleep(timeout)  # Supervisor notices the exit and restarts the child
+        return None
+    
+    def stop(self):
+        self.running = False
+        try:
+            self.call('stop', timeout=2)
+        except RuntimeError:
+            pass
+        if self.process is not None:
+            self.process.join(2)
+            if self.process.is_alive():
+                self.process.kill()
+        self.logger.info(f"⏹️  {self.name} process stopped")
+    
+    def get_status(self) -> Dict[str, Any]:
+        samples = list(self.call_ms)
+        return {
+            'pid': self.process.pid if self.process is not None else None,
+            'alive': self.alive(),
+            'uptimeSec': round(time.monotonic() - self.started_at) if self.alive() else None,
+            'restarts': self.restarts,
+            'failures': self.failures,
+            'lastExit': self.last_exit,
+            'callP50Ms': percentile(samples, 50),
+            'callP95Ms': percentile(samples, 95)
+        }
+
+
+class ProcessReader(ReaderInterface):
+    """Reader proxy for a ReaderSupervisor running in its own process"""
+    
+    def __init__(self, get_config: Callable[[], Dict[str, Any]]):
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.worker = WorkerProcess('reader', reader_process_main, get_config)
+        self.name = "Reader process (starting)"
+        self.uid = None
+        self.armed = True
+    
+    def initialize(self, config: Dict[str, Any]) -> bool:
+        """Start the reader process and wait until it has probed the hardware"""
+        if not self.worker.start():
+            return False
+        deadline = time.monotonic() + config.get('process_start_timeout', 30)
+        while time.monotonic() < deadline:
+            event = self.worker.next_event(0.5)
+            if event and event[0] == 'ready':
+                self.name = event[1]
+                return True
+        return False
+    
+    def read_uid(self, timeout: float = 0.05) -> Optional[bytes]:
+        try:
+            if not self.armed:
+                self.worker.call('arm', wait=False)
+                self.armed = True
+        except RuntimeError:
+            pass
+        
+        event = self.worker.next_event(timeout)
+        if event:
+            kind, value = event
+            if kind == 'ready':  # Restarted child starts with an empty field
+                self.name = value
+                self.uid = None
+            elif kind == 'uid':
+                self.uid = value
+                if value:
+                    self.armed = False  # Child holds off until this tap is done
+        return self.uid
+    
+    def send_apdu(self, apdu_command: list) -> Optional[bytes]:
+        try:
+            response, rf_errors = self.worker.call('apdu', apdu_command)
+            self.rf_errors += rf_errors
+            return response
+        except RuntimeError as e:
+            self.logger.error(f"❌ APDU exchange failed: {e}")
+            self.rf_errors += 1
+            return None
+    
+    def card_info(self) -> Dict[str, Any]:
+        try:
+            return self.worker.call('card_info', timeout=2)
+        except RuntimeError:
+            return {}
+    
+    def configure(self, config: Dict[str, Any]):
+        try:
+            self.worker.call('configure', config, wait=False)
+        except RuntimeError:
+            pass  # A restarted child gets the current config
+    
+    def request_reinit(self):
+        try:
+            self.worker.call('reinit', wait=False)
+        except RuntimeError:
+            pass
+    
+    def get_reader_name(self) -> str:
+        return self.name
+    
+    def get_status(self) -> Dict[str, Any]:
+        """Reader health from the child plus process state"""
+        try:
+            status = self.worker.call('status', timeout=2)
+            self.name = status.pop('name')
+        except RuntimeError:
+            status = {}
+        status['process'] = self.worker.get_status()
+        return status
+    
+    def stop(self):
+        self.worker.stop()
+
+
+class ProcessActuator:
+    """
+    Actuator proxy for GPIO running in its own process
+    
+    LEDs and buzzer are fire-and-forget, so feedback no longer holds up the
+    tap; the child runs commands in order, so a dispense still follows the
+    indications queued before it. A restarted child drives the valve low
+    before doing anything else.
+    """
+    
+    def __init__(self, get_config: Callable[[], Dict[str, Any]]):
+        self.get_config = get_config
+        self.logger = logging.getLogger(__name__)
+        self.worker = WorkerProcess('actuator', actuator_process_main, get_config)
+    
+    def start(self) -> bool:
+        return self.worker.start()
+    
+    def setup(self, previous_pins: Optional[Dict[str, int]] = None):
+        try:
+            self.worker.call('configure', self.get_config(), previous_pins)
+        except RuntimeError as e:
+            self.logger.error(f"❌ Failed to initialize GPIO: {e}")
+    
+    def dispense(self, dispense_time: float) -> Dict[str, Any]:
+        # Raises RuntimeError if the valve could not be driven
+        return self.worker.call('dispense', dispense_time,
+                                timeout=dispense_time + self.get_config().get('process_call_timeout', 5))
+    
+    def dispense_sequence(self, steps: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return self.worker.call('dispense_sequence', steps,
+                                timeout=sum(step['seconds'] for step in steps) + self.get_config().get('process_call_timeout', 5))
+    
+    def dispense_volume(self, volume_ml: float) -> Dict[str, Any]:
+        config = self.get_config()
+        return self.worker.call('dispense_volume', volume_ml,
+                                timeout=config.get('flow_timeout', 15) + config.get('process_call_timeout', 5))
+    
+    def set_led(self, color: str, mode: str = 'on'):
+        try:
+            self.worker.call('set_led', color, mode, wait=False)
+        except RuntimeError:
+            pass
+    
+    def beep(self, duration: float = 0.1):
+        try:
+            self.worker.call('beep', duration, wait=False)
+        except RuntimeError:
+            pass
+    
+    def stop(self):
+        self.worker.stop()
+
+
+class TapWorker:
+    """
+    Long-lived thread that processes taps one at a time
+    
+    The machine has one reader and one valve, and the poller does not read
+    another card until the current tap has finished (processing_card), so
+    taps never overlap and a pool or queue would never hold more than one.
+    A single worker replaces the thread per tap, so the thread count stays
+    flat however often the reader flaps. A tap handed over while the worker
+    is still busy is refused (BUSY) rather than queued.
+    """
+    
+    NAME = 'tap-worker'
+    
+    def __init__(self, handler: Callable[..., Any], liveness: LivenessMonitor):
+        self.handler = handler
+        self.liveness = liveness
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Condition()
+        self.task = None
+        self.busy = None  # (card uid, started)
+        self.running = False
+        self.thread = None
+        self.stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'rejected': 0
+        }
+    
+    def start(self):
+        self.running = True
+        # Idle, the worker beats every second; while busy it is covered by its tap's own liveness entry
+        self.liveness.register(self.NAME, lambda: float('inf') if self.busy else 5)
+        self.thread = threading.Thread(target=self.worker_loop, name=self.NAME, daemon=True)
+        self.thread.start()
+        self.logger.info("👷 Tap worker started")
+    
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.task = None
+            self.lock.notify()
+        self.liveness.unregister(self.NAME)
+    
+    def submit(self, *args) -> bool:
+        """Hand a tap to the worker. Returns False if it is still busy with the previous one."""
+        with self.lock:
+            if self.busy or self.task:
+                self.stats['rejected'] += 1
+                self.logger.warning(f"🚧 Tap worker busy - rejected tap {args[0]}")
+                return False
+            self.stats['submitted'] += 1
+            self.task = args
+            self.lock.notify()
+        return True
+    
+    def worker_loop(self):
+        while True:
+            with self.lock:
+                while self.running and self.task is None:
+                    self.liveness.beat(self.NAME)
+                    self.lock.wait(timeout=1)
+                if not self.running:
+                    return
+                args, self.task = self.task, None
+                self.busy = (args[0], time.monotonic())
+            
+            try:
+                self.handler(*args)
+                outcome = 'completed'
+            except Exception as e:
+                self.logger.error(f"❌ Tap worker error: {e}")
+                outcome = 'failed'
+            finally:
+                with self.lock:
+                    self.busy = None
+                    self.stats[outcome] += 1
+                self.liveness.beat(self.NAME)
+    
+    def get_status(self) -> Dict[str, Any]:
+        with self.lock:
+            card, started = self.busy or (None, None)
+            return {
+                'busy': card is not None,
+                'card': card,
+                'runningSec': round(time.monotonic() - started, 1) if started is not None else None,
+                **self.stats
+            }